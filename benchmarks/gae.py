@@ -0,0 +1,57 @@
+"""
+Compares the scan-based ``compute_returns_and_advantages`` against the original
+per-timestep loop for a range of rollout sizes.
+
+Usage: ``python benchmarks/gae.py [--device cuda] [--repeats 50]``
+"""
+import time
+from typing import Callable
+
+import click
+import torch
+
+from enn_trainer.gae import (
+    _reference_returns_and_advantages,
+    compute_returns_and_advantages,
+)
+
+SIZES = [(16, 128), (64, 256), (128, 256), (256, 1024), (1024, 64)]
+
+
+def _time(fn: Callable[[], object], repeats: int, device: torch.device) -> float:
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+@click.command()
+@click.option("--device", default="cpu", help="Device to run the benchmark on.")
+@click.option("--repeats", default=50, help="Number of timed repetitions per size.")
+def main(device: str, repeats: int) -> None:
+    dev = torch.device(device)
+    click.echo(
+        f"{'steps':>6} {'envs':>6} {'gae':>5} {'loop (ms)':>10} {'scan (ms)':>10} {'speedup':>8}"
+    )
+    for steps, num_envs in SIZES:
+        rewards = torch.randn(steps, num_envs, device=dev)
+        values = torch.randn(steps, num_envs, device=dev)
+        dones = (torch.rand(steps, num_envs, device=dev) < 0.05).float()
+        next_value = torch.randn(1, num_envs, device=dev)
+        next_done = (torch.rand(num_envs, device=dev) < 0.05).float()
+        for gae in [True, False]:
+            args = (next_value, next_done, rewards, dones, values, gae, 0.99, 0.95)
+            loop = _time(lambda: _reference_returns_and_advantages(*args), repeats, dev)
+            scan = _time(lambda: compute_returns_and_advantages(*args), repeats, dev)
+            click.echo(
+                f"{steps:>6} {num_envs:>6} {str(gae):>5} {loop * 1000:>10.3f} {scan * 1000:>10.3f} {loop / scan:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Compares the per-decision latency of ``RogueNetAgent`` and an agent exported with
+``enn_trainer.export`` on CPU, for a single observation at a time.
+
+Usage: ``python benchmarks/inference_latency.py [--env MultiSnake] [--d-model 64]``
+"""
+import os
+import tempfile
+import time
+from typing import List
+
+import click
+import numpy as np
+import torch
+from entity_gym.examples import ENV_REGISTRY
+from entity_gym.runner import Agent
+from rogue_net.rogue_net import RogueNetConfig
+
+from enn_trainer.agent import RogueNetAgent
+from enn_trainer.config import EnvConfig, OptimizerConfig, PPOConfig, RolloutConfig
+from enn_trainer.export import export_agent, load_exported_agent
+from enn_trainer.train import TrainConfig, _create_agent
+
+
+def _latencies(agent: Agent, env_id: str, decisions: int) -> List[float]:
+    env = ENV_REGISTRY[env_id]()
+    obs_space = env.obs_space()
+    obs = env.reset_filter(obs_space)
+    latencies = []
+    for _ in range(decisions):
+        start = time.perf_counter()
+        actions, _ = agent.act(obs)
+        latencies.append(time.perf_counter() - start)
+        obs = env.act_filter(actions, obs_space)
+        if obs.done:
+            obs = env.reset_filter(obs_space)
+    return latencies
+
+
+@click.command()
+@click.option("--env", "env_id", default="MultiSnake", help="Environment id.")
+@click.option("--d-model", default=64, help="Width of the network.")
+@click.option("--n-layer", default=2, help="Number of transformer blocks.")
+@click.option("--decisions", default=2000, help="Number of timed decisions.")
+@click.option("--threads", default=1, help="Number of threads used by torch.")
+def main(env_id: str, d_model: int, n_layer: int, decisions: int, threads: int) -> None:
+    torch.set_num_threads(threads)
+    env = ENV_REGISTRY[env_id]()
+    cfg = TrainConfig(
+        env=EnvConfig(id=env_id),
+        net=RogueNetConfig(d_model=d_model, n_layer=n_layer),
+        optim=OptimizerConfig(),
+        ppo=PPOConfig(),
+        rollout=RolloutConfig(),
+    )
+    net = _create_agent(cfg, env.obs_space(), env.action_space())
+    net.eval()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "policy.pt")
+        export_agent(net, path)
+        agents = [
+            ("RogueNetAgent", RogueNetAgent(net)),
+            ("exported", load_exported_agent(path)),
+        ]
+        click.echo(f"{'agent':>14} {'p50 (us)':>10} {'p99 (us)':>10} {'mean (us)':>10}")
+        for name, agent in agents:
+            # Warm up allocators and the TorchScript profiling executor
+            _latencies(agent, env_id, 100)
+            latencies = np.array(_latencies(agent, env_id, decisions)) * 1e6
+            click.echo(
+                f"{name:>14} {np.percentile(latencies, 50):>10.0f} "
+                f"{np.percentile(latencies, 99):>10.0f} {latencies.mean():>10.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Compares RogueNetAgent against BatchingAgent when many client threads request actions
+concurrently, and prints the latency percentiles and batch sizes of BatchingAgent.
+
+Usage: ``python benchmarks/inference_server.py [--clients 64] [--max-delay-ms 2]``
+"""
+import threading
+import time
+from typing import List
+
+import click
+import numpy as np
+import torch
+from entity_gym.examples import ENV_REGISTRY
+from entity_gym.runner import Agent
+from rogue_net.rogue_net import RogueNetConfig
+
+from enn_trainer.agent import RogueNetAgent
+from enn_trainer.config import EnvConfig, OptimizerConfig, PPOConfig, RolloutConfig
+from enn_trainer.serve import BatchingAgent
+from enn_trainer.train import TrainConfig, _create_agent
+
+
+def _client(agent: Agent, env_id: str, decisions: int, latencies: List[float]) -> None:
+    env = ENV_REGISTRY[env_id]()
+    obs_space = env.obs_space()
+    obs = env.reset_filter(obs_space)
+    for _ in range(decisions):
+        start = time.perf_counter()
+        actions, _ = agent.act(obs)
+        latencies.append(time.perf_counter() - start)
+        obs = env.act_filter(actions, obs_space)
+        if obs.done:
+            obs = env.reset_filter(obs_space)
+
+
+def _run(agent: Agent, env_id: str, clients: int, decisions: int) -> None:
+    latencies: List[float] = []
+    threads = [
+        threading.Thread(target=_client, args=(agent, env_id, decisions, latencies))
+        for _ in range(clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    ms = np.array(latencies) * 1000
+    click.echo(
+        f"{type(agent).__name__:>14} {len(latencies) / elapsed:>12.0f} "
+        f"{np.percentile(ms, 50):>9.2f} {np.percentile(ms, 99):>9.2f}"
+    )
+
+
+@click.command()
+@click.option("--env", "env_id", default="MultiSnake", help="Environment id.")
+@click.option("--d-model", default=64, help="Width of the network.")
+@click.option("--clients", default=64, help="Number of concurrent client threads.")
+@click.option("--decisions", default=100, help="Decisions per client.")
+@click.option("--max-batch-size", default=64, help="Maximum batch size of the server.")
+@click.option("--max-delay-ms", default=2.0, help="Latency budget of the server.")
+def main(
+    env_id: str,
+    d_model: int,
+    clients: int,
+    decisions: int,
+    max_batch_size: int,
+    max_delay_ms: float,
+) -> None:
+    env = ENV_REGISTRY[env_id]()
+    cfg = TrainConfig(
+        env=EnvConfig(id=env_id),
+        net=RogueNetConfig(d_model=d_model, n_layer=2),
+        optim=OptimizerConfig(),
+        ppo=PPOConfig(),
+        rollout=RolloutConfig(),
+    )
+    net = _create_agent(cfg, env.obs_space(), env.action_space())
+    if torch.cuda.is_available():
+        net = net.cuda()
+    click.echo(f"{'agent':>14} {'decisions/s':>12} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+    # The server puts the network in evaluation mode, which the baseline shares
+    with BatchingAgent(net, max_batch_size, max_delay_ms) as server:
+        _run(RogueNetAgent(net), env_id, clients, decisions)
+        _run(server, env_id, clients, decisions)
+        stats = server.stats()
+    click.echo(
+        f"server latency p50 {stats.latency_p50_ms:.2f} ms, p99 {stats.latency_p99_ms:.2f} ms"
+    )
+    click.echo(f"batch sizes: {stats.batch_sizes}")
+
+
+if __name__ == "__main__":
+    main()
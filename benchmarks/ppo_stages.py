@@ -0,0 +1,247 @@
+"""
+Times the hot stages of a PPO update in isolation on CPU for the entity-gym configs:
+rollout, returns and advantages, minibatch gather, forward pass, policy and value
+losses, backward pass, and optimizer step.
+
+Results are written as JSON. When a baseline produced by an earlier run is given, stages
+that are slower than the baseline by more than the threshold are reported as
+regressions and the command exits with a non-zero status.
+
+Usage: ``python benchmarks/ppo_stages.py [--config configs/entity-gym/xor.ron] [--output results.json] [--baseline baseline.json]``
+"""
+import json
+import platform
+import random
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+import click
+import hyperstate
+import numpy as np
+import torch
+from entity_gym.examples import ENV_REGISTRY
+from entity_gym.simple_trace import Tracer
+
+from enn_trainer.config import TrainConfig
+from enn_trainer.gae import returns_and_advantages
+from enn_trainer.ppo import ActorLayout, ppo_loss, value_loss
+from enn_trainer.rollout import Rollout, RolloutBatch
+from enn_trainer.train import SerializableAdamW, _create_agent, _env_factory
+
+CONFIG_DIR = Path(__file__).parent.parent / "configs" / "entity-gym"
+STAGES = [
+    "rollout",
+    "advantages",
+    "gather",
+    "forward",
+    "loss",
+    "backward",
+    "optimizer_step",
+]
+
+T = TypeVar("T")
+
+
+def _timed(times: List[float], fn: Callable[[], T]) -> T:
+    start = time.perf_counter()
+    result = fn()
+    times.append(time.perf_counter() - start)
+    return result
+
+
+def benchmark_config(
+    cfg: TrainConfig, repeats: int, seed: int
+) -> Dict[str, Dict[str, float]]:
+    """
+    Returns the median and minimum time in milliseconds of each stage for one config.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    device = torch.device("cpu")
+    tracer = Tracer(cuda=False)
+    envs = _env_factory(ENV_REGISTRY[cfg.env.id])(cfg.env, cfg.rollout.num_envs, 1, 0)
+    obs_space = envs.obs_space()
+    action_space = envs.action_space()
+    agent = _create_agent(cfg, obs_space, action_space)
+    optimizer = SerializableAdamW(
+        agent.parameters(),
+        lr=cfg.optim.lr,
+        weight_decay=cfg.optim.weight_decay,
+        eps=1e-5,
+    )
+    rollout = Rollout(envs, obs_space, action_space, agent, device, tracer)
+    times: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+    try:
+        # Warm up allocations of the rollout buffers
+        rollout.run(cfg.rollout.steps, record_samples=True)
+        for _ in range(repeats):
+            next_obs, next_done, _ = _timed(
+                times["rollout"],
+                lambda: rollout.run(cfg.rollout.steps, record_samples=True),
+            )
+
+            def advantages() -> Tuple[torch.Tensor, torch.Tensor]:
+                with torch.no_grad():
+                    return returns_and_advantages(
+                        agent,
+                        next_obs,
+                        next_done,
+                        rollout.rewards,
+                        rollout.dones,
+                        rollout.values,
+                        cfg.ppo.gae,
+                        cfg.ppo.gamma,
+                        cfg.ppo.gae_lambda,
+                        device,
+                        tracer,
+                    )
+
+            returns, advantages_ = _timed(times["advantages"], advantages)
+            actor_layout = ActorLayout.from_logprobs(rollout.logprobs.buffers, device)
+            batch = RolloutBatch(rollout, actor_layout, advantages_, returns)
+            mb_inds = np.random.permutation(batch.frames)[
+                : min(cfg.optim.bs, batch.frames)
+            ]
+
+            mb = _timed(
+                times["gather"],
+                lambda: batch.gather(mb_inds, batch.upload_indices(mb_inds)),
+            )
+            _, newlogprob, entropy, _, aux, _ = _timed(
+                times["forward"],
+                lambda: agent.get_action_and_auxiliary(
+                    mb.entities,
+                    mb.visible,
+                    mb.action_masks,
+                    prev_actions=mb.actions,
+                    tracer=tracer,
+                ),
+            )
+
+            def loss() -> torch.Tensor:
+                pg_loss, _ = ppo_loss(
+                    cfg.ppo, newlogprob, mb.actors, mb.advantages, device, tracer
+                )
+                v_loss = value_loss(
+                    cfg.ppo, aux["value"], mb.returns, mb.values, tracer
+                )
+                entropy_loss = torch.cat(list(entropy.values())).mean()
+                return (
+                    pg_loss - cfg.ppo.ent_coef * entropy_loss + v_loss * cfg.ppo.vf_coef
+                )
+
+            optimizer.zero_grad()
+            loss_ = _timed(times["loss"], loss)
+            _timed(times["backward"], loss_.backward)
+            _timed(times["optimizer_step"], optimizer.step)
+            tracer.finish()
+    finally:
+        envs.close()
+    return {
+        stage: {
+            "median_ms": float(np.median(t)) * 1000,
+            "min_ms": float(np.min(t)) * 1000,
+        }
+        for stage, t in times.items()
+    }
+
+
+def compare(
+    results: Dict[str, Any], baseline: Dict[str, Any], threshold: float
+) -> List[str]:
+    """
+    Returns a description of every stage whose median time exceeds the baseline by more
+    than ``threshold`` (a fraction of the baseline time).
+    """
+    regressions = []
+    for name, stages in results["configs"].items():
+        for stage, timing in stages.items():
+            base = baseline["configs"].get(name, {}).get(stage)
+            if base is None:
+                continue
+            if timing["median_ms"] > base["median_ms"] * (1 + threshold):
+                regressions.append(
+                    f"{name} {stage}: {base['median_ms']:.3f}ms -> {timing['median_ms']:.3f}ms "
+                    f"(+{(timing['median_ms'] / base['median_ms'] - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+@click.command()
+@click.option(
+    "--config",
+    "configs",
+    multiple=True,
+    type=click.Path(exists=True),
+    help="Configs to benchmark, defaults to all configs in configs/entity-gym.",
+)
+@click.option("--repeats", default=10, help="Number of timed repetitions per stage.")
+@click.option("--seed", default=0, help="Seed of the environments and network.")
+@click.option("--threads", default=None, type=int, help="Number of torch threads.")
+@click.option("--output", default=None, type=click.Path(), help="Write JSON results.")
+@click.option(
+    "--baseline",
+    default=None,
+    type=click.Path(exists=True),
+    help="Compare against the JSON results of an earlier run.",
+)
+@click.option(
+    "--threshold",
+    default=0.1,
+    help="Relative slowdown that is reported as a regression.",
+)
+def main(
+    configs: Tuple[str, ...],
+    repeats: int,
+    seed: int,
+    threads: Optional[int],
+    output: Optional[str],
+    baseline: Optional[str],
+    threshold: float,
+) -> None:
+    if threads is not None:
+        torch.set_num_threads(threads)
+    paths = [Path(c) for c in configs] or sorted(CONFIG_DIR.glob("*.ron"))
+    results: Dict[str, Any] = {
+        "environment": {
+            "python": sys.version.split()[0],
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "threads": torch.get_num_threads(),
+        },
+        "repeats": repeats,
+        "seed": seed,
+        "configs": {},
+    }
+    click.echo(f"{'config':<28} " + " ".join(f"{s:>14}" for s in STAGES))
+    for path in paths:
+        cfg = hyperstate.load(TrainConfig, path)
+        cfg.cuda = False
+        stages = benchmark_config(cfg, repeats, seed)
+        results["configs"][path.stem] = stages
+        click.echo(
+            f"{path.stem:<28} "
+            + " ".join(f"{stages[s]['median_ms']:>12.3f}ms" for s in STAGES)
+        )
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        click.echo(json.dumps(results, indent=2))
+
+    if baseline is not None:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), threshold)
+        for regression in regressions:
+            click.echo(f"REGRESSION {regression}")
+        if len(regressions) > 0:
+            sys.exit(1)
+        click.echo("No regressions")
+
+
+if __name__ == "__main__":
+    main()
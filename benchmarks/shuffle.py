@@ -0,0 +1,95 @@
+"""
+Compares the vectorized ``deterministic_permutation`` against the original loop, and the
+time to gather batches from a memory-mapped array with frame-level and block shuffles.
+
+Usage: ``python benchmarks/shuffle.py [--rows 4000000] [--block-size 64]``
+"""
+import math
+import os
+import tempfile
+import time
+from typing import Callable
+
+import click
+import numpy as np
+import numpy.typing as npt
+
+from enn_trainer.supervised import block_permutation, deterministic_permutation
+
+SIZES = [10_000, 100_000, 1_000_000, 4_000_000]
+
+
+def loop_deterministic_permutation(n: int) -> npt.NDArray[np.int64]:
+    stepsize = int(math.sqrt(n))
+    perm = np.zeros(n, dtype=np.int64)
+    index = 0
+    offset = 0
+    for i in range(n):
+        perm[i] = index
+        index += stepsize
+        if index >= n:
+            offset += 1
+            index = offset
+    return perm
+
+
+def _time(fn: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.option("--rows", default=4_000_000, help="Number of rows of the mapped array.")
+@click.option("--row-bytes", default=256, help="Size of each row in bytes.")
+@click.option("--batch-size", default=2048, help="Rows gathered per batch.")
+@click.option("--block-size", default=64, help="Rows per block of the block shuffle.")
+@click.option("--batches", default=200, help="Number of batches to gather.")
+def main(
+    rows: int, row_bytes: int, batch_size: int, block_size: int, batches: int
+) -> None:
+    click.echo(
+        f"{'frames':>10} {'loop (ms)':>10} {'vectorized (ms)':>16} {'speedup':>8}"
+    )
+    for n in SIZES:
+        loop = _time(lambda: loop_deterministic_permutation(n))
+        vectorized = _time(lambda: deterministic_permutation(n))
+        assert np.array_equal(
+            loop_deterministic_permutation(n), deterministic_permutation(n)
+        )
+        click.echo(
+            f"{n:>10} {loop * 1000:>10.1f} {vectorized * 1000:>16.2f} {loop / vectorized:>7.0f}x"
+        )
+
+    click.echo()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "data.bin")
+        data = np.memmap(
+            path, dtype=np.float32, mode="w+", shape=(rows, row_bytes // 4)
+        )
+        data[:] = 1.0
+        data.flush()
+        del data
+        click.echo(f"{'shuffle':>10} {'gather (ms/batch)':>18}")
+        for name, bs in [("frame", 1), ("block", block_size)]:
+            # Drop the file from the page cache to measure reads from storage
+            if hasattr(os, "posix_fadvise"):
+                with open(path, "rb") as f:
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            mapped = np.memmap(
+                path, dtype=np.float32, mode="r", shape=(rows, row_bytes // 4)
+            )
+            perm = block_permutation(rows, bs)
+            elapsed = _time(
+                lambda: [
+                    np.ascontiguousarray(
+                        mapped[perm[i * batch_size : (i + 1) * batch_size]]
+                    )
+                    for i in range(batches)
+                ]
+            )
+            click.echo(f"{name:>10} {elapsed / batches * 1000:>18.3f}")
+
+
+if __name__ == "__main__":
+    main()
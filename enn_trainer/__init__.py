@@ -10,7 +10,14 @@ from .config import (
     RolloutConfig,
     TrainConfig,
 )
-from .load_checkpoint import init_train_state, load_agent, load_checkpoint
+from .export import CompiledRogueNetAgent, export_agent, load_exported_agent
+from .load_checkpoint import (
+    init_train_state,
+    load_agent,
+    load_checkpoint,
+    load_rogue_net,
+)
+from .serve import BatchingAgent, ServingStats
 from .train import State, train
 
 __all__ = [
@@ -24,8 +31,14 @@ __all__ = [
     "EnvConfig",
     "State",
     "RogueNetAgent",
+    "CompiledRogueNetAgent",
+    "BatchingAgent",
+    "ServingStats",
     "train",
     "load_checkpoint",
     "load_agent",
+    "load_rogue_net",
     "init_train_state",
+    "export_agent",
+    "load_exported_agent",
 ]
@@ -14,6 +14,8 @@ from rogue_net.rogue_net import RogueNet
 
 
 class PPOAgent(Protocol):
+    training: bool
+
     def get_action_and_auxiliary(
         self,
         entities: Mapping[str, RaggedBufferF32],
@@ -37,6 +39,12 @@ class PPOAgent(Protocol):
     def parameters(self, recurse: bool = True) -> Iterator[torch.nn.Parameter]:
         ...
 
+    def train(self, mode: bool = True) -> "PPOAgent":
+        ...
+
+    def eval(self) -> "PPOAgent":
+        ...
+
     def get_auxiliary_head(
         self,
         entities: Mapping[str, RaggedBufferF32],
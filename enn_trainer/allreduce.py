@@ -0,0 +1,131 @@
+from typing import Any, Callable, List, Optional
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+
+class _Bucket:
+    def __init__(self, params: List[nn.Parameter]) -> None:
+        self.params = params
+        self.numel = sum(p.numel() for p in params)
+        self.pending = len(params)
+        self.buffer: Optional[torch.Tensor] = None
+        self.work: Optional[Any] = None
+
+
+class GradientAllreduce:
+    """
+    Sums the gradients of a model across all processes with bucketed all-reduces that are
+    launched asynchronously during the backward pass.
+
+    Parameters are grouped into buckets of roughly ``bucket_size_mb`` megabytes in reverse
+    order of registration, which approximates the order in which gradients are computed.
+    As soon as all gradients of a bucket have been accumulated, the bucket is flattened
+    and its all-reduce is started, overlapping communication with the remainder of the
+    backward pass. Buckets are always launched in the same order so that the collectives
+    of all processes match even if their backward passes produce gradients in different
+    orders. :meth:`wait` must be called after the last backward pass of an
+    optimizer step to complete all pending all-reduces and copy back the results.
+    When gradients are accumulated over several microbatches, ``sync`` must be set to
+    ``False`` during all but the last backward pass of the step.
+
+    :param model: The model whose gradients are reduced.
+    :param bucket_size_mb: Maximum size of the gradients reduced by a single all-reduce.
+    :param compress_fp16: Communicate gradients in half precision.
+    """
+
+    def __init__(
+        self, model: nn.Module, bucket_size_mb: float = 1.0, compress_fp16: bool = False
+    ) -> None:
+        self.compress_fp16 = compress_fp16
+        self.sync = True
+        self.buckets: List[_Bucket] = []
+        # Index of the next bucket to launch
+        self._next = 0
+        bucket_size = int(bucket_size_mb * 1024 * 1024)
+        params: List[nn.Parameter] = []
+        nbytes = 0
+        for param in reversed([p for p in model.parameters() if p.requires_grad]):
+            params.append(param)
+            nbytes += param.numel() * param.element_size()
+            if nbytes >= bucket_size:
+                self.buckets.append(_Bucket(params))
+                params = []
+                nbytes = 0
+        if len(params) > 0:
+            self.buckets.append(_Bucket(params))
+        for bucket in self.buckets:
+            for param in bucket.params:
+                _register_post_accumulate_grad_hook(param, self._hook(bucket))
+
+    def wait(self) -> None:
+        """
+        Completes the all-reduces of the current step and writes the summed gradients back.
+        """
+        # Buckets in which some parameters did not receive a gradient are still pending
+        while self._next < len(self.buckets):
+            self._launch(self.buckets[self._next])
+            self._next += 1
+        self._next = 0
+        for bucket in self.buckets:
+            assert bucket.work is not None and bucket.buffer is not None
+            bucket.work.wait()
+            offset = 0
+            for param in bucket.params:
+                chunk = bucket.buffer[offset : offset + param.numel()].view_as(param)
+                if param.grad is None:
+                    # Parameters without a gradient on this process may have one on others
+                    param.grad = chunk.to(param.dtype, copy=True)
+                else:
+                    param.grad.copy_(chunk)
+                offset += param.numel()
+            bucket.work = None
+            bucket.pending = len(bucket.params)
+
+    def _hook(self, bucket: _Bucket) -> Callable[[nn.Parameter], None]:
+        def hook(param: nn.Parameter) -> None:
+            if not self.sync:
+                return
+            bucket.pending -= 1
+            while (
+                self._next < len(self.buckets) and self.buckets[self._next].pending == 0
+            ):
+                self._launch(self.buckets[self._next])
+                self._next += 1
+
+        return hook
+
+    def _launch(self, bucket: _Bucket) -> None:
+        dtype = torch.float16 if self.compress_fp16 else bucket.params[0].dtype
+        device = bucket.params[0].device
+        if (
+            bucket.buffer is None
+            or bucket.buffer.dtype != dtype
+            or bucket.buffer.device != device
+        ):
+            bucket.buffer = torch.empty(bucket.numel, dtype=dtype, device=device)
+        offset = 0
+        for param in bucket.params:
+            chunk = bucket.buffer[offset : offset + param.numel()]
+            if param.grad is None:
+                chunk.zero_()
+            else:
+                chunk.copy_(param.grad.detach().view(-1))
+            offset += param.numel()
+        bucket.work = dist.all_reduce(
+            bucket.buffer, op=dist.ReduceOp.SUM, async_op=True
+        )
+
+
+def _register_post_accumulate_grad_hook(
+    param: nn.Parameter, hook: Callable[[nn.Parameter], None]
+) -> None:
+    if hasattr(param, "register_post_accumulate_grad_hook"):
+        param.register_post_accumulate_grad_hook(hook)
+    else:
+        # Older versions of PyTorch: hook the gradient accumulator of the parameter directly
+        grad_acc = param.expand_as(param).grad_fn.next_functions[0][0]  # type: ignore
+        grad_acc.register_hook(lambda *_: hook(param))  # type: ignore
+        # Keep the accumulator alive, otherwise the hook is dropped
+        param._grad_accumulator = grad_acc  # type: ignore
@@ -0,0 +1,222 @@
+"""
+Finds the number of environments and environment processes that maximize rollout
+throughput on the current machine.
+
+Usage: ``python -m enn_trainer.autotune --config=configs/entity-gym/cherry_pick.ron [--write] [field.name=value ...]``
+"""
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Type
+
+import click
+import hyperstate
+import torch
+from entity_gym.env import Environment
+from entity_gym.examples import ENV_REGISTRY
+from entity_gym.simple_trace import Tracer
+
+from enn_trainer.config import TrainConfig
+from enn_trainer.rollout import Rollout
+from enn_trainer.train import _create_agent, _env_factory
+
+
+@dataclass
+class ProbeResult:
+    """
+    Throughput of rollouts with one setting of ``rollout.num_envs`` and ``rollout.processes``.
+
+    :param sps: Environment steps per second.
+    :param forward: Seconds spent in the forward pass of the policy.
+    :param step: Seconds spent stepping the environments.
+    """
+
+    num_envs: int
+    processes: int
+    sps: float
+    forward: float
+    step: float
+
+
+def probe(
+    cfg: TrainConfig,
+    env_cls: Type[Environment],
+    num_envs: int,
+    processes: int,
+    steps: int,
+    device: torch.device,
+    warmup_steps: int = 2,
+) -> ProbeResult:
+    """
+    Measures the throughput of a rollout with the given number of environments and processes.
+    """
+    create_env = _env_factory(env_cls, cfg.rollout.shared_memory_mb)
+    envs = create_env(cfg.env, num_envs, processes, 0)
+    obs_space = envs.obs_space()
+    action_space = envs.action_space()
+    agent = _create_agent(cfg, obs_space, action_space).to(device)
+    tracer = Tracer(cuda=device.type == "cuda")
+    rollout = Rollout(
+        envs,
+        obs_space=obs_space,
+        action_space=action_space,
+        agent=agent,
+        device=device,
+        tracer=tracer,
+        precision=cfg.optim.precision,
+    )
+    try:
+        rollout.run(warmup_steps, record_samples=True)
+        tracer.finish()
+        start_time = time.time()
+        rollout.run(steps, record_samples=True)
+        elapsed = time.time() - start_time
+        traces = tracer.finish()
+    finally:
+        envs.close()
+    return ProbeResult(
+        num_envs=num_envs,
+        processes=processes,
+        sps=num_envs * steps / elapsed,
+        forward=traces.get("forward", 0.0),
+        step=traces.get("step", 0.0),
+    )
+
+
+def default_grid(cfg: TrainConfig) -> List[int]:
+    """
+    Powers of two between a quarter and four times the configured number of environments
+    that yield at least one full batch per rollout.
+    """
+    candidates = [cfg.rollout.num_envs]
+    n = 1
+    while n <= 4 * cfg.rollout.num_envs:
+        if n * 4 >= cfg.rollout.num_envs:
+            candidates.append(n)
+        n *= 2
+    return sorted(set(n for n in candidates if n * cfg.rollout.steps >= cfg.optim.bs))
+
+
+def autotune(
+    cfg: TrainConfig,
+    env_cls: Type[Environment],
+    num_envs: Sequence[int],
+    processes: Sequence[int],
+    steps: int,
+    device: torch.device,
+) -> List[ProbeResult]:
+    """
+    Probes all combinations of the given numbers of environments and processes for which
+    the environments can be evenly split across the processes.
+    Returns the results ordered from highest to lowest throughput.
+    """
+    results = []
+    for _num_envs in num_envs:
+        for _processes in processes:
+            if _num_envs % _processes != 0:
+                continue
+            result = probe(cfg, env_cls, _num_envs, _processes, steps, device)
+            click.echo(
+                f"num_envs={result.num_envs:<5} processes={result.processes:<3} "
+                f"sps={result.sps:<9.0f} forward={result.forward:.3f}s step={result.step:.3f}s"
+            )
+            results.append(result)
+    return sorted(results, key=lambda r: r.sps, reverse=True)
+
+
+def write_rollout_config(path: str, num_envs: int, processes: int) -> None:
+    """
+    Sets ``rollout.num_envs`` and ``rollout.processes`` in a RON config file,
+    preserving the formatting and comments of the rest of the file.
+    """
+    with open(path) as f:
+        ron = f.read()
+    values = {"num_envs": num_envs, "processes": processes}
+    rollout = re.search(r"^([ \t]*)rollout:\s*\(", ron, re.MULTILINE)
+    if rollout is None:
+        opening = re.search(r"^\w*\(", ron, re.MULTILINE)
+        if opening is None:
+            raise ValueError(f"Could not find the config struct in {path}")
+        fields = "".join(f"\n        {k}: {v}," for k, v in values.items())
+        ron = (
+            ron[: opening.end()]
+            + f"\n    rollout: ({fields}\n    ),"
+            + ron[opening.end() :]
+        )
+    else:
+        end = ron.index(")", rollout.end())
+        block = ron[rollout.end() : end]
+        for key, value in values.items():
+            block, count = re.subn(rf"\b{key}:\s*\d+", f"{key}: {value}", block)
+            if count == 0:
+                block = f"\n{rollout.group(1)}    {key}: {value}," + block
+        ron = ron[: rollout.end()] + block + ron[end:]
+    with open(path, "w") as f:
+        f.write(ron)
+
+
+@click.command(context_settings={"ignore_unknown_options": True})
+@click.option("--config", type=click.Path(exists=True), default=None)
+@click.option(
+    "--num-envs",
+    type=str,
+    default=None,
+    help="Comma separated numbers of environments to probe.",
+)
+@click.option(
+    "--processes",
+    type=str,
+    default=None,
+    help="Comma separated numbers of processes to probe.",
+)
+@click.option("--steps", type=int, default=None, help="Steps per probe rollout.")
+@click.option(
+    "--write",
+    is_flag=True,
+    help="Write the fastest setting back into the config file.",
+)
+@click.argument("overrides", nargs=-1)
+def main(
+    config: Optional[str],
+    num_envs: Optional[str],
+    processes: Optional[str],
+    steps: Optional[int],
+    write: bool,
+    overrides: List[str],
+) -> None:
+    cfg = hyperstate.load(TrainConfig, file=config, overrides=list(overrides))
+    cuda = torch.cuda.is_available() and cfg.cuda
+    device = torch.device("cuda" if cuda else "cpu")
+    if num_envs is None:
+        num_envs_grid = default_grid(cfg)
+    else:
+        num_envs_grid = [int(n) for n in num_envs.split(",")]
+    if processes is None:
+        max_processes = os.cpu_count() or 1
+        processes_grid = [
+            2**i for i in range(max_processes.bit_length()) if 2**i <= max_processes
+        ]
+    else:
+        processes_grid = [int(p) for p in processes.split(",")]
+
+    results = autotune(
+        cfg,
+        ENV_REGISTRY[cfg.env.id],
+        num_envs_grid,
+        processes_grid,
+        steps or cfg.rollout.steps,
+        device,
+    )
+    best = results[0]
+    click.echo(
+        f"Fastest: rollout.num_envs={best.num_envs} rollout.processes={best.processes} ({best.sps:.0f} SPS)"
+    )
+    if write:
+        assert config is not None, "--write requires --config"
+        write_rollout_config(config, best.num_envs, best.processes)
+        click.echo(f"Updated {config}")
+
+
+if __name__ == "__main__":
+    main()
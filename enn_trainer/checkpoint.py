@@ -0,0 +1,173 @@
+import copy
+import dataclasses
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import hyperstate
+import torch
+from hyperstate import StateManager
+
+from enn_trainer.config import TrainConfig
+
+
+class _Snapshot(hyperstate.Serializable):
+    """
+    Serializes a copy of the state dict of a network or optimizer taken at checkpoint time.
+
+    Snapshots only exist while a checkpoint is written. Their serialized form is identical
+    to that of the network or optimizer they were taken from, and hyperstate deserializes
+    checkpoints with the field types declared by the training state, so a snapshot is
+    never deserialized.
+    """
+
+    def __init__(self, state_dict: Any) -> None:
+        self.state_dict = state_dict
+
+    def serialize(self) -> Any:
+        return self.state_dict
+
+    @classmethod
+    def deserialize(
+        clz, state_dict: Any, config: Any, state: Any, ctx: Dict[str, Any]
+    ) -> "_Snapshot":
+        raise TypeError(
+            "Checkpoint snapshots cannot be deserialized, checkpoints are loaded with the "
+            "field types declared by the training state"
+        )
+
+
+class Checkpointer:
+    """
+    Persists the training state to the checkpoint directory of a StateManager.
+
+    Checkpoints are written to a temporary directory and atomically moved to
+    ``<checkpoint_dir>/latest-step<step>``, and only the ``keep`` most recent checkpoints
+    are retained. With ``asynchronous`` set, :meth:`step` copies the state dicts of all
+    networks and optimizers to CPU and returns immediately while the copy is written on a
+    background thread. Checkpoints that fall due while the previous one is still being
+    written are skipped, except for the last one, which is written by :meth:`close`.
+
+    :param state_manager: The StateManager of the training run. The checkpointer takes over
+        its checkpoint directory, so that ``state_manager.step()`` only updates schedules.
+    :param keep: Number of most recent checkpoints to keep.
+    :param asynchronous: Write checkpoints on a background thread.
+    """
+
+    def __init__(
+        self,
+        state_manager: StateManager[TrainConfig, Any],
+        keep: int = 1,
+        asynchronous: bool = False,
+    ) -> None:
+        if keep < 1:
+            raise ValueError(
+                f"Number of checkpoints to keep must be positive, got {keep}"
+            )
+        self.state_manager = state_manager
+        self.checkpoint_dir = state_manager.checkpoint_dir
+        state_manager.checkpoint_dir = None
+        self.keep = keep
+        self._checkpoint_name = re.compile(
+            rf"latest-{re.escape(state_manager.checkpoint_key)}(\d{{12}})$"
+        )
+        self._executor = ThreadPoolExecutor(max_workers=1) if asynchronous else None
+        self._pending: Optional[Future[None]] = None
+        self._skipped = False
+        self._lock = threading.Lock()
+        self._write_times: List[float] = []
+
+    def step(self) -> None:
+        """
+        Updates all hyperparameter schedules and checkpoints the current state.
+        """
+        self.state_manager.step()
+        if self.checkpoint_dir is None:
+            return
+        if self._executor is None:
+            self._write(self.state_manager)
+            return
+        if self._pending is not None:
+            if not self._pending.done():
+                self._skipped = True
+                return
+            # Raise errors of the previous write
+            self._pending.result()
+        self._skipped = False
+        self._pending = self._executor.submit(self._write, self._snapshot())
+
+    def write_times(self) -> List[float]:
+        """
+        Returns the durations in seconds of all checkpoint writes that completed since the
+        last call.
+        """
+        with self._lock:
+            write_times = self._write_times
+            self._write_times = []
+        return write_times
+
+    def close(self) -> None:
+        """
+        Waits for the pending checkpoint and writes the most recent state if it was skipped.
+        """
+        if self._executor is None:
+            return
+        try:
+            if self._pending is not None:
+                pending, self._pending = self._pending, None
+                pending.result()
+            if self._skipped and self.checkpoint_dir is not None:
+                self._write(self.state_manager)
+                self._skipped = False
+        finally:
+            self._executor.shutdown()
+
+    def _snapshot(self) -> StateManager[TrainConfig, Any]:
+        state = self.state_manager.state
+        snapshots = {
+            field.name: _Snapshot(_to_cpu(getattr(state, field.name).state_dict()))
+            for field in dataclasses.fields(state)
+            if isinstance(getattr(state, field.name), hyperstate.Serializable)
+        }
+        manager = copy.copy(self.state_manager)
+        # Schedules update the config in place while the checkpoint is written
+        manager._config = copy.deepcopy(self.state_manager.config)
+        manager._state = dataclasses.replace(state, **snapshots)
+        return manager
+
+    def _write(self, manager: StateManager[TrainConfig, Any]) -> None:
+        assert self.checkpoint_dir is not None
+        start = time.perf_counter()
+        key = manager.checkpoint_key
+        target = self.checkpoint_dir / f"latest-{key}{getattr(manager.state, key):012}"
+        if not target.exists():
+            manager.checkpoint(str(target))
+        self._remove_old_checkpoints(self.checkpoint_dir)
+        with self._lock:
+            self._write_times.append(time.perf_counter() - start)
+
+    def _remove_old_checkpoints(self, checkpoint_dir: Path) -> None:
+        checkpoints = sorted(
+            (int(match.group(1)), path)
+            for path in checkpoint_dir.iterdir()
+            if (match := self._checkpoint_name.match(path.name)) is not None
+        )
+        for _, path in checkpoints[: -self.keep]:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _to_cpu(x: Any) -> Any:
+    # Copies all tensors of a (nested) state dict to CPU, leaving the original unchanged
+    if isinstance(x, torch.Tensor):
+        return x.detach().to("cpu", copy=True)
+    elif isinstance(x, dict):
+        return {k: _to_cpu(v) for k, v in x.items()}
+    elif isinstance(x, list):
+        return [_to_cpu(v) for v in x]
+    elif isinstance(x, tuple):
+        return tuple(_to_cpu(v) for v in x)
+    return x
@@ -28,11 +28,17 @@ class RolloutConfig:
     :param steps: The number of steps to run in each environment per policy rollout.
     :param num_envs: The number of parallel game environments.
     :param processes: The number of processes to use to collect env data. The envs are split as equally as possible across the processes.
+    :param asynchronous: Collect the next rollout on a background thread with a snapshot of the policy while optimizing on the current rollout.
+    :param max_policy_lag: Maximum number of updates by which the policy used for asynchronous rollouts may lag behind the trained policy.
+    :param shared_memory_mb: If set, environment processes send observations through shared memory buffers of this many megabytes per process rather than pipes.
     """
 
     steps: int = 16
     num_envs: int = 128
     processes: int = 4
+    asynchronous: bool = False
+    max_policy_lag: int = 1
+    shared_memory_mb: Optional[float] = None
 
 
 @dataclass
@@ -81,6 +87,9 @@ class PPOConfig:
     :param vf_coef: Coefficient for value function loss term.
     :param target_kl: Stop optimization if the KL divergence between the old and new policy exceeds this threshold.
     :param anneal_entropy: Linearly anneal the entropy coefficient from its initial value to 0.
+    :param vtrace: Correct returns and advantages for the lag between the rollout and the trained policy with V-trace (useful with asynchronous rollouts).
+    :param vtrace_rho_clip: Truncation threshold for the V-trace importance weights of the temporal difference terms.
+    :param vtrace_c_clip: Truncation threshold for the V-trace trace-cutting coefficients.
     """
 
     gae: bool = True
@@ -93,6 +102,9 @@ class PPOConfig:
     vf_coef: float = 0.5
     target_kl: Optional[float] = None
     anneal_entropy: bool = True
+    vtrace: bool = False
+    vtrace_rho_clip: float = 1.0
+    vtrace_c_clip: float = 1.0
 
 
 @dataclass
@@ -103,19 +115,30 @@ class OptimizerConfig:
     :param bs: Batch size.
     :param micro_bs: Micro batch size size used for gradient accumulation. Using a lower micro batch
         size reduces memory usage and performance without affecting training dyanmics.
+    :param micro_bs_tokens: Form micro batches from frames with similar numbers of entities, limiting the
+        number of padded entities per micro batch to this value rather than the number of frames to ``micro_bs``.
     :param weight_decay: Adam weight decay.
     :param anneal_lr: Linearly anneal learning rate from initial learning rate to 0.
     :param update_epochs: Number of optimizer passes over each batch of rollout samples.
     :param max_grad_norm: Gradient norm clipping.
+    :param precision: Precision of forward passes, one of "fp32", "bf16", or "fp16". Reduced precisions use
+        autocast with fp32 weights, fp16 additionally scales the loss to prevent gradient underflow (requires cuda).
+    :param allreduce_bucket_mb: Size in megabytes of the buckets of gradients that are all-reduced asynchronously during
+        the backward pass when training with multiple processes.
+    :param allreduce_fp16: Communicate gradients in half precision when training with multiple processes.
     """
 
     lr: float = 0.001
     bs: int = 1024
     weight_decay: float = 0.0
     micro_bs: Optional[int] = None
+    micro_bs_tokens: Optional[int] = None
     anneal_lr: bool = True
     update_epochs: int = 3
     max_grad_norm: float = 2.0
+    precision: str = "fp32"
+    allreduce_bucket_mb: float = 1.0
+    allreduce_fp16: bool = False
 
 
 @dataclass
@@ -143,6 +166,8 @@ class TrainConfig(hyperstate.Versioned):
     :param capture_samples_subsample: Only persist every nth sample, chosen randomly (requires ``capture_samples``).
     :param data_dir: Directory to save output from training and logging.
     :param cuda_empty_cache: Empty the torch cuda cache after each optimizer step.
+    :param checkpoint_async: Write checkpoints on a background thread from a CPU copy of the training state.
+    :param checkpoint_keep: Number of most recent checkpoints to keep.
     """
 
     env: EnvConfig
@@ -168,6 +193,8 @@ class TrainConfig(hyperstate.Versioned):
     trial: Optional[int] = None
     data_dir: str = "."
     cuda_empty_cache: bool = False
+    checkpoint_async: bool = False
+    checkpoint_keep: int = 1
 
     @classmethod
     def version(clz) -> int:
@@ -0,0 +1,306 @@
+import hashlib
+import os
+import shutil
+from typing import Any, BinaryIO, Dict, List, Mapping, Optional, Set, Tuple, Type
+
+import msgpack
+import numpy as np
+import numpy.typing as npt
+import tqdm
+from entity_gym.env import ActionSpace, ObsSpace
+from entity_gym.env.vec_env import (
+    VecActionMask,
+    VecCategoricalActionMask,
+    VecSelectEntityActionMask,
+)
+from entity_gym.serialization.sample_recorder import Sample
+from ragged_buffer import RaggedBuffer, RaggedBufferBool, RaggedBufferI64
+
+from enn_trainer.trace_reader import MappedTrace, decode_header
+
+CACHE_VERSION = 1
+
+# Identifies an array of a split: (group, name, part), where part is "data" for the
+# flattened items of a ragged buffer and "offsets" for the index of the first item of
+# each frame. Categorical action masks only store their data and use the offsets of
+# their actors.
+_ArrayKey = Tuple[str, str, str]
+
+
+# Size of the chunks at the start and end of a dataset file that are part of its cache key
+_KEY_CHUNK_SIZE = 1 << 20
+
+
+def dataset_cache_path(cache_dir: str, dataset_path: str) -> str:
+    """
+    Returns the directory that caches the given dataset, keyed by the absolute path,
+    size, and modification time of the dataset file, and a hash of its first and last
+    megabyte. The rest of the file isn't read, so this is fast for large datasets.
+    """
+    stat = os.stat(dataset_path)
+    digest = hashlib.sha256(
+        f"{os.path.abspath(dataset_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+    )
+    with open(dataset_path, "rb") as f:
+        digest.update(f.read(_KEY_CHUNK_SIZE))
+        if stat.st_size > _KEY_CHUNK_SIZE:
+            f.seek(max(stat.st_size - _KEY_CHUNK_SIZE, _KEY_CHUNK_SIZE))
+            digest.update(f.read())
+    name = os.path.splitext(os.path.basename(dataset_path))[0]
+    return os.path.join(cache_dir, f"{name}-{digest.hexdigest()[:16]}")
+
+
+class CachedSplit:
+    """
+    Memory-mapped arrays of the samples of one split of a :class:`DatasetCache`.
+
+    :param frames: Number of frames in the split.
+    """
+
+    def __init__(self, directory: str, meta: Dict[str, Any]) -> None:
+        self.frames: int = meta["frames"]
+        self.arrays: Dict[_ArrayKey, npt.NDArray[Any]] = {}
+        for array in meta["arrays"]:
+            shape = tuple(array["shape"])
+            if np.prod(shape) == 0:
+                data: npt.NDArray[Any] = np.zeros(shape, dtype=array["dtype"])
+            else:
+                data = np.memmap(
+                    os.path.join(directory, array["file"]),
+                    dtype=array["dtype"],
+                    mode="r",
+                    shape=shape,
+                )
+            self.arrays[tuple(array["key"])] = data
+
+    def names(self, group: str) -> List[str]:
+        return sorted({name for g, name, _ in self.arrays.keys() if g == group})
+
+    def ragged(
+        self,
+        group: str,
+        rb_cls: Type[RaggedBuffer[Any]],
+        indices: npt.NDArray[np.int64],
+    ) -> Dict[str, Any]:
+        """
+        Gathers the given frames of all ragged buffers in a group.
+        """
+        return {
+            name: self._gather(group, name, rb_cls, indices)
+            for name in self.names(group)
+        }
+
+    def masks(self, indices: npt.NDArray[np.int64]) -> Dict[str, VecActionMask]:
+        masks: Dict[str, VecActionMask] = {}
+        for name in self.names("mask_actors"):
+            actors = self._gather("mask_actors", name, RaggedBufferI64, indices)
+            if ("mask_actees", name, "data") in self.arrays:
+                masks[name] = VecSelectEntityActionMask(
+                    actors,
+                    self._gather("mask_actees", name, RaggedBufferI64, indices),
+                )
+            elif ("mask", name, "data") in self.arrays:
+                masks[name] = VecCategoricalActionMask(
+                    actors,
+                    self._gather(
+                        "mask",
+                        name,
+                        RaggedBufferBool,
+                        indices,
+                        offsets=self.arrays[("mask_actors", name, "offsets")],
+                    ),
+                )
+            else:
+                masks[name] = VecCategoricalActionMask(actors, None)
+        return masks
+
+    def _gather(
+        self,
+        group: str,
+        name: str,
+        rb_cls: Type[RaggedBuffer[Any]],
+        indices: npt.NDArray[np.int64],
+        offsets: Optional[npt.NDArray[np.int64]] = None,
+    ) -> Any:
+        data = self.arrays[(group, name, "data")]
+        if offsets is None:
+            offsets = self.arrays[(group, name, "offsets")]
+        starts = offsets[indices]
+        lengths = offsets[indices + 1] - starts
+        # Index of every item of the selected frames
+        items = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(
+            lengths.sum()
+        )
+        return rb_cls.from_flattened(np.ascontiguousarray(data[items]), lengths)
+
+
+class DatasetCache:
+    """
+    Dataset of recorded samples that has been split into a training and test set and
+    converted into contiguous arrays that are memory-mapped on load.
+    Use :func:`build_dataset_cache` to create the cache.
+    """
+
+    def __init__(self, directory: str) -> None:
+        with open(os.path.join(directory, "meta.msgpack"), "rb") as f:
+            meta = msgpack.unpackb(f.read(), raw=False)
+        if meta["version"] != CACHE_VERSION:
+            raise ValueError(
+                f"Dataset cache {directory} has version {meta['version']}, expected {CACHE_VERSION}"
+            )
+        self.dataset_path: str = meta["dataset_path"]
+        self.action_space: Dict[str, ActionSpace]
+        self.obs_space: ObsSpace
+        self.action_space, self.obs_space, self.subsample = decode_header(
+            meta["header"]
+        )
+        self.train = CachedSplit(directory, meta["splits"]["train"])
+        self.test = CachedSplit(directory, meta["splits"]["test"])
+
+
+def build_dataset_cache(
+    dataset_path: str,
+    directory: str,
+    test_frac: float = 0.1,
+    progress_bar: bool = False,
+) -> None:
+    """
+    Converts a trace of recorded samples into a :class:`DatasetCache`.
+    Samples are read one at a time, so the trace does not have to fit into memory.
+    """
+    trace = MappedTrace(dataset_path, progress_bar=progress_bar)
+    train, test = trace.train_test_split(test_frac)
+    tmp_directory = f"{directory}.tmp{os.getpid()}"
+    os.makedirs(tmp_directory)
+    try:
+        splits = {}
+        for split, samples in [("train", train), ("test", test)]:
+            writer = _SplitWriter(tmp_directory, split)
+            for i in tqdm.tqdm(samples) if progress_bar else samples:
+                writer.push_sample(trace.sample(i))
+            splits[split] = writer.close()
+        meta = {
+            "version": CACHE_VERSION,
+            "dataset_path": os.path.abspath(dataset_path),
+            "header": bytes(trace.header),
+            "splits": splits,
+        }
+        with open(os.path.join(tmp_directory, "meta.msgpack"), "wb") as f:
+            f.write(msgpack.packb(meta, use_bin_type=True))
+        # Only complete caches become visible
+        try:
+            os.replace(tmp_directory, directory)
+        except OSError:
+            if not os.path.exists(directory):
+                raise
+            # The cache was built concurrently by another process
+            shutil.rmtree(tmp_directory)
+    except BaseException:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        raise
+    finally:
+        trace.close()
+
+
+class _SplitWriter:
+    def __init__(self, directory: str, split: str) -> None:
+        self.directory = directory
+        self.split = split
+        self.frames = 0
+        self.files: Dict[_ArrayKey, BinaryIO] = {}
+        self.arrays: Dict[_ArrayKey, Dict[str, Any]] = {}
+        # Number of items written to each ragged buffer
+        self.items: Dict[Tuple[str, str], int] = {}
+        # Ragged buffers written by the current sample
+        self.sample_buffers: Set[Tuple[str, str]] = set()
+        # Categorical action masks that have not been seen yet are filled in once the
+        # number of choices is known, tracks the number of actors without mask
+        self.missing_mask_items: Dict[str, int] = {}
+
+    def push_sample(self, sample: Sample) -> None:
+        self.sample_buffers.clear()
+        groups: List[Tuple[str, Mapping[str, RaggedBuffer[Any]]]] = [
+            ("entities", sample.obs.features),
+            ("visible", sample.obs.visible),
+            ("actions", sample.actions),
+            ("logprobs", sample.probs),
+            ("logits", sample.logits or {}),
+        ]
+        for group, buffers in groups:
+            for name, buffer in buffers.items():
+                self._write_ragged(group, name, buffer)
+        for name, mask in sample.obs.action_masks.items():
+            self._write_ragged("mask_actors", name, mask.actors)
+            if isinstance(mask, VecSelectEntityActionMask):
+                self._write_ragged("mask_actees", name, mask.actees)
+            elif mask.mask is not None and mask.mask.size0() > 0:
+                if ("mask", name, "data") not in self.files:
+                    missing = self.missing_mask_items.get(name, 0)
+                    self._write(
+                        ("mask", name, "data"),
+                        np.ones((missing, mask.mask.size2()), dtype=np.bool_),
+                    )
+                self._write(("mask", name, "data"), mask.mask.as_array())
+            elif ("mask", name, "data") in self.files:
+                width = self.arrays[("mask", name, "data")]["shape"][1]
+                self._write(
+                    ("mask", name, "data"),
+                    np.ones((mask.actors.items(), width), dtype=np.bool_),
+                )
+            else:
+                self.missing_mask_items[name] = (
+                    self.missing_mask_items.get(name, 0) + mask.actors.items()
+                )
+        # The offsets of all ragged buffers must have an entry for every frame
+        if self.sample_buffers != set(self.items.keys()):
+            names = sorted(
+                "/".join(key) for key in set(self.items.keys()) - self.sample_buffers
+            )
+            raise ValueError(
+                f"Can't cache sample without ragged buffers {', '.join(names)}, all samples must contain the same buffers"
+            )
+        self.frames += len(sample.episode)
+
+    def close(self) -> Dict[str, Any]:
+        for f in self.files.values():
+            f.close()
+        return {"frames": self.frames, "arrays": list(self.arrays.values())}
+
+    def _write_ragged(self, group: str, name: str, buffer: RaggedBuffer[Any]) -> None:
+        self.sample_buffers.add((group, name))
+        if (group, name) not in self.items:
+            if self.frames > 0:
+                raise ValueError(
+                    f"Can't cache ragged buffer {group}/{name} that is missing from previous samples"
+                )
+            self.items[(group, name)] = 0
+            self._write((group, name, "offsets"), np.zeros(1, dtype=np.int64))
+        lengths = buffer.size1()
+        self._write(
+            (group, name, "offsets"),
+            self.items[(group, name)] + np.cumsum(lengths, dtype=np.int64),
+        )
+        self._write((group, name, "data"), buffer.as_array())
+        self.items[(group, name)] += int(lengths.sum())
+
+    def _write(self, key: _ArrayKey, array: npt.NDArray[Any]) -> None:
+        if key not in self.files:
+            file = f"{self.split}-{len(self.files)}.bin"
+            self.files[key] = open(os.path.join(self.directory, file), "wb")
+            self.arrays[key] = {
+                "key": list(key),
+                "file": file,
+                "dtype": array.dtype.name,
+                "shape": [0] + list(array.shape[1:]),
+            }
+        meta = self.arrays[key]
+        if (
+            array.dtype.name != meta["dtype"]
+            or list(array.shape[1:]) != meta["shape"][1:]
+        ):
+            raise ValueError(
+                f"Can't cache {'/'.join(key)}: items of shape {list(array.shape[1:])} and dtype {array.dtype.name} "
+                f"don't match previous items of shape {meta['shape'][1:]} and dtype {meta['dtype']}"
+            )
+        self.files[key].write(np.ascontiguousarray(array).tobytes())
+        meta["shape"][0] += array.shape[0]
@@ -1,5 +1,4 @@
-import json
-from typing import Callable, List, Mapping, Optional, Tuple, Union
+from typing import Callable, Dict, List, Mapping, Optional, Tuple, Union
 
 import numpy as np
 import numpy.typing as npt
@@ -32,6 +31,7 @@ def run_eval(
     global_step: int,
     rank: int,
     parallelism: int,
+    metric_reducer: Optional["MetricReducer"] = None,
 ) -> None:
     # TODO: metrics are biased towards short episodes
     processes = cfg.processes or rollout.processes
@@ -83,6 +83,8 @@ def run_eval(
         agent=agents,
         device=device,
         tracer=tracer,
+        # Threads don't speed up CPU inference, which already uses all cores
+        concurrent_agents=device.type == "cuda",
     )
     _, _, metrics = eval_rollout.run(
         cfg.steps,
@@ -92,30 +94,9 @@ def run_eval(
     )
 
     if parallelism > 1:
-        serialized_metrics = json.dumps(
-            {
-                k: {
-                    "count": int(v.count),
-                    "sum": float(v.sum),
-                    "min": float(v.min),
-                    "max": float(v.max),
-                }
-                for k, v in metrics.items()
-            }
-        )
-        metrics_tensor = torch.tensor(
-            bytearray(serialized_metrics.encode("utf-8")), dtype=torch.uint8
-        )
-        metrics = {}
-        for metrics_tensor in allgather(metrics_tensor, rank, parallelism):
-            for k, v in json.loads(
-                metrics_tensor.numpy().tobytes().decode("utf-8")
-            ).items():
-                m = Metric(**v)
-                if k in metrics:
-                    metrics[k] += m
-                else:
-                    metrics[k] = m
+        if metric_reducer is None:
+            metric_reducer = MetricReducer()
+        metrics = metric_reducer.reduce(metrics)
     if writer is not None:
         if cfg.capture_videos:
             # save the videos
@@ -134,19 +115,68 @@ def run_eval(
     print(
         f"[eval] global_step={global_step} {'  '.join(f'{name}={value.mean}' for name, value in metrics.items())}"
     )
+    eval_rollout.close()
     envs.close()
 
 
-def allgather(tensor: torch.Tensor, rank: int, parallelism: int) -> List[torch.Tensor]:
-    sizes = [torch.zeros(1, dtype=torch.long) for _ in range(parallelism)]
-    dist.all_gather(sizes, torch.tensor([tensor.nelement()], dtype=torch.long))
-    alltensors = []
-    for src, size in enumerate(sizes):
-        if src == rank:
-            dist.broadcast(tensor, src)
-            alltensors.append(tensor)
-        else:
-            result = torch.zeros(int(size.item()), dtype=tensor.dtype)
-            dist.broadcast(result, src)
-            alltensors.append(result)
-    return alltensors
+class MetricReducer:
+    """
+    Aggregates metrics across all processes with a constant number of collectives.
+
+    The count, sum, min, and max of each metric are packed into float64 tensors with a
+    fixed layout that is reduced with one SUM, one MIN, and one MAX all-reduce. The set of
+    metric names is agreed on once and cached, and only renegotiated when some process
+    reports a metric that is not part of the cached layout.
+    """
+
+    def __init__(self) -> None:
+        self.names: List[str] = []
+        self._index: Dict[str, int] = {}
+
+    def reduce(self, metrics: Dict[str, Metric]) -> Dict[str, Metric]:
+        sums = self._sums(metrics)
+        dist.all_reduce(sums, op=dist.ReduceOp.SUM)
+        if sums[-1] > 0:
+            # Some process has metrics that are not part of the layout
+            all_names: List[Optional[List[str]]] = [None] * dist.get_world_size()
+            dist.all_gather_object(all_names, list(metrics.keys()))
+            self.names = sorted(
+                set(self.names).union(*[n for n in all_names if n is not None])
+            )
+            self._index = {name: i for i, name in enumerate(self.names)}
+            sums = self._sums(metrics)
+            dist.all_reduce(sums, op=dist.ReduceOp.SUM)
+        mins = torch.full((len(self.names),), float("inf"), dtype=torch.float64)
+        maxs = torch.full((len(self.names),), float("-inf"), dtype=torch.float64)
+        for name, metric in metrics.items():
+            mins[self._index[name]] = metric.min
+            maxs[self._index[name]] = metric.max
+        dist.all_reduce(mins, op=dist.ReduceOp.MIN)
+        dist.all_reduce(maxs, op=dist.ReduceOp.MAX)
+
+        counts, totals, present = sums[:-1].view(3, len(self.names)).tolist()
+        _mins, _maxs = mins.tolist(), maxs.tolist()
+        return {
+            name: Metric(
+                count=int(counts[i]), sum=totals[i], min=_mins[i], max=_maxs[i]
+            )
+            for i, name in enumerate(self.names)
+            if present[i] > 0
+        }
+
+    def _sums(self, metrics: Dict[str, Metric]) -> torch.Tensor:
+        """
+        Returns the counts, sums, and presence flags of all metrics in the layout,
+        followed by the number of metrics that are missing from the layout.
+        """
+        n = len(self.names)
+        sums = torch.zeros(3 * n + 1, dtype=torch.float64)
+        for name, metric in metrics.items():
+            i = self._index.get(name)
+            if i is None:
+                sums[-1] += 1
+            else:
+                sums[i] = metric.count
+                sums[n + i] = metric.sum
+                sums[2 * n + i] = 1
+        return sums
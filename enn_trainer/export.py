@@ -0,0 +1,420 @@
+"""
+Exports the policy of a checkpoint as an inference-only module.
+
+During training, RogueNet processes ragged batches of many observations, which incurs
+substantial Python overhead on every call. Agents that are queried with one observation
+at a time, e.g. by a game server, can instead use an :class:`InferenceNet`, which
+computes the same outputs for a single observation with dense tensor operations only.
+The network is traced with TorchScript (or exported to ONNX) for a fixed observation and
+action space, and :class:`CompiledRogueNetAgent` wraps a traced network with the same
+interface as :class:`~enn_trainer.agent.RogueNetAgent`.
+
+Usage: ``python -m enn_trainer.export --checkpoint <dir> --output policy.pt``
+"""
+import copy
+import inspect
+import math
+import warnings
+from typing import Any, Dict, List, Literal, Tuple, cast
+
+import click
+import entity_gym.runner
+import msgpack_numpy
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from entity_gym.env import (
+    Action,
+    ActionSpace,
+    CategoricalActionSpace,
+    GlobalCategoricalActionSpace,
+    Observation,
+    ObsSpace,
+    SelectEntityActionSpace,
+    VecCategoricalActionMask,
+    VecObs,
+    VecSelectEntityActionMask,
+)
+from entity_gym.env.env_list import action_index_to_actions
+from entity_gym.env.environment import ActionName
+from entity_gym.env.vec_env import batch_obs
+from entity_gym.serialization.msgpack_ragged import (
+    ragged_buffer_decode,
+    ragged_buffer_encode,
+)
+from ragged_buffer import RaggedBufferI64
+from rogue_net.rogue_net import RogueNet
+from rogue_net.transformer import Block, Pool, RaggedAttention
+
+from enn_trainer.load_checkpoint import load_checkpoint
+
+InferenceInputs = Tuple[
+    List[torch.Tensor], List[torch.Tensor], List[torch.Tensor], List[torch.Tensor]
+]
+
+_SPACES_FILE = "spaces.msgpack"
+
+
+class InferenceNet(nn.Module):
+    """
+    Computes the action distributions and auxiliary head values of a RogueNet for a
+    single observation. Holds a copy of the parameters of the network in evaluation mode,
+    so that input normalization statistics are frozen, and leaves the network unchanged.
+
+    The attention layers and action heads are reimplemented with the parameters of the
+    corresponding RogueNet modules, since the forward pass of RogueNet operates on ragged
+    batches. ``test_export.py`` checks that the modules of RogueNet match this layout.
+
+    All inputs are lists of tensors in a fixed order:
+
+    - ``features``: The features of each entity type in :attr:`feature_names`, of shape
+      ``(entities, features)``.
+    - ``visible``: Whether each entity of each entity type in :attr:`entity_names` is
+      visible to the policy, of shape ``(entities,)``.
+    - ``actors``: For each action in :attr:`action_names`, the indices of the entities
+      that perform the action, of shape ``(actors,)``. Entities are indexed in the order
+      of :attr:`entity_names`.
+    - ``masks``: For each action, either a boolean mask of shape ``(actors, choices)`` of
+      the valid choices of a categorical action, or the indices of the entities that can
+      be selected by a select-entity action, of shape ``(actees,)``.
+
+    Returns the log probabilities of all choices of each action, of shape
+    ``(actors, choices)`` or ``(actors, actees)``, and the values of all auxiliary heads.
+    Use :func:`inference_inputs` to convert a batch of one observation.
+    """
+
+    def __init__(self, net: RogueNet) -> None:
+        super().__init__()
+        if net.embedding.feature_transforms is not None:
+            raise ValueError("Exporting networks with translation is not supported")
+        if net.backbone.relpos_encoding is not None:
+            raise ValueError(
+                "Exporting networks with relative positional encoding is not supported"
+            )
+        if any(isinstance(block.attn, Pool) for block in net.backbone.blocks):
+            raise ValueError("Exporting networks with pooling is not supported")
+        if len(net.obs_filter) > 0:
+            raise ValueError(
+                "Exporting networks with an observation filter is not supported"
+            )
+        net = copy.deepcopy(net).eval()
+        self.obs_space = net.obs_space
+        self.action_space = net.action_space
+        self.entity_names = list(net.embedding.embeddings.keys())
+        self.feature_names = feature_names(net.obs_space, net.action_space)
+        self.action_names = list(net.action_heads.keys())
+        self.auxiliary_names = (
+            list(net.auxiliary_heads.keys()) if net.auxiliary_heads is not None else []
+        )
+        self.global_features = "__global__" in self.feature_names
+        self.global_entity = "__global__" in self.entity_names
+        self.embeddings = nn.ModuleList(net.embedding.embeddings.values())
+        self.blocks = nn.ModuleList(net.backbone.blocks)
+        self.action_heads = nn.ModuleList(net.action_heads.values())
+        self.auxiliary_heads = nn.ModuleList(
+            net.auxiliary_heads.values() if net.auxiliary_heads is not None else []
+        )
+        self.select_entity = [
+            isinstance(net.action_space[name], SelectEntityActionSpace)
+            for name in self.action_names
+        ]
+
+    def forward(
+        self,
+        features: List[torch.Tensor],
+        visible: List[torch.Tensor],
+        actors: List[torch.Tensor],
+        masks: List[torch.Tensor],
+    ) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        nentity = len(self.obs_space.entities)
+        entities = features[:nentity]
+        if self.global_features:
+            globals = features[nentity]
+            # Global features are appended to the features of every entity
+            entities = [
+                torch.cat([feats, globals.expand(feats.size(0), globals.size(1))], 1)
+                for feats in entities
+            ]
+            if self.global_entity:
+                entities.append(globals)
+
+        x = torch.cat(
+            [embedding(feats) for embedding, feats in zip(self.embeddings, entities)]
+        )
+        visibility = torch.cat(visible)
+        # Visible entities don't attend to invisible entities
+        attn_mask = visibility.unsqueeze(1) > visibility.unsqueeze(0)
+        for block in cast(List[Block], self.blocks):
+            attn = cast(RaggedAttention, block.attn)
+            x = x + self._attention(attn, block.ln1(x), attn_mask)
+            x = x + block.mlp(block.ln2(x))
+
+        logprobs = []
+        for head, select_entity, actor, mask in zip(
+            cast(List[Any], self.action_heads), self.select_entity, actors, masks
+        ):
+            if select_entity:
+                queries = head.query_proj(x[actor])
+                keys = head.key_proj(x[mask])
+                logits = (queries @ keys.t()) * (1.0 / math.sqrt(head.d_qk))
+            else:
+                logits = head.proj(x[actor]).masked_fill(~mask, -float("inf"))
+            logprobs.append(F.log_softmax(logits, dim=-1))
+
+        # Mean over all entities, which is zero for observations without entities
+        count = torch.ones_like(x[:, :1]).sum(0, keepdim=True).clamp(min=1)
+        pooled = x.sum(0, keepdim=True) / count
+        return logprobs, [head(pooled) for head in self.auxiliary_heads]
+
+    def _attention(
+        self, attn: RaggedAttention, x: torch.Tensor, attn_mask: torch.Tensor
+    ) -> torch.Tensor:
+        d_model = x.size(1)
+        d_head = d_model // attn.n_head
+        k = attn.key(x).view(-1, attn.n_head, d_head).transpose(0, 1)
+        q = attn.query(x).view(-1, attn.n_head, d_head).transpose(0, 1)
+        v = attn.value(x).view(-1, attn.n_head, d_head).transpose(0, 1)
+        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(d_head))
+        att = att.masked_fill(attn_mask.unsqueeze(0), -1e9)
+        y = F.softmax(att, dim=-1) @ v
+        return attn.proj(y.transpose(0, 1).reshape(-1, d_model))  # type: ignore
+
+
+def feature_names(
+    obs_space: ObsSpace, action_space: Dict[str, ActionSpace]
+) -> List[str]:
+    """
+    Returns the names of the entity types whose features are inputs to an
+    :class:`InferenceNet`, which includes ``"__global__"`` for the global features.
+    """
+    names = list(obs_space.entities.keys())
+    if len(obs_space.global_features) > 0 or any(
+        isinstance(space, GlobalCategoricalActionSpace)
+        for space in action_space.values()
+    ):
+        names.append("__global__")
+    return names
+
+
+def inference_inputs(
+    obs: VecObs,
+    obs_space: ObsSpace,
+    action_space: Dict[str, ActionSpace],
+) -> InferenceInputs:
+    """
+    Converts a batch that contains a single observation into the inputs of an
+    :class:`InferenceNet`.
+    """
+    names = feature_names(obs_space, action_space)
+    features = [torch.from_numpy(obs.features[name].as_array()) for name in names]
+    entity_names = list(obs_space.entities.keys())
+    if any(
+        isinstance(space, GlobalCategoricalActionSpace)
+        for space in action_space.values()
+    ):
+        entity_names.append("__global__")
+    visible = [
+        torch.from_numpy(obs.visible[name].as_array().reshape(-1))
+        if name in obs.visible
+        else torch.ones(features[names.index(name)].size(0), dtype=torch.bool)
+        for name in entity_names
+    ]
+    actors = []
+    masks = []
+    for name, space in action_space.items():
+        mask = obs.action_masks[name]
+        actor = torch.from_numpy(mask.actors.as_array().reshape(-1))
+        actors.append(actor)
+        if isinstance(mask, VecSelectEntityActionMask):
+            masks.append(torch.from_numpy(mask.actees.as_array().reshape(-1)))
+        else:
+            assert isinstance(mask, VecCategoricalActionMask)
+            nchoice = len(space.index_to_label)  # type: ignore
+            if mask.mask is not None and mask.mask.size0() > 0:
+                masks.append(
+                    torch.from_numpy(mask.mask.as_array().reshape(-1, nchoice))
+                )
+            else:
+                masks.append(torch.ones(actor.size(0), nchoice, dtype=torch.bool))
+    return features, visible, actors, masks
+
+
+def export_agent(
+    net: RogueNet,
+    path: str,
+    format: Literal["torchscript", "onnx"] = "torchscript",
+) -> None:
+    """
+    Exports the policy and auxiliary heads of a RogueNet for single-observation inference.
+
+    TorchScript exports also store the observation and action spaces and can be loaded
+    with :func:`load_exported_agent`. ONNX exports name their inputs ``features.<entity>``,
+    ``visible.<entity>``, ``actors.<action>`` and ``masks.<action>``, and their outputs
+    ``logprobs.<action>`` and ``<auxiliary head>``, see :class:`InferenceNet` for the layout.
+    ONNX exports require the ``onnx`` package.
+    """
+    module = InferenceNet(net).cpu()
+    example = _example_inputs(net.obs_space, net.action_space)
+    if format == "torchscript":
+        with warnings.catch_warnings():
+            # Branches on frozen normalization statistics are expected to be constant
+            warnings.simplefilter("ignore", category=torch.jit.TracerWarning)
+            traced = torch.jit.trace(module, example, check_trace=False)
+        spaces = msgpack_numpy.dumps(
+            {
+                "obs_space": net.obs_space,
+                "act_space": net.action_space,
+                "auxiliary_heads": module.auxiliary_names,
+            },
+            default=ragged_buffer_encode,
+        )
+        torch.jit.save(traced, path, _extra_files={_SPACES_FILE: spaces})
+    elif format == "onnx":
+        input_names = (
+            [f"features.{name}" for name in module.feature_names]
+            + [f"visible.{name}" for name in module.entity_names]
+            + [f"actors.{name}" for name in module.action_names]
+            + [f"masks.{name}" for name in module.action_names]
+        )
+        output_names = [
+            f"logprobs.{name}" for name in module.action_names
+        ] + module.auxiliary_names
+        dynamic_axes: Dict[str, Dict[int, str]] = {
+            name: {0: name.replace(".", "_")} for name in input_names
+        }
+        for name, select_entity in zip(module.action_names, module.select_entity):
+            dynamic_axes[f"logprobs.{name}"] = {0: f"actors_{name}"}
+            if select_entity:
+                dynamic_axes[f"logprobs.{name}"][1] = f"masks_{name}"
+        kwargs: Dict[str, Any] = {}
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+            kwargs["dynamo"] = False
+        torch.onnx.export(
+            module,
+            example,
+            path,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            **kwargs,
+        )
+    else:
+        raise ValueError(f"Unknown export format {format}")
+
+
+class CompiledRogueNetAgent(entity_gym.runner.Agent):
+    """
+    Exposes an entity_gym Agent interface for a traced :class:`InferenceNet`.
+    Produces the same action distributions as :class:`~enn_trainer.agent.RogueNetAgent`
+    at a fraction of the latency per call.
+
+    :param module: The traced network.
+    """
+
+    def __init__(
+        self,
+        module: torch.jit.ScriptModule,
+        obs_space: ObsSpace,
+        action_space: Dict[str, ActionSpace],
+        auxiliary_heads: List[str],
+    ) -> None:
+        self.module = module
+        self.obs_space = obs_space
+        self.action_space = action_space
+        self.auxiliary_heads = auxiliary_heads
+
+    def act(self, obs: Observation) -> Tuple[Dict[ActionName, Action], float]:
+        vec_obs = batch_obs([obs], self.obs_space, self.action_space)
+        inputs = inference_inputs(vec_obs, self.obs_space, self.action_space)
+        with torch.no_grad():
+            logprobs, auxiliary = self.module(*inputs)
+        act_indices = {}
+        probs = {}
+        for (name, space), logprob in zip(self.action_space.items(), logprobs):
+            prob = logprob.exp()
+            if prob.size(0) > 0:
+                action = torch.multinomial(prob, 1)
+            else:
+                action = torch.zeros((0, 1), dtype=torch.int64)
+            act_indices[name] = RaggedBufferI64.from_array(
+                action.numpy().reshape(1, -1, 1)
+            )
+            # Same layout as the logits of the select-entity heads of RogueNet
+            if isinstance(space, SelectEntityActionSpace):
+                prob = prob.unsqueeze(0)
+            probs[name] = prob.numpy()
+        actions = action_index_to_actions(
+            self.obs_space, self.action_space, act_indices, obs, probs=probs
+        )
+        return actions, float(auxiliary[self.auxiliary_heads.index("value")].item())
+
+
+def load_exported_agent(path: str) -> CompiledRogueNetAgent:
+    """
+    Loads an agent exported with :func:`export_agent` in the TorchScript format.
+    """
+    extra_files = {_SPACES_FILE: ""}
+    module = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+    spaces = msgpack_numpy.loads(
+        extra_files[_SPACES_FILE],
+        object_hook=ragged_buffer_decode,
+        strict_map_key=False,
+    )
+    return CompiledRogueNetAgent(
+        module, spaces["obs_space"], spaces["act_space"], spaces["auxiliary_heads"]
+    )
+
+
+def _example_inputs(
+    obs_space: ObsSpace, action_space: Dict[str, ActionSpace]
+) -> InferenceInputs:
+    # Two entities of each type, all of which can act and be selected
+    names = feature_names(obs_space, action_space)
+    features = []
+    for name in names:
+        if name == "__global__":
+            features.append(torch.zeros(1, len(obs_space.global_features)))
+        else:
+            features.append(torch.zeros(2, len(obs_space.entities[name].features)))
+    nentity = 2 * len(obs_space.entities)
+    visible = [torch.ones(2, dtype=torch.bool) for _ in obs_space.entities]
+    if any(
+        isinstance(space, GlobalCategoricalActionSpace)
+        for space in action_space.values()
+    ):
+        visible.append(torch.ones(1, dtype=torch.bool))
+    actors = []
+    masks = []
+    for space in action_space.values():
+        if isinstance(space, GlobalCategoricalActionSpace):
+            actors.append(torch.tensor([nentity]))
+            masks.append(torch.ones(1, len(space.index_to_label), dtype=torch.bool))
+        elif isinstance(space, CategoricalActionSpace):
+            actors.append(torch.arange(nentity))
+            masks.append(
+                torch.ones(nentity, len(space.index_to_label), dtype=torch.bool)
+            )
+        else:
+            actors.append(torch.arange(nentity))
+            masks.append(torch.arange(nentity))
+    return features, visible, actors, masks
+
+
+@click.command()
+@click.option("--checkpoint", type=click.Path(exists=True), required=True)
+@click.option("--output", type=click.Path(), required=True)
+@click.option(
+    "--format",
+    type=click.Choice(["torchscript", "onnx"]),
+    default="torchscript",
+    show_default=True,
+)
+def main(checkpoint: str, output: str, format: str) -> None:
+    """Exports the agent of a training checkpoint for single-observation inference."""
+    agent = load_checkpoint(checkpoint).state.agent
+    export_agent(agent, output, format)  # type: ignore
+    click.echo(f"Exported agent to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
 # adapted from https://github.com/vwxyzjn/cleanrl
-from typing import Tuple
+from typing import Optional, Tuple
 
+import numpy as np
 import torch
 from entity_gym.env import *
+from entity_gym.ragged_dict import RaggedActionDict, RaggedBatchDict
 from entity_gym.simple_trace import Tracer
 
 from enn_trainer.agent import PPOAgent
+from enn_trainer.ppo import ActorLayout
 
 from .config import *
 
@@ -17,7 +20,7 @@ def returns_and_advantages(
     rewards: torch.Tensor,
     dones: torch.Tensor,
     values: torch.Tensor,
-    gae: float,
+    gae: bool,
     gamma: float,
     gae_lambda: float,
     device: torch.device,
@@ -27,10 +30,72 @@ def returns_and_advantages(
     next_value = agent.get_auxiliary_head(
         next_obs.features, next_obs.visible, "value", tracer
     ).reshape(1, -1)
+    returns, advantages = compute_returns_and_advantages(
+        next_value.to(device),
+        next_done.to(device),
+        rewards,
+        dones,
+        values,
+        gae,
+        gamma,
+        gae_lambda,
+    )
+    # Need to detach here because bug in pytorch that otherwise causes spurious autograd errors and memory leaks when dedicated value function network is used.
+    # possibly same cause as this: https://github.com/pytorch/pytorch/issues/71495
+    return returns.detach(), advantages.detach()
+
+
+def compute_returns_and_advantages(
+    next_value: torch.Tensor,
+    next_done: torch.Tensor,
+    rewards: torch.Tensor,
+    dones: torch.Tensor,
+    values: torch.Tensor,
+    gae: bool,
+    gamma: float,
+    gae_lambda: float,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Computes returns and advantages for a ``[steps, num_envs]`` batch of rollout samples.
+
+    :param next_value: Value estimate for the observation following the last step, shape ``[1, num_envs]``.
+    :param next_done: Done flags for the observation following the last step, shape ``[num_envs]``.
+    """
+    # nextnonterminal[t] and nextvalues[t] refer to the observation at step t + 1
+    nextnonterminal = 1.0 - torch.cat([dones[1:], next_done.float().view(1, -1)])
+    if gae:
+        nextvalues = torch.cat([values[1:], next_value.view(1, -1)])
+        deltas = rewards + gamma * nextvalues * nextnonterminal - values
+        advantages = discounted_reverse_scan(
+            deltas, gamma * gae_lambda * nextnonterminal
+        )
+        returns = advantages + values
+    else:
+        returns = discounted_reverse_scan(
+            rewards, gamma * nextnonterminal, next_value.view(-1)
+        )
+        advantages = returns - values
+    return returns, advantages
+
+
+def _reference_returns_and_advantages(
+    next_value: torch.Tensor,
+    next_done: torch.Tensor,
+    rewards: torch.Tensor,
+    dones: torch.Tensor,
+    values: torch.Tensor,
+    gae: bool,
+    gamma: float,
+    gae_lambda: float,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Original per-timestep implementation of :func:`compute_returns_and_advantages`, used
+    as the reference by tests and benchmarks.
+    """
     num_steps = values.size(0)
     if gae:
-        advantages = torch.zeros_like(rewards).to(device)
-        lastgaelam = 0
+        advantages = torch.zeros_like(rewards)
+        lastgaelam = torch.zeros_like(rewards[0])
         for t in reversed(range(num_steps)):
             if t == num_steps - 1:
                 nextnonterminal = 1.0 - next_done.float()
@@ -44,7 +109,7 @@ def returns_and_advantages(
             )
         returns = advantages + values
     else:
-        returns = torch.zeros_like(rewards).to(device)
+        returns = torch.zeros_like(rewards)
         for t in reversed(range(num_steps)):
             if t == num_steps - 1:
                 nextnonterminal = 1.0 - next_done
@@ -54,6 +119,138 @@ def returns_and_advantages(
                 next_return = returns[t + 1]
             returns[t] = rewards[t] + gamma * nextnonterminal * next_return
         advantages = returns - values
-    # Need to detach here because bug in pytorch that otherwise causes spurious autograd errors and memory leaks when dedicated value function network is used.
-    # possibly same cause as this: https://github.com/pytorch/pytorch/issues/71495
+    return returns, advantages
+
+
+def vtrace_returns_and_advantages(
+    agent: PPOAgent,
+    next_obs: VecObs,
+    next_done: torch.Tensor,
+    rewards: torch.Tensor,
+    dones: torch.Tensor,
+    values: torch.Tensor,
+    log_rhos: torch.Tensor,
+    gamma: float,
+    rho_clip: float,
+    c_clip: float,
+    device: torch.device,
+    tracer: Tracer,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    next_value = agent.get_auxiliary_head(
+        next_obs.features, next_obs.visible, "value", tracer
+    ).reshape(1, -1)
+    returns, advantages = compute_vtrace(
+        next_value.to(device),
+        next_done.to(device),
+        rewards,
+        dones,
+        values,
+        log_rhos,
+        gamma,
+        rho_clip,
+        c_clip,
+    )
     return returns.detach(), advantages.detach()
+
+
+def compute_vtrace(
+    next_value: torch.Tensor,
+    next_done: torch.Tensor,
+    rewards: torch.Tensor,
+    dones: torch.Tensor,
+    values: torch.Tensor,
+    log_rhos: torch.Tensor,
+    gamma: float,
+    rho_clip: float,
+    c_clip: float,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Computes V-trace value targets and policy gradient advantages (https://arxiv.org/abs/1802.01561)
+    for samples collected with a behavior policy that differs from the trained policy.
+
+    :param log_rhos: Log importance weights ``log(pi(a|x) / mu(a|x))`` of each frame, shape ``[steps, num_envs]``.
+    """
+    rhos = log_rhos.exp()
+    clipped_rhos = rhos.clamp(max=rho_clip)
+    cs = rhos.clamp(max=c_clip)
+    nextnonterminal = 1.0 - torch.cat([dones[1:], next_done.float().view(1, -1)])
+    nextvalues = torch.cat([values[1:], next_value.view(1, -1)])
+    deltas = clipped_rhos * (rewards + gamma * nextvalues * nextnonterminal - values)
+    vs = values + discounted_reverse_scan(deltas, gamma * cs * nextnonterminal)
+    next_vs = torch.cat([vs[1:], next_value.view(1, -1)])
+    advantages = clipped_rhos * (rewards + gamma * next_vs * nextnonterminal - values)
+    return vs, advantages
+
+
+def importance_log_ratios(
+    agent: PPOAgent,
+    entities: RaggedBatchDict[np.float32],
+    visible: RaggedBatchDict[np.bool_],
+    action_masks: RaggedActionDict,
+    actions: RaggedBatchDict[np.int64],
+    actor_layout: ActorLayout,
+    frames: int,
+    microbatch_size: int,
+    device: torch.device,
+    tracer: Tracer,
+) -> torch.Tensor:
+    """
+    Computes the log importance weight of the trained policy relative to the behavior
+    policy for each frame, summed over all actions and actors of the frame.
+
+    The agent is evaluated with normalization statistics frozen (``agent.eval()``), so
+    that the rollout doesn't update them a second time, and its previous mode is restored
+    afterwards.
+    """
+    log_rhos = torch.zeros(frames, device=device)
+    was_training = agent.training
+    agent.eval()
+    try:
+        for start in range(0, frames, microbatch_size):
+            mb_inds = np.arange(start, min(start + microbatch_size, frames))
+            mb_inds_tensor = torch.tensor(mb_inds, device=device)
+            actors = actor_layout.microbatch(mb_inds, mb_inds_tensor)
+            _, newlogprob, _, _, _, _ = agent.get_action_and_auxiliary(
+                entities[mb_inds],
+                visible[mb_inds],
+                action_masks[mb_inds],
+                prev_actions=actions[mb_inds],
+                tracer=tracer,
+            )
+            for action_name, oldlogprob in actors.logprobs.items():
+                frame_index = actors.frame_index[action_name]
+                log_rhos.index_add_(
+                    0,
+                    mb_inds_tensor if frame_index is None else frame_index + start,
+                    newlogprob[action_name] - oldlogprob,
+                )
+    finally:
+        agent.train(was_training)
+    return log_rhos
+
+
+def discounted_reverse_scan(
+    x: torch.Tensor,
+    discount: torch.Tensor,
+    bootstrap: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """
+    Computes ``y[t] = x[t] + discount[t] * y[t + 1]`` along the first dimension, with
+    ``y[steps] = bootstrap`` (or 0 if not given).
+
+    Uses a Hillis-Steele scan that requires ``log2(steps)`` batched tensor ops rather than
+    one Python loop iteration (and several small kernel launches) per step. Results match
+    the sequential recurrence up to floating point reassociation.
+    """
+    num_steps = x.size(0)
+    y = x.clone()
+    c = discount.clone()
+    if bootstrap is not None:
+        y[-1] += c[-1] * bootstrap
+    # Invariant: y[t] = sum over x[t:t + offset] discounted back to t, c[t] = product of discount[t:t + offset]
+    offset = 1
+    while offset < num_steps:
+        y[:-offset] = y[:-offset] + c[:-offset] * y[offset:]
+        c[:-offset] = c[:-offset] * c[offset:]
+        offset *= 2
+    return y
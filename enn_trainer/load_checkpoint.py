@@ -1,8 +1,27 @@
+import copy
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, Tuple, TypeVar, Union
+
+import msgpack
+import numpy as np
+import torch
 from hyperstate import StateManager
 
 from .agent import RogueNetAgent
 from .config import TrainConfig
-from .train import State, init_train_state
+from .train import SerializableRogueNet, State, init_train_state
+
+T = TypeVar("T")
+
+# Maximum number of agents kept in memory by `load_rogue_net`
+AGENT_CACHE_SIZE = 16
+
+# Type markers and sizes of the length prefixes of msgpack bin values
+_MSGPACK_BIN = {0xC4: 1, 0xC5: 2, 0xC6: 4}
+
+_agent_cache: "OrderedDict[Tuple[str, int], SerializableRogueNet]" = OrderedDict()
 
 
 def load_checkpoint(path: str) -> StateManager[TrainConfig, State]:
@@ -20,6 +39,108 @@ def load_agent(path: str) -> RogueNetAgent:
     """
     Loads a training checkpoint from a given path and returns the agent.
     """
-    return RogueNetAgent(
-        StateManager(TrainConfig, State, init_train_state, init_path=path).state.agent
-    )
+    return RogueNetAgent(load_rogue_net(path))
+
+
+def load_rogue_net(
+    path: str, device: Union[str, torch.device] = "cpu"
+) -> SerializableRogueNet:
+    """
+    Loads only the policy network of a training checkpoint.
+
+    The parameters are memory-mapped from the checkpoint, without deserializing the
+    optimizer state. Loaded networks are cached by path and modification time of the
+    checkpoint, so loading the same checkpoint repeatedly, e.g. as an opponent in every
+    evaluation, doesn't read it from disk again. Every call returns a new copy of the
+    network that doesn't share any tensors with other calls.
+
+    :param path: Path to the checkpoint directory.
+    :param device: Device to load the network on.
+    """
+    blob = Path(path) / "state.agent.msgpack"
+    if not blob.exists():
+        # Checkpoints written by older versions of hyperstate
+        return StateManager(
+            TrainConfig,
+            State,
+            init_train_state,
+            init_path=path,
+            ignore_extra_fields=True,
+        ).state.agent.to(device)
+
+    key = (str(blob.resolve()), os.stat(blob).st_mtime_ns)
+    net = _agent_cache.get(key)
+    if net is None:
+        sm = StateManager(
+            TrainConfig,
+            State,
+            init_train_state,
+            init_path=path,
+            ignore_extra_fields=True,
+        )
+        # The state is loaded lazily, this doesn't deserialize the agent or optimizer
+        state = sm.state
+        net = SerializableRogueNet(
+            sm.config.net,
+            state.obs_space,
+            state.action_space,
+            regression_heads={"value": 1},
+        )
+        net.load_state_dict(mmap_state_dict(str(blob)))
+        _agent_cache[key] = net
+        if len(_agent_cache) > AGENT_CACHE_SIZE:
+            _agent_cache.popitem(last=False)
+    else:
+        _agent_cache.move_to_end(key)
+    return copy.deepcopy(net).to(device)
+
+
+def mmap_state_dict(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Memory-maps a state dict that was serialized by hyperstate.
+
+    Only the keys, dtypes and shapes of the tensors are parsed. Tensors are read from the
+    file on first access, and are copy-on-write: modifying them doesn't change the file.
+
+    :param path: Path to a msgpack blob of a state dict, e.g. ``state.agent.msgpack``.
+    """
+    data = np.memmap(path, dtype=np.uint8, mode="c")
+    buf = data.data
+    state_dict = {}
+    ntensor, pos = _unpack_at(buf, 0, lambda u: u.read_map_header())
+    for _ in range(ntensor):
+        name, pos = _unpack_at(buf, pos, lambda u: u.unpack())
+        nfield, pos = _unpack_at(buf, pos, lambda u: u.read_map_header())
+        fields: Dict[bytes, Any] = {}
+        for _ in range(nfield):
+            field, pos = _unpack_at(buf, pos, lambda u: u.unpack())
+            if buf[pos] in _MSGPACK_BIN:
+                # Record the location of binary data instead of copying it
+                size = _MSGPACK_BIN[buf[pos]]
+                length = int.from_bytes(buf[pos + 1 : pos + 1 + size], "big")
+                fields[field] = (pos + 1 + size, length)
+                pos += 1 + size + length
+            else:
+                fields[field], pos = _unpack_at(buf, pos, lambda u: u.unpack())
+        start, length = fields[b"data"]
+        array = (
+            data[start : start + length]
+            .view(np.dtype(fields[b"dtype"]))
+            .reshape(fields[b"shape"])
+        )
+        state_dict[name] = torch.from_numpy(array)
+    return state_dict
+
+
+def _unpack_at(buf: memoryview, pos: int, read: Callable[[Any], T]) -> Tuple[T, int]:
+    # Reads a small msgpack value at `pos` and returns it with the position after it
+    window = 256
+    while True:
+        unpacker = msgpack.Unpacker(strict_map_key=False)
+        unpacker.feed(buf[pos : pos + window])
+        try:
+            return read(unpacker), pos + unpacker.tell()
+        except msgpack.OutOfData:
+            if pos + window >= len(buf):
+                raise
+            window *= 16
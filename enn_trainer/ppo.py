@@ -1,5 +1,8 @@
-from typing import Mapping, Tuple
+from dataclasses import dataclass
+from typing import Dict, List, Mapping, Optional, Tuple
 
+import numpy as np
+import numpy.typing as npt
 import torch
 from entity_gym.env.environment import ActionName
 from entity_gym.simple_trace import Tracer
@@ -8,19 +11,228 @@ from ragged_buffer import RaggedBufferF32
 from enn_trainer.config import PPOConfig
 
 
+@dataclass
+class MicrobatchActors:
+    """
+    Actors of each action in a microbatch.
+
+    :param logprobs: Log probability of the sampled action of each actor under the rollout policy.
+    :param frame_index: Index of the frame within the microbatch of each actor, or ``None`` if every frame has exactly one actor.
+    """
+
+    logprobs: Dict[ActionName, torch.Tensor]
+    frame_index: Dict[ActionName, Optional[torch.Tensor]]
+
+
+@dataclass
+class ActorLayout:
+    """
+    Device-resident layout of the actors of each action in a rollout, computed once per
+    rollout so that microbatches can be sliced on the device rather than rebuilding and
+    uploading index arrays for every microbatch.
+
+    :param logprobs: Log probability of the sampled action of each actor under the rollout policy.
+    :param actor_counts: Number of actors in each frame.
+    :param actor_offsets: Index of the first actor of each frame.
+    :param one_actor_per_frame: Whether every frame has exactly one actor, in which case actors and frames coincide.
+    """
+
+    logprobs: Dict[ActionName, torch.Tensor]
+    actor_counts: Dict[ActionName, npt.NDArray[np.int64]]
+    device_actor_counts: Dict[ActionName, torch.Tensor]
+    actor_offsets: Dict[ActionName, torch.Tensor]
+    one_actor_per_frame: Dict[ActionName, bool]
+
+    @classmethod
+    def from_logprobs(
+        cls, logprobs: Mapping[ActionName, RaggedBufferF32], device: torch.device
+    ) -> "ActorLayout":
+        layout = cls({}, {}, {}, {}, {})
+        for action_name, _logprobs in logprobs.items():
+            counts = _logprobs.size1()
+            layout.logprobs[action_name] = torch.tensor(
+                _logprobs.as_array(), device=device
+            ).view(-1)
+            layout.actor_counts[action_name] = counts
+            layout.device_actor_counts[action_name] = torch.tensor(
+                counts, device=device
+            )
+            layout.actor_offsets[action_name] = torch.tensor(
+                np.cumsum(counts) - counts, device=device
+            )
+            layout.one_actor_per_frame[action_name] = bool(np.all(counts == 1))
+        return layout
+
+    def microbatch(
+        self, inds: npt.NDArray[np.int64], device_inds: torch.Tensor
+    ) -> MicrobatchActors:
+        """
+        Selects the actors of the frames with the given indices.
+
+        :param inds: Frame indices of the microbatch.
+        :param device_inds: The same indices as a tensor on the device.
+        """
+        actors = MicrobatchActors({}, {})
+        for action_name, logprobs in self.logprobs.items():
+            if self.one_actor_per_frame[action_name]:
+                actors.logprobs[action_name] = logprobs[device_inds]
+                actors.frame_index[action_name] = None
+                continue
+            total = int(self.actor_counts[action_name][inds].sum())
+            counts = self.device_actor_counts[action_name][device_inds]
+            frame_index = torch.repeat_interleave(
+                torch.arange(len(inds), device=device_inds.device),
+                counts,
+                output_size=total,
+            )
+            # Position of each actor within its frame
+            first_actor = torch.cumsum(counts, 0) - counts
+            actor_in_frame = (
+                torch.arange(total, device=device_inds.device)
+                - first_actor[frame_index]
+            )
+            actor_index = (
+                self.actor_offsets[action_name][device_inds][frame_index]
+                + actor_in_frame
+            )
+            actors.logprobs[action_name] = logprobs[actor_index]
+            actors.frame_index[action_name] = frame_index
+        return actors
+
+
+def frame_entity_counts(
+    entities: Mapping[str, RaggedBufferF32]
+) -> npt.NDArray[np.int64]:
+    """
+    Returns the total number of entities (the sequence length seen by the network) of each frame.
+    """
+    counts: Optional[npt.NDArray[np.int64]] = None
+    for buffer in entities.values():
+        counts = buffer.size1() if counts is None else counts + buffer.size1()
+    assert counts is not None, "no entities"
+    return counts
+
+
+def microbatches(
+    inds: npt.NDArray[np.int64],
+    microbatch_size: int,
+    entity_counts: npt.NDArray[np.int64],
+    token_budget: Optional[int] = None,
+) -> List[npt.NDArray[np.int64]]:
+    """
+    Splits the frame indices of a minibatch into microbatches.
+
+    Without a token budget, the indices are split into chunks of ``microbatch_size`` frames.
+    With a token budget, frames are sorted by entity count and greedily packed into
+    microbatches whose padded size (number of frames times the largest entity count) does
+    not exceed the budget, so that frames with similar sequence lengths are batched together.
+    Since the gradient is accumulated over the whole minibatch, this does not change the
+    result of the optimizer step.
+
+    :param inds: Frame indices of the minibatch.
+    :param microbatch_size: Number of frames per microbatch if no token budget is given.
+    :param entity_counts: Number of entities of each frame of the rollout.
+    :param token_budget: Maximum number of padded entities per microbatch.
+    """
+    if token_budget is None:
+        return [
+            inds[start : start + microbatch_size]
+            for start in range(0, len(inds), microbatch_size)
+        ]
+    inds = inds[np.argsort(entity_counts[inds], kind="stable")]
+    # Since frames are sorted, the last frame of a microbatch has the largest entity count
+    lengths = np.maximum(entity_counts[inds], 1)
+    result = []
+    start = 0
+    for end in range(1, len(inds) + 1):
+        if end - start > 1 and (end - start) * lengths[end - 1] > token_budget:
+            result.append(inds[start : end - 1])
+            start = end - 1
+    if start < len(inds):
+        result.append(inds[start:])
+    return result
+
+
+def padding_efficiency(
+    microbatches: List[npt.NDArray[np.int64]],
+    entity_counts: npt.NDArray[np.int64],
+) -> float:
+    """
+    Fraction of the padded ``[frames, max_entities]`` sequence slots of the given
+    microbatches that are occupied by entities.
+    """
+    entities = 0
+    padded = 0
+    for inds in microbatches:
+        counts = entity_counts[inds]
+        if len(counts) > 0:
+            entities += int(counts.sum())
+            padded += len(counts) * int(counts.max())
+    return entities / padded if padded > 0 else 1.0
+
+
+@dataclass
+class PPOStats:
+    """
+    Statistics of the policy update that are kept on the device and accumulated across
+    microbatches, so that they only need to be synchronized with the host when logged.
+
+    :param approx_kl: Sum of the approximate KL divergence of each microbatch.
+    :param clipfrac: Sum of the fraction of clipped ratios of each microbatch.
+    :param ratio_min: Minimum probability ratio.
+    :param ratio_max: Maximum probability ratio.
+    :param count: Number of accumulated microbatches.
+    """
+
+    approx_kl: torch.Tensor
+    clipfrac: torch.Tensor
+    ratio_min: torch.Tensor
+    ratio_max: torch.Tensor
+    count: int = 1
+
+    def __iadd__(self, other: "PPOStats") -> "PPOStats":
+        self.approx_kl = self.approx_kl + other.approx_kl
+        self.clipfrac = self.clipfrac + other.clipfrac
+        self.ratio_min = torch.minimum(self.ratio_min, other.ratio_min)
+        self.ratio_max = torch.maximum(self.ratio_max, other.ratio_max)
+        self.count += other.count
+        return self
+
+    @property
+    def mean_approx_kl(self) -> torch.Tensor:
+        return self.approx_kl / self.count
+
+    @property
+    def mean_clipfrac(self) -> torch.Tensor:
+        return self.clipfrac / self.count
+
+
+def normalize_advantages(cfg: PPOConfig, advantages: torch.Tensor) -> torch.Tensor:
+    """
+    Normalizes the advantages of a minibatch if ``cfg.norm_adv`` is set.
+
+    Advantages are normalized over the whole minibatch before it is split into
+    microbatches, so that the loss doesn't depend on how frames are assigned to
+    microbatches.
+    """
+    if cfg.norm_adv:
+        assert len(advantages) > 1, "Can't normalize advantages with minibatch size 1"
+        advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
+    return advantages
+
+
 def ppo_loss(
     cfg: PPOConfig,
     newlogprob: Mapping[ActionName, torch.Tensor],
-    oldlogprob: Mapping[ActionName, RaggedBufferF32],
+    actors: MicrobatchActors,
     advantages: torch.Tensor,
     device: torch.device,
     tracer: Tracer,
-) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+) -> Tuple[torch.Tensor, "PPOStats"]:
     with tracer.span("ratio"):
+        # Upcast outputs of reduced precision forward passes before computing the loss
         logratio = {
-            k: newlogprob[k]
-            - torch.tensor(oldlogprob[k].as_array(), device=device).squeeze(-1)
-            for k in newlogprob.keys()
+            k: newlogprob[k].float() - actors.logprobs[k] for k in newlogprob.keys()
         }
         ratio = {k: l.exp() for k, l in logratio.items()}
 
@@ -28,37 +240,36 @@ def ppo_loss(
         # calculate approx_kl http://joschu.net/blog/kl-approx.html
         # old_approx_kl = (-logratio).mean()
         # TODO: mean across everything rather than nested mean? or do summation over different actions?
-        approx_kl = torch.tensor(
+        approx_kl = torch.stack(
             [
                 ((_ratio - 1) - _logratio).mean()
                 for (_ratio, _logratio) in zip(ratio.values(), logratio.values())
             ]
         ).mean()
-        clipfrac = torch.tensor(
+        clipfrac = torch.stack(
             [
-                ((_ratio - 1.0).abs() > cfg.clip_coef).float().mean().item()
+                ((_ratio - 1.0).abs() > cfg.clip_coef).float().mean()
                 for _ratio in ratio.values()
             ]
         ).mean()
+        all_ratios = torch.cat([_ratio.flatten() for _ratio in ratio.values()])
+        if all_ratios.numel() > 0:
+            ratio_min, ratio_max = all_ratios.min(), all_ratios.max()
+        else:
+            ratio_min = torch.tensor(float("inf"), device=device)
+            ratio_max = torch.tensor(float("-inf"), device=device)
+        stats = PPOStats(approx_kl, clipfrac, ratio_min, ratio_max)
 
-    # TODO: not invariant to microbatch size, should be normalizing full batch or minibatch instead
-    if cfg.norm_adv:
-        assert len(advantages) > 1, "Can't normalize advantages with minibatch size 1"
-        advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
-
-    # TODO: we can elide the index op and get better performance when there is exactly one actor per action
     # TODO: we can reuse the mb_advantages across all actions that have the same number of actors
     # TODO: what's the correct way of combining loss from multiple actions/actors on the same timestep? should we split the advantages across actions/actors?
     with tracer.span("broadcast_advantages"):
         # Broadcast the advantage value from each timestep to all actors/actions on that timestep
-        bc_mb_advantages = {
-            action_name: advantages[
-                torch.tensor(
-                    _b_logprobs.indices(dim=0).as_array().flatten(), device=device
-                )
-            ]
-            for action_name, _b_logprobs in oldlogprob.items()
-        }
+        bc_mb_advantages = {}
+        for action_name in ratio.keys():
+            frame_index = actors.frame_index[action_name]
+            bc_mb_advantages[action_name] = (
+                advantages if frame_index is None else advantages[frame_index]
+            )
 
     # Policy loss
     with tracer.span("policy_loss"):
@@ -85,7 +296,7 @@ def ppo_loss(
         )
         pg_loss = torch.max(pg_loss1, pg_loss2).mean()
 
-    return pg_loss, clipfrac, approx_kl
+    return pg_loss, stats
 
 
 def value_loss(
@@ -96,7 +307,7 @@ def value_loss(
     tracer: Tracer,
 ) -> torch.Tensor:
     with tracer.span("value_loss"):
-        newvalue = newvalue.view(-1)
+        newvalue = newvalue.view(-1).float()
         if cfg.clip_vloss:
             v_loss_unclipped = (newvalue - returns) ** 2
             v_clipped = oldvalue + torch.clamp(
@@ -0,0 +1,44 @@
+from typing import ContextManager, Dict
+
+import torch
+
+PRECISIONS: Dict[str, torch.dtype] = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+
+def check_precision(precision: str, device: torch.device) -> None:
+    if precision not in PRECISIONS:
+        raise ValueError(
+            f"Unknown precision {precision!r}, must be one of {list(PRECISIONS)}"
+        )
+    if precision == "fp16" and device.type != "cuda":
+        raise ValueError("fp16 precision requires a cuda device, use bf16 instead")
+
+
+def autocast(precision: str, device: torch.device) -> ContextManager[None]:
+    """
+    Returns a context that runs forward passes with the given precision.
+    Matrix multiplications run in reduced precision while numerically sensitive ops
+    (softmax, log_softmax, reductions) are kept in fp32 by autocast.
+
+    :param precision: One of "fp32", "bf16", or "fp16".
+    """
+    return torch.autocast(
+        device_type=device.type,
+        dtype=PRECISIONS[precision],
+        enabled=precision != "fp32",
+    )
+
+
+def grad_scaler(precision: str) -> "torch.amp.GradScaler":
+    """
+    Returns a gradient scaler that prevents underflow of fp16 gradients.
+    All of its methods are no-ops for other precisions.
+    """
+    enabled = precision == "fp16"
+    if hasattr(torch, "amp") and hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler("cuda", enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
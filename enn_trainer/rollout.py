@@ -1,18 +1,279 @@
-from typing import Dict, List, Mapping, Optional, Tuple, Union
+import contextlib
+import copy
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import (
+    Any,
+    ContextManager,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+    cast,
+)
 
 import numpy as np
 import numpy.typing as npt
 import ragged_buffer
 import torch
+import torch.nn as nn
 from entity_gym.env import *
-from entity_gym.env.vec_env import Metric
+from entity_gym.env.vec_env import (
+    Metric,
+    VecCategoricalActionMask,
+    VecSelectEntityActionMask,
+)
 from entity_gym.ragged_dict import RaggedActionDict, RaggedBatchDict
 from entity_gym.serialization.sample_recorder import SampleRecordingVecEnv
 from entity_gym.simple_trace import Tracer
-from ragged_buffer import RaggedBufferBool, RaggedBufferF32, RaggedBufferI64
+from ragged_buffer import (
+    RaggedBuffer,
+    RaggedBufferBool,
+    RaggedBufferF32,
+    RaggedBufferI64,
+)
 from rogue_net.rogue_net import tensor_dict_to_ragged
 
 from enn_trainer.agent import PPOAgent
+from enn_trainer.ppo import ActorLayout, MicrobatchActors, frame_entity_counts
+from enn_trainer.precision import autocast
+
+ScalarType = TypeVar("ScalarType", bound=np.generic, covariant=True)
+
+
+_ITEMSIZE = {RaggedBufferF32: 4, RaggedBufferI64: 8, RaggedBufferBool: 1}
+
+
+def ragged_nbytes(buffer: RaggedBuffer[Any]) -> int:
+    """Number of bytes occupied by the items of a ragged buffer."""
+    return buffer.items() * buffer.size2() * _ITEMSIZE[type(buffer)]
+
+
+@dataclass
+class RaggedArena(RaggedBatchDict[ScalarType]):
+    """
+    Rollout storage that owns its ragged buffers and keeps their capacity across rollouts.
+
+    Clearing a ragged buffer retains its allocation, so after the first rollout every
+    step is written into already reserved storage. Buffers are copied on first insert
+    rather than aliasing the (transient) buffers of the observation.
+    """
+
+    peak_bytes: int = 0
+
+    def extend(self, batch: Mapping[str, RaggedBuffer[ScalarType]]) -> None:
+        for k, v in batch.items():
+            if k not in self.buffers:
+                self.buffers[k] = v.clone()
+            else:
+                self.buffers[k].extend(v)
+
+    def clear(self) -> None:
+        self.peak_bytes = self.reserved_bytes()
+        super().clear()
+
+    def used_bytes(self) -> int:
+        return sum(ragged_nbytes(b) for b in self.buffers.values())
+
+    def reserved_bytes(self) -> int:
+        return max(self.peak_bytes, self.used_bytes())
+
+
+@dataclass
+class ActionMaskArena(RaggedActionDict):
+    """
+    Same as :class:`RaggedArena` for action masks.
+    """
+
+    peak_bytes: int = 0
+
+    def extend(self, batch: Mapping[str, VecActionMask]) -> None:
+        for k, v in batch.items():
+            if k not in self.buffers:
+                if isinstance(v, VecCategoricalActionMask):
+                    self.buffers[k] = VecCategoricalActionMask(
+                        v.actors.clone(), v.mask.clone() if v.mask is not None else None
+                    )
+                else:
+                    self.buffers[k] = VecSelectEntityActionMask(
+                        v.actors.clone(), v.actees.clone()
+                    )
+            else:
+                self.buffers[k].extend(v)
+
+    def clear(self) -> None:
+        self.peak_bytes = self.reserved_bytes()
+        super().clear()
+
+    def used_bytes(self) -> int:
+        nbytes = 0
+        for mask in self.buffers.values():
+            if isinstance(mask, VecCategoricalActionMask):
+                nbytes += ragged_nbytes(mask.actors)
+                if mask.mask is not None:
+                    nbytes += ragged_nbytes(mask.mask)
+            else:
+                nbytes += ragged_nbytes(mask.actors) + ragged_nbytes(mask.actees)
+        return nbytes
+
+    def reserved_bytes(self) -> int:
+        return max(self.peak_bytes, self.used_bytes())
+
+
+def _merge_spans(tracer: Tracer, other: Tracer) -> None:
+    # Adds the spans recorded by another tracer as children of the active span of tracer
+    prefix = f"{tracer.stack}." if tracer.stack else ""
+    for name, duration in other.total_time.items():
+        tracer.total_time[prefix + name] += duration
+    other.total_time.clear()
+
+
+class MultiAgentForward:
+    """
+    Runs a different agent on each of several disjoint sets of environments, e.g. the
+    agent and its opponent during evaluation, and combines their outputs.
+
+    Which environments are processed by which agent, and the permutation that restores
+    the original order of environments, are computed once on construction.
+    With ``concurrent`` set, the forward passes of different agents run in parallel
+    threads, each on its own CUDA stream when running on a GPU.
+
+    :param agents: The indices of the environments controlled by each agent, and the agent.
+    :param num_envs: Total number of environments, each of which must be controlled by exactly one agent.
+    :param concurrent: Run the forward passes of different agents concurrently.
+    """
+
+    def __init__(
+        self,
+        agents: List[Tuple[npt.NDArray[np.int64], PPOAgent]],
+        num_envs: int,
+        device: torch.device,
+        concurrent: bool = False,
+    ) -> None:
+        self.agents = agents
+        self.device = device
+        allindices = np.concatenate([indices for indices, _ in agents])
+        if not np.array_equal(np.sort(allindices), np.arange(num_envs)):
+            raise ValueError(
+                f"Environment indices of agents must cover each of the {num_envs} environments exactly once"
+            )
+        # Position of each environment in the concatenated outputs of all agents
+        self.invindex = np.empty(num_envs, dtype=np.int64)
+        self.invindex[allindices] = np.arange(num_envs)
+
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._streams: Optional[List[torch.cuda.Stream]] = None
+        # Agents may update their input normalization, so an agent that controls several
+        # sets of environments is never run on multiple threads at once
+        distinct = len({id(agent) for _, agent in agents}) == len(agents)
+        if concurrent and len(agents) > 1 and distinct:
+            self._executor = ThreadPoolExecutor(max_workers=len(agents))
+            if device.type == "cuda":
+                self._streams = [torch.cuda.Stream(device) for _ in agents]
+        # Spans of concurrent forward passes are recorded separately since the tracer is not
+        # thread-safe, and are merged into the tracer of the caller once all threads complete
+        self._tracers = [Tracer(cuda=False) for _ in agents]
+
+    def forward(
+        self,
+        obs: VecObs,
+        tracer: Tracer,
+        precision: str = "fp32",
+        capture_logits: bool = False,
+    ) -> Tuple[
+        Dict[str, RaggedBufferI64],
+        Dict[str, RaggedBufferF32],
+        Optional[Dict[str, RaggedBufferF32]],
+    ]:
+        """
+        Samples actions for all environments. Returns the actions, their log probabilities,
+        and the logits of all choices if ``capture_logits`` is set.
+        """
+        if self._executor is None:
+            outputs = [
+                self._forward(i, obs, tracer, precision, capture_logits)
+                for i in range(len(self.agents))
+            ]
+        else:
+            if self._streams is not None:
+                for stream in self._streams:
+                    stream.wait_stream(torch.cuda.current_stream(self.device))
+            futures = [
+                self._executor.submit(
+                    self._forward, i, obs, self._tracers[i], precision, capture_logits
+                )
+                for i in range(len(self.agents))
+            ]
+            outputs = [future.result() for future in futures]
+            for agent_tracer in self._tracers:
+                _merge_spans(tracer, agent_tracer)
+        actions = self._scatter([action for action, _, _ in outputs])
+        logprobs = self._scatter([logprob for _, logprob, _ in outputs])
+        logits = None
+        if capture_logits:
+            logits = self._scatter([cast(Dict[str, Any], l) for _, _, l in outputs])
+        return actions, logprobs, logits
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def _forward(
+        self,
+        i: int,
+        obs: VecObs,
+        tracer: Tracer,
+        precision: str,
+        capture_logits: bool,
+    ) -> Tuple[
+        Dict[str, RaggedBufferI64],
+        Dict[str, RaggedBufferF32],
+        Optional[Dict[str, RaggedBufferF32]],
+    ]:
+        env_indices, agent = self.agents[i]
+        stream: ContextManager[Any] = (
+            torch.cuda.stream(self._streams[i])
+            if self._streams is not None
+            else contextlib.nullcontext()
+        )
+        # Gradient and autocast modes are thread-local and have to be set on every thread
+        with torch.no_grad(), autocast(precision, self.device), stream:
+            (
+                action,
+                probs_tensor,
+                _,
+                actor_counts,
+                _,
+                logits,
+            ) = agent.get_action_and_auxiliary(
+                {name: feats[env_indices] for name, feats in obs.features.items()},
+                {name: visible[env_indices] for name, visible in obs.visible.items()},
+                {name: mask[env_indices] for name, mask in obs.action_masks.items()},
+                tracer,
+            )
+            logprob = tensor_dict_to_ragged(
+                RaggedBufferF32,
+                {k: v.float() for k, v in probs_tensor.items()},
+                actor_counts,
+            )
+            ragged_logits = None
+            if capture_logits:
+                ragged_logits = tensor_dict_to_ragged(
+                    RaggedBufferF32,
+                    {k: v.squeeze(1).float() for k, v in logits.items()},
+                    actor_counts,
+                )
+        return action, logprob, ragged_logits
+
+    def _scatter(self, outputs: List[Dict[str, Any]]) -> Dict[str, Any]:
+        # Concatenates the outputs of all agents and restores the order of environments
+        return {
+            name: ragged_buffer.cat([output[name] for output in outputs])[self.invindex]
+            for name in outputs[0].keys()
+        }
 
 
 class Rollout:
@@ -25,6 +286,8 @@ class Rollout:
         device: torch.device,
         tracer: Tracer,
         value_function: Optional[PPOAgent] = None,
+        precision: str = "fp32",
+        concurrent_agents: bool = False,
     ) -> None:
         self.envs = envs
         self.obs_space = obs_space
@@ -33,6 +296,12 @@ class Rollout:
         self.agent = agent
         self.value_function = value_function
         self.tracer = tracer
+        self.precision = precision
+        self.multi_agent: Optional[MultiAgentForward] = None
+        if isinstance(agent, list):
+            self.multi_agent = MultiAgentForward(
+                agent, len(envs), device, concurrent=concurrent_agents
+            )
 
         self.global_step = 0
         self.next_obs: Optional[VecObs] = None
@@ -40,15 +309,39 @@ class Rollout:
         self.rewards = torch.zeros(0)
         self.dones = torch.zeros(0)
         self.values = torch.zeros(0)
-        self.entities: RaggedBatchDict[np.float32] = RaggedBatchDict(RaggedBufferF32)
-        self.visible: RaggedBatchDict[np.bool_] = RaggedBatchDict(RaggedBufferBool)
-        self.action_masks = RaggedActionDict()
-        self.actions = RaggedBatchDict(RaggedBufferI64)
-        self.logprobs = RaggedBatchDict(RaggedBufferF32)
+        # Host staging buffers for rewards and dones, pinned when the device is a GPU
+        self.host_rewards = self.rewards
+        self.host_dones = self.dones
+        self._upload_event: Optional[torch.cuda.Event] = None
+        self.entities: RaggedArena[np.float32] = RaggedArena(RaggedBufferF32)
+        self.visible: RaggedArena[np.bool_] = RaggedArena(RaggedBufferBool)
+        self.action_masks = ActionMaskArena()
+        self.actions: RaggedArena[np.int64] = RaggedArena(RaggedBufferI64)
+        self.logprobs: RaggedArena[np.float32] = RaggedArena(RaggedBufferF32)
 
         self.rendered_frames: List[npt.NDArray[np.uint8]] = []
         self.rendered: Optional[npt.NDArray[np.uint8]] = None
 
+    def storage_bytes(self) -> Tuple[int, int]:
+        """
+        Returns the number of bytes used by the samples of the last rollout and the number
+        of bytes reserved by the rollout storage.
+        """
+        arenas: List[Union[RaggedArena[Any], ActionMaskArena]] = [
+            self.entities,
+            self.visible,
+            self.action_masks,
+            self.actions,
+            self.logprobs,
+        ]
+        used = sum(arena.used_bytes() for arena in arenas)
+        reserved = sum(arena.reserved_bytes() for arena in arenas)
+        return used, reserved
+
+    def close(self) -> None:
+        if self.multi_agent is not None:
+            self.multi_agent.close()
+
     def run(
         self,
         steps: int,
@@ -64,20 +357,26 @@ class Rollout:
                 self.rewards = torch.zeros((steps, len(self.envs)), device=self.device)
                 self.dones = torch.zeros((steps, len(self.envs)), device=self.device)
                 self.values = torch.zeros((steps, len(self.envs)), device=self.device)
+                if self.device.type == "cuda":
+                    self.host_rewards = torch.zeros(
+                        (steps, len(self.envs)), pin_memory=True
+                    )
+                    self.host_dones = torch.zeros(
+                        (steps, len(self.envs)), pin_memory=True
+                    )
+                else:
+                    self.host_rewards = self.rewards
+                    self.host_dones = self.dones
+            if self._upload_event is not None:
+                # Staging buffers must not be overwritten before the last upload has completed
+                self._upload_event.synchronize()
+                self._upload_event = None
             self.entities.clear()
             self.visible.clear()
             self.action_masks.clear()
             self.actions.clear()
             self.logprobs.clear()
-        if isinstance(self.agent, list):
-            allindices = np.concatenate([indices for indices, _ in self.agent])
-            invindex = np.zeros_like(allindices, dtype=np.int64)
-            for i, index in enumerate(allindices):
-                invindex[index] = i
-        else:
-            invindex = np.array([], dtype=np.int64)
-
-        metrics: Dict[str, Metric] = {}
+        step_metrics: List[Dict[str, Metric]] = []
 
         if self.next_obs is None or self.next_done is None:
             next_obs = self.envs.reset(self.obs_space)
@@ -85,6 +384,8 @@ class Rollout:
         else:
             next_obs = self.next_obs
             next_done = self.next_done
+        if record_samples:
+            self.dones[0] = next_done
 
         if capture_videos:
             self.rendered_frames.append(self.envs.render(mode="rgb_array"))
@@ -97,34 +398,17 @@ class Rollout:
                 self.entities.extend(next_obs.features)
                 self.visible.extend(next_obs.visible)
                 self.action_masks.extend(next_obs.action_masks)
-                self.dones[step] = next_done
-
-            with torch.no_grad(), self.tracer.span("forward"):
-                if isinstance(self.agent, list):
-                    actions = []
-                    for env_indices, agent in self.agent:
-                        a = agent.get_action_and_auxiliary(
-                            {
-                                name: feats[env_indices]
-                                for name, feats in next_obs.features.items()
-                            },
-                            {
-                                name: visible[env_indices]
-                                for name, visible in next_obs.visible.items()
-                            },
-                            {
-                                name: mask[env_indices]
-                                for name, mask in next_obs.action_masks.items()
-                            },
-                            self.tracer,
-                        )[0]
-                        actions.append((env_indices, a))
-                    action = {}
-                    for name in self.action_space.keys():
-                        action[name] = ragged_buffer.cat([a[1][name] for a in actions])[
-                            invindex
-                        ]
+
+            ragged_logits: Optional[Dict[str, RaggedBufferF32]] = None
+            with torch.no_grad(), self.tracer.span("forward"), autocast(
+                self.precision, self.device
+            ):
+                if self.multi_agent is not None:
+                    action, logprob, ragged_logits = self.multi_agent.forward(
+                        next_obs, self.tracer, self.precision, capture_logits
+                    )
                 else:
+                    assert not isinstance(self.agent, list)
                     (
                         action,
                         probs_tensor,
@@ -139,16 +423,22 @@ class Rollout:
                         tracer=self.tracer,
                     )
                     logprob = tensor_dict_to_ragged(
-                        RaggedBufferF32, probs_tensor, actor_counts
+                        RaggedBufferF32,
+                        {k: v.float() for k, v in probs_tensor.items()},
+                        actor_counts,
                     )
             if record_samples:
                 if self.value_function is None:
                     value = aux["value"]
                 else:
                     # TODO: can ignore `visible` here, allow for full attention across all entities
-                    value = self.value_function.get_auxiliary_head(
-                        next_obs.features, next_obs.visible, "value", tracer=self.tracer
-                    )
+                    with torch.no_grad(), autocast(self.precision, self.device):
+                        value = self.value_function.get_auxiliary_head(
+                            next_obs.features,
+                            next_obs.visible,
+                            "value",
+                            tracer=self.tracer,
+                        )
 
                 # Need to detach here because bug in pytorch that otherwise causes spurious autograd errors and memory leaks when dedicated value function network is used.
                 # possibly same cause as this: https://github.com/pytorch/pytorch/issues/71495
@@ -161,16 +451,12 @@ class Rollout:
 
             with self.tracer.span("step"):
                 if isinstance(self.envs, SampleRecordingVecEnv):
-                    if capture_logits:
-                        ragged_logits: Optional[
-                            Dict[str, RaggedBufferF32]
-                        ] = tensor_dict_to_ragged(
+                    if capture_logits and self.multi_agent is None:
+                        ragged_logits = tensor_dict_to_ragged(
                             RaggedBufferF32,
-                            {k: v.squeeze(1) for k, v in logits.items()},
+                            {k: v.squeeze(1).float() for k, v in logits.items()},
                             actor_counts,
                         )
-                    else:
-                        ragged_logits = None
                     next_obs = self.envs.act(
                         action, self.obs_space, logprob, ragged_logits
                     )
@@ -178,13 +464,27 @@ class Rollout:
                     next_obs = self.envs.act(action, self.obs_space)
 
             if record_samples:
-                with self.tracer.span("reward_done_to_device"):
-                    self.rewards[step] = (
-                        torch.tensor(next_obs.reward).to(self.device).view(-1)
-                    )
-                    next_done = torch.tensor(next_obs.done).to(self.device).view(-1)
+                with self.tracer.span("reward_done_to_host"):
+                    self.host_rewards[step] = torch.from_numpy(next_obs.reward)
+                    if step + 1 < steps:
+                        self.host_dones[step + 1] = torch.from_numpy(next_obs.done)
 
-            for mname, mvalue in next_obs.metrics.items():
+            step_metrics.append(next_obs.metrics)
+
+        if record_samples:
+            with self.tracer.span("reward_done_to_device"):
+                if self.host_rewards is not self.rewards:
+                    self.rewards.copy_(self.host_rewards, non_blocking=True)
+                    self.dones[1:].copy_(self.host_dones[1:], non_blocking=True)
+                    self._upload_event = torch.cuda.Event()
+                    self._upload_event.record()
+                next_done = torch.tensor(next_obs.done, dtype=torch.float32).to(
+                    self.device
+                )
+
+        metrics: Dict[str, Metric] = {}
+        for _metrics in step_metrics:
+            for mname, mvalue in _metrics.items():
                 if mname in metrics:
                     metrics[mname] += mvalue
                 else:
@@ -197,3 +497,201 @@ class Rollout:
             self.rendered = np.stack(self.rendered_frames)
 
         return next_obs, next_done, metrics
+
+
+@dataclass
+class Minibatch:
+    """
+    Frames selected from a :class:`RolloutBatch`.
+
+    :param entities: Entity features of each frame, gathered on the host as input to the network.
+    :param actors: Actors of each action and their log probabilities under the rollout policy.
+    :param advantages: Advantage of each frame.
+    :param returns: Return of each frame.
+    :param values: Value estimate of each frame under the rollout policy.
+    """
+
+    entities: Dict[str, RaggedBufferF32]
+    visible: Dict[str, RaggedBufferBool]
+    action_masks: Dict[str, VecActionMask]
+    actions: Dict[str, RaggedBufferI64]
+    actors: MicrobatchActors
+    advantages: torch.Tensor
+    returns: torch.Tensor
+    values: torch.Tensor
+
+
+class RolloutBatch:
+    """
+    The samples of a rollout flattened into a batch of frames.
+
+    All per-frame tensors (advantages, returns, values, and the log probabilities of all
+    actors) are uploaded to the device once per rollout, so selecting the frames of a
+    minibatch only requires device index ops. The entities, masks, and actions that are
+    passed to the network remain ragged host buffers since the network consumes those.
+    """
+
+    def __init__(
+        self,
+        rollout: Rollout,
+        actor_layout: ActorLayout,
+        advantages: torch.Tensor,
+        returns: torch.Tensor,
+    ) -> None:
+        self.entities = rollout.entities
+        self.visible = rollout.visible
+        self.action_masks = rollout.action_masks
+        self.actions = rollout.actions
+        self.actor_layout = actor_layout
+        self.advantages = advantages.reshape(-1)
+        self.returns = returns.reshape(-1).detach()
+        self.values = rollout.values.reshape(-1).detach()
+        self.frames = self.values.size(0)
+        self.entity_counts = frame_entity_counts(rollout.entities.buffers)
+
+    def upload_indices(self, inds: npt.NDArray[np.int64]) -> torch.Tensor:
+        return torch.tensor(inds, device=self.values.device)
+
+    def gather(
+        self, inds: npt.NDArray[np.int64], device_inds: torch.Tensor
+    ) -> Minibatch:
+        """
+        Selects the frames with the given indices.
+
+        :param inds: Frame indices.
+        :param device_inds: The same indices as a tensor on the device, which may be a
+            slice of a larger index tensor uploaded with :meth:`upload_indices`.
+        """
+        return Minibatch(
+            entities=self.entities[inds],
+            visible=self.visible[inds],
+            action_masks=self.action_masks[inds],
+            actions=self.actions[inds],
+            actors=self.actor_layout.microbatch(inds, device_inds),
+            advantages=self.advantages[device_inds],
+            returns=self.returns[device_inds],
+            values=self.values[device_inds],
+        )
+
+
+class AsyncRollout:
+    """
+    Double-buffered rollouts that are collected on a background thread.
+
+    While the learner optimizes on the samples of one rollout, the next rollout is
+    collected into a second buffer using a frozen snapshot of the policy (and value
+    function). The snapshot is synchronized with the learner before starting a rollout
+    whose samples would otherwise be more than ``max_policy_lag`` updates behind the
+    policy they are optimized with.
+
+    :param max_policy_lag: Maximum number of optimizer updates by which the policy that
+        collected a batch may lag behind the policy that is trained on it. Must be at least 1.
+    """
+
+    def __init__(
+        self,
+        envs: VecEnv,
+        obs_space: ObsSpace,
+        action_space: Mapping[str, ActionSpace],
+        agent: PPOAgent,
+        device: torch.device,
+        cuda: bool,
+        value_function: Optional[PPOAgent] = None,
+        max_policy_lag: int = 1,
+        precision: str = "fp32",
+    ) -> None:
+        assert (
+            max_policy_lag >= 1
+        ), f"Asynchronous rollouts require max_policy_lag >= 1, got {max_policy_lag}"
+        self.agent = agent
+        self.value_function = value_function
+        self.max_policy_lag = max_policy_lag
+        # Spans of the background thread are recorded separately since the tracer is not thread-safe
+        self.tracer = Tracer(cuda=cuda)
+        self.traces: Dict[str, float] = {}
+
+        self.agent_snapshot = _frozen_copy(agent)
+        self.value_function_snapshot = (
+            _frozen_copy(value_function) if value_function is not None else None
+        )
+        self.buffers = [
+            Rollout(
+                envs,
+                obs_space=obs_space,
+                action_space=action_space,
+                agent=self.agent_snapshot,
+                value_function=self.value_function_snapshot,
+                device=device,
+                tracer=self.tracer,
+                precision=precision,
+            )
+            for _ in range(2)
+        ]
+        # The most recently completed rollout, which is being consumed by the learner
+        self.current = self.buffers[0]
+        # Number of batches handed to the learner whose updates are not reflected in the snapshot
+        self.snapshot_lag = 0
+        self.policy_lag = 0
+        self._pending_lag = 0
+        self._back = self.buffers[1]
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending: Optional[
+            Future[Tuple[VecObs, torch.Tensor, Dict[str, Metric]]]
+        ] = None
+
+    def start(self, steps: int, capture_logits: bool = False) -> None:
+        """
+        Starts collecting the next rollout on the background thread.
+        """
+        assert self._pending is None, "Rollout already in progress"
+        if self.snapshot_lag > self.max_policy_lag:
+            self._sync_snapshot()
+        self._pending_lag = self.snapshot_lag
+
+        back = self.buffers[1] if self.current is self.buffers[0] else self.buffers[0]
+        back.next_obs = self.current.next_obs
+        back.next_done = self.current.next_done
+        back.global_step = self.current.global_step
+        self._pending = self._executor.submit(
+            back.run, steps, record_samples=True, capture_logits=capture_logits
+        )
+        self._back = back
+
+    def wait(self) -> Tuple[Rollout, VecObs, torch.Tensor, Dict[str, Metric]]:
+        """
+        Waits for the rollout started by the last call to :meth:`start` and returns the
+        completed rollout buffer together with next_obs, next_done, and statistics.
+        """
+        assert self._pending is not None, "No rollout in progress"
+        next_obs, next_done, metrics = self._pending.result()
+        self._pending = None
+        self.current = self._back
+        self.policy_lag = self._pending_lag
+        self.snapshot_lag += 1
+        self.traces = self.tracer.finish()
+        return self.current, next_obs, next_done, metrics
+
+    def close(self) -> None:
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+        self._executor.shutdown()
+
+    def _sync_snapshot(self) -> None:
+        _copy_state(self.agent, self.agent_snapshot)
+        if self.value_function is not None:
+            assert self.value_function_snapshot is not None
+            _copy_state(self.value_function, self.value_function_snapshot)
+        # The learner is about to be updated on the batch that was just handed to it
+        self.snapshot_lag = min(self.snapshot_lag, 1)
+
+
+def _frozen_copy(agent: PPOAgent) -> PPOAgent:
+    snapshot = copy.deepcopy(agent)
+    for param in snapshot.parameters():
+        param.requires_grad_(False)
+    return snapshot
+
+
+def _copy_state(src: PPOAgent, dst: PPOAgent) -> None:
+    cast(nn.Module, dst).load_state_dict(cast(nn.Module, src).state_dict())
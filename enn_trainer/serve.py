@@ -0,0 +1,228 @@
+"""
+Serves a RogueNet agent to many concurrent callers, e.g. game sessions that each
+request one action at a time.
+
+Instead of running a forward pass with a single observation for every call, as
+:class:`~enn_trainer.agent.RogueNetAgent` does, :class:`BatchingAgent` queues requests
+from any number of threads or asyncio tasks and runs one forward pass for all requests
+that arrive within a small latency budget.
+"""
+import asyncio
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import entity_gym.runner
+import numpy as np
+import torch
+from entity_gym.env import Action, Observation, SelectEntityActionSpace
+from entity_gym.env.env_list import action_index_to_actions
+from entity_gym.env.environment import ActionName
+from entity_gym.env.vec_env import batch_obs
+from entity_gym.simple_trace import Tracer
+from rogue_net.rogue_net import RogueNet
+
+from enn_trainer.load_checkpoint import load_agent
+
+ActResult = Tuple[Dict[ActionName, Action], float]
+
+
+@dataclass
+class ServingStats:
+    """
+    Latency and batching statistics of a :class:`BatchingAgent`.
+
+    :param requests: Number of requests served.
+    :param latency_p50_ms: Median time from submitting a request to its result, in milliseconds.
+    :param latency_p99_ms: 99th percentile of the request latency, in milliseconds.
+    :param batch_sizes: Number of forward passes for each number of batched requests.
+    """
+
+    requests: int
+    latency_p50_ms: float
+    latency_p99_ms: float
+    batch_sizes: Dict[int, int]
+
+
+@dataclass
+class _Request:
+    obs: Observation
+    future: "Future[ActResult]"
+    submitted: float
+
+
+class BatchingAgent(entity_gym.runner.Agent):
+    """
+    Thread-safe entity_gym Agent that coalesces concurrent requests into batches.
+
+    A background thread waits for the first pending request, then collects further
+    requests until ``max_batch_size`` requests are pending or ``max_delay_ms`` have
+    passed since the first request arrived, and runs a single forward pass for all of them.
+
+    :param agent: The underlying RogueNet, which is put in evaluation mode.
+    :param max_batch_size: Maximum number of observations per forward pass.
+    :param max_delay_ms: Maximum time the first request of a batch waits for other requests.
+    :param latency_window: Number of most recent requests used to compute latency percentiles.
+    """
+
+    def __init__(
+        self,
+        agent: RogueNet,
+        max_batch_size: int = 64,
+        max_delay_ms: float = 2.0,
+        latency_window: int = 10000,
+    ) -> None:
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be positive, got {max_batch_size}")
+        # Freeze the input normalization, otherwise every request would update it and
+        # actions would depend on the history and composition of batches
+        self.agent = agent.eval()
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000
+        self._requests: "queue.Queue[Optional[_Request]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._latencies: Deque[float] = deque(maxlen=latency_window)
+        self._batch_sizes: Counter[int] = Counter()
+        self._served = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_checkpoint(cls, path: str, **kwargs: Any) -> "BatchingAgent":
+        """
+        Loads the agent of a training checkpoint, see :func:`~enn_trainer.load_agent`.
+        """
+        return cls(load_agent(path).agent, **kwargs)
+
+    def submit(self, obs: Observation) -> "Future[ActResult]":
+        """
+        Queues an observation and returns a future that resolves to the actions and
+        the value estimate of the agent.
+        """
+        future: "Future[ActResult]" = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("BatchingAgent is closed")
+            self._requests.put(_Request(obs, future, time.perf_counter()))
+        return future
+
+    def act(self, obs: Observation) -> ActResult:
+        return self.submit(obs).result()
+
+    async def act_async(self, obs: Observation) -> ActResult:
+        return await asyncio.wrap_future(self.submit(obs))
+
+    def stats(self) -> ServingStats:
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            return ServingStats(
+                requests=self._served,
+                latency_p50_ms=float(np.percentile(latencies, 50))
+                if len(latencies) > 0
+                else 0.0,
+                latency_p99_ms=float(np.percentile(latencies, 99))
+                if len(latencies) > 0
+                else 0.0,
+                batch_sizes=dict(sorted(self._batch_sizes.items())),
+            )
+
+    def close(self) -> None:
+        """
+        Serves all pending requests and stops the background thread.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._requests.put(None)
+        self._thread.join()
+
+    def __enter__(self) -> "BatchingAgent":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    def _serve(self) -> None:
+        stopped = False
+        while not stopped:
+            first = self._requests.get()
+            if first is None:
+                break
+            batch = [first]
+            deadline = first.submitted + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                try:
+                    request = (
+                        self._requests.get(timeout=timeout)
+                        if timeout > 0
+                        else self._requests.get_nowait()
+                    )
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopped = True
+                    break
+                batch.append(request)
+            try:
+                results = self._act([request.obs for request in batch])
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            done = time.perf_counter()
+            with self._lock:
+                self._latencies.extend(done - request.submitted for request in batch)
+                self._batch_sizes[len(batch)] += 1
+                self._served += len(batch)
+            for request, result in zip(batch, results):
+                request.future.set_result(result)
+
+    def _act(self, observations: List[Observation]) -> List[ActResult]:
+        obs_space, action_space = self.agent.obs_space, self.agent.action_space
+        vec_obs = batch_obs(observations, obs_space, action_space)
+        with torch.no_grad():
+            (
+                act_indices,
+                _,
+                _,
+                actor_counts,
+                aux,
+                logits,
+            ) = self.agent.get_action_and_auxiliary(
+                vec_obs.features,
+                vec_obs.visible,
+                vec_obs.action_masks,
+                tracer=Tracer(False),
+            )
+        values = aux["value"].view(-1).cpu().numpy()
+        probs = {name: l.exp().cpu().numpy() for name, l in logits.items()}
+        # Probabilities of the actors of each observation
+        offsets = {
+            name: np.concatenate([[0], np.cumsum(counts)])
+            for name, counts in actor_counts.items()
+        }
+        results = []
+        for i, obs in enumerate(observations):
+            obs_probs = {}
+            for name, prob in probs.items():
+                if (
+                    isinstance(action_space[name], SelectEntityActionSpace)
+                    and prob.ndim == 3
+                ):
+                    # Padded to the largest number of actors and actees in the batch
+                    nactee = vec_obs.action_masks[name].actees.size1(i)  # type: ignore
+                    obs_probs[name] = prob[i : i + 1, : actor_counts[name][i], :nactee]
+                else:
+                    obs_probs[name] = prob[offsets[name][i] : offsets[name][i + 1]]
+            actions = action_index_to_actions(
+                obs_space, action_space, act_indices, obs, index=i, probs=obs_probs
+            )
+            results.append((actions, float(values[i])))
+        return results
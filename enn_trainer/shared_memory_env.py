@@ -0,0 +1,283 @@
+import multiprocessing as mp
+import multiprocessing.connection as conn
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+import msgpack_numpy
+import numpy as np
+import numpy.typing as npt
+from entity_gym.env import (
+    ActionName,
+    ActionSpace,
+    Environment,
+    ObsSpace,
+    VecEnv,
+    VecObs,
+)
+from entity_gym.env.env_list import EnvList
+from entity_gym.env.parallel_env_list import CloudpickleWrapper
+from entity_gym.env.vec_env import batch_obs
+from entity_gym.serialization.msgpack_ragged import (
+    ragged_buffer_decode,
+    ragged_buffer_encode,
+)
+from ragged_buffer import (
+    RaggedBuffer,
+    RaggedBufferBool,
+    RaggedBufferF32,
+    RaggedBufferI64,
+)
+
+_RAGGED_TYPES: Dict[str, Any] = {
+    "float32": RaggedBufferF32,
+    "int64": RaggedBufferI64,
+    "bool": RaggedBufferBool,
+}
+
+# Message tags
+_SHARED = b"S"
+_INLINE = b"I"
+
+
+class _CapacityExceeded(Exception):
+    pass
+
+
+class _SharedMemoryWriter:
+    """
+    Encodes ragged buffers by copying their data into a shared memory segment and
+    replacing them with references to the segment.
+    """
+
+    def __init__(self, shm: SharedMemory) -> None:
+        assert shm.buf is not None
+        self.buf = shm.buf
+        self.offset = 0
+
+    def write(self, array: npt.NDArray[Any]) -> Tuple[int, str, List[int]]:
+        array = np.ascontiguousarray(array)
+        # Keep all arrays 8-byte aligned
+        start = (self.offset + 7) & ~7
+        end = start + array.nbytes
+        if end > len(self.buf):
+            raise _CapacityExceeded()
+        np.ndarray(array.shape, dtype=array.dtype, buffer=self.buf, offset=start)[
+            ...
+        ] = array
+        self.offset = end
+        return start, array.dtype.name, list(array.shape)
+
+    def encode(self, obj: Any) -> Any:
+        if type(obj) in _RAGGED_TYPES.values():
+            return {
+                "__shm_flattened__": self.write(obj.as_array()),
+                "__shm_lengths__": self.write(obj.size1()),
+            }
+        return ragged_buffer_encode(obj)
+
+
+class _SharedMemoryReader:
+    def __init__(self, shm: SharedMemory) -> None:
+        assert shm.buf is not None
+        self.buf = shm.buf
+
+    def read(self, ref: Tuple[int, str, List[int]]) -> npt.NDArray[Any]:
+        offset, dtype, shape = ref
+        return np.ndarray(
+            tuple(shape), dtype=np.dtype(dtype), buffer=self.buf, offset=offset
+        )
+
+    def decode(self, obj: Any) -> Any:
+        if "__shm_flattened__" in obj:
+            flattened = self.read(obj["__shm_flattened__"])
+            lengths = self.read(obj["__shm_lengths__"])
+            # Copies the data out of the segment, which is reused by the next step
+            ragged: RaggedBuffer[Any] = _RAGGED_TYPES[
+                flattened.dtype.name
+            ].from_flattened(flattened, lengths)
+            return ragged
+        return ragged_buffer_decode(obj)
+
+
+def _send(remote: conn.Connection, data: Any) -> None:
+    remote.send_bytes(msgpack_numpy.dumps(data, default=ragged_buffer_encode))
+
+
+def _recv(remote: conn.Connection) -> Any:
+    return msgpack_numpy.loads(
+        remote.recv_bytes(), object_hook=ragged_buffer_decode, strict_map_key=False
+    )
+
+
+def _send_obs(remote: conn.Connection, obs: VecObs, shm: SharedMemory) -> None:
+    try:
+        writer = _SharedMemoryWriter(shm)
+        header = msgpack_numpy.dumps(obs, default=writer.encode)
+        remote.send_bytes(_SHARED + header)
+    except _CapacityExceeded:
+        # Observations that don't fit into the shared memory segment are sent in full
+        remote.send_bytes(
+            _INLINE + msgpack_numpy.dumps(obs, default=ragged_buffer_encode)
+        )
+
+
+def _worker(
+    remote: conn.Connection,
+    parent_remote: conn.Connection,
+    env_list_config: CloudpickleWrapper,
+    shm_name: str,
+) -> None:
+    parent_remote.close()
+    # The segment is owned by the parent process, which is responsible for unlinking it
+    shm = SharedMemory(name=shm_name)
+    envs = EnvList(*env_list_config.var)
+    while True:
+        try:
+            cmd, data = _recv(remote)
+            if cmd == "act":
+                _send_obs(remote, envs.act(data[0], data[1]), shm)
+            elif cmd == "reset":
+                _send_obs(remote, envs.reset(data), shm)
+            elif cmd == "render":
+                _send(remote, envs.render(**data))
+            elif cmd == "close":
+                envs.close()
+                remote.close()
+                break
+            else:
+                raise NotImplementedError(f"`{cmd}` is not implemented in the worker")
+        except EOFError:
+            break
+    shm.close()
+
+
+class SharedMemoryEnvList(VecEnv):
+    """
+    Runs environments in worker processes like :class:`ParallelEnvList`, but transfers
+    observations through shared memory rather than serializing them over pipes.
+
+    Each worker owns a shared memory segment into which it writes the flattened data and
+    lengths of all ragged buffers of its observations (features, visibility, and action
+    masks). Only a small header that describes the layout of the segment is sent over the
+    pipe, and the main process constructs the observation directly from the segment.
+    Observations that exceed the capacity of the segment are sent over the pipe in full.
+
+    :param capacity_mb: Size of the shared memory segment of each worker in megabytes.
+    """
+
+    def __init__(
+        self,
+        create_env: Callable[[], Environment],
+        num_envs: int,
+        num_processes: int,
+        capacity_mb: float = 64,
+        start_method: Optional[str] = None,
+    ):
+        if start_method is None:
+            forkserver_available = "forkserver" in mp.get_all_start_methods()
+            start_method = "forkserver" if forkserver_available else "spawn"
+        ctx = mp.get_context(start_method)
+
+        assert (
+            num_envs % num_processes == 0
+        ), "The required number of environments can not be equally split into the number of specified processes."
+
+        self.num_processes = num_processes
+        self.num_envs = num_envs
+        self.envs_per_process = num_envs // num_processes
+        # Number of observations that did not fit into shared memory
+        self.inline_transfers = 0
+
+        self.segments = [
+            SharedMemory(create=True, size=max(int(capacity_mb * 1024 * 1024), 1))
+            for _ in range(num_processes)
+        ]
+        self.readers = [_SharedMemoryReader(shm) for shm in self.segments]
+        self.remotes: List[conn.Connection] = []
+        self.processes = []
+        for shm in self.segments:
+            remote, work_remote = ctx.Pipe()
+            args = (
+                work_remote,
+                remote,
+                CloudpickleWrapper((create_env, self.envs_per_process)),
+                shm.name,
+            )
+            process = ctx.Process(target=_worker, args=args, daemon=True)  # type: ignore
+            process.start()
+            self.processes.append(process)
+            self.remotes.append(remote)
+            work_remote.close()
+
+        env = create_env()
+        self._obs_space = env.obs_space()
+        self._action_space = env.action_space()
+
+    def reset(self, obs_space: ObsSpace) -> VecObs:
+        for remote in self.remotes:
+            _send(remote, ("reset", obs_space))
+        return self._recv_obs()
+
+    def act(
+        self, actions: Mapping[str, RaggedBufferI64], obs_space: ObsSpace
+    ) -> VecObs:
+        for i, remote in enumerate(self.remotes):
+            start = i * self.envs_per_process
+            _send(
+                remote,
+                (
+                    "act",
+                    (
+                        {
+                            atype: a[start : start + self.envs_per_process, :, :]
+                            for atype, a in actions.items()
+                        },
+                        obs_space,
+                    ),
+                ),
+            )
+        return self._recv_obs()
+
+    def _recv_obs(self) -> VecObs:
+        observations = batch_obs([], self.obs_space(), self.action_space())
+        for remote, reader in zip(self.remotes, self.readers):
+            message = remote.recv_bytes()
+            if message[:1] == _SHARED:
+                obs = msgpack_numpy.loads(
+                    message[1:], object_hook=reader.decode, strict_map_key=False
+                )
+            else:
+                self.inline_transfers += 1
+                obs = msgpack_numpy.loads(
+                    message[1:], object_hook=ragged_buffer_decode, strict_map_key=False
+                )
+            observations.extend(obs)
+        return observations
+
+    def render(self, **kwargs: Any) -> npt.NDArray[np.uint8]:
+        rgb_arrays = []
+        for remote in self.remotes:
+            _send(remote, ("render", kwargs))
+            rgb_arrays.append(_recv(remote))
+        np_rgb_arrays = np.concatenate(rgb_arrays)
+        assert isinstance(np_rgb_arrays, np.ndarray)
+        return np_rgb_arrays
+
+    def close(self) -> None:
+        for remote in self.remotes:
+            _send(remote, ("close", None))
+        for process in self.processes:
+            process.join()
+        self.readers = []
+        for shm in self.segments:
+            shm.close()
+            shm.unlink()
+
+    def __len__(self) -> int:
+        return self.num_envs
+
+    def obs_space(self) -> ObsSpace:
+        return self._obs_space
+
+    def action_space(self) -> Dict[ActionName, ActionSpace]:
+        return self._action_space
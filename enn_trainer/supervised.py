@@ -1,12 +1,28 @@
 import math
 import os
+import socket
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import asdict, dataclass
-from typing import Dict, List, Literal, Optional, Tuple
+from typing import (
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import hyperstate
 import numpy as np
 import numpy.typing as npt
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.nn as nn
 import torch.nn.functional as F
 import wandb
@@ -16,9 +32,20 @@ from entity_gym.serialization import Trace
 from entity_gym.serialization.sample_loader import Episode, MergedSamples
 from entity_gym.simple_trace import Tracer
 from ragged_buffer import RaggedBufferBool, RaggedBufferF32, RaggedBufferI64
+from rogue_net.input_norm import InputNorm
 from rogue_net.rogue_net import RogueNet, RogueNetConfig
 from torch.optim import AdamW
 
+from enn_trainer.allreduce import GradientAllreduce
+from enn_trainer.dataset_cache import (
+    CachedSplit,
+    DatasetCache,
+    build_dataset_cache,
+    dataset_cache_path,
+)
+from enn_trainer.precision import autocast, check_precision, grad_scaler
+from enn_trainer.trace_reader import MappedTrace
+
 
 @dataclass
 class OptimizerConfig:
@@ -29,12 +56,18 @@ class OptimizerConfig:
         anneal_lr: anneal learning rate
         max_grad_norm: max gradient norm
         batch_size: batch size
+        precision: precision of forward passes ("fp32", "bf16", or "fp16")
+        allreduce_bucket_mb: size in megabytes of the buckets of gradients that are all-reduced when training with multiple processes
+        allreduce_fp16: communicate gradients in half precision when training with multiple processes
     """
 
     lr: float = 1e-4
     anneal_lr: bool = True
     max_grad_norm: float = 100.0
     batch_size: int = 512
+    precision: str = "fp32"
+    allreduce_bucket_mb: float = 1.0
+    allreduce_fp16: bool = False
 
 
 @dataclass
@@ -66,6 +99,12 @@ class Config:
         log_interval: print out loss every log_interval steps
         fast_eval_interval: interval at which to evaluate with subset of test data
         fast_eval_samples: number of samples to use in fast evaluation
+        fast_eval_batch_size: number of samples per batch in fast evaluation
+        streaming: read samples from a memory-mapped dataset file on demand rather than loading the entire dataset into memory
+        dataset_cache_dir: directory in which the dataset is cached as memory-mapped arrays that are reused across runs (disabled if not set)
+        shuffle_block_size: number of consecutive frames that are kept together when shuffling the training set, larger blocks keep reads from the dataset cache mostly sequential
+        prefetch_batches: number of batches that are loaded ahead of time in a background thread (0 to load batches synchronously)
+        processes: number of local data-parallel processes, each of which processes a slice of every batch (replicas of an xprun experiment are used instead when running on xprun)
     """
 
     optim: OptimizerConfig
@@ -77,6 +116,23 @@ class Config:
     log_interval: int = 10
     fast_eval_interval: int = 32768
     fast_eval_samples: int = 8192
+    fast_eval_batch_size: int = 2048
+    streaming: bool = False
+    dataset_cache_dir: Optional[str] = None
+    shuffle_block_size: int = 1
+    prefetch_batches: int = 2
+    processes: int = 1
+
+
+# Entities, visibility masks, actions, logprobs, action masks, and logits of a batch
+BatchData = Tuple[
+    Dict[str, RaggedBufferF32],
+    Dict[str, RaggedBufferBool],
+    Dict[str, RaggedBufferI64],
+    Dict[str, RaggedBufferF32],
+    Dict[str, VecActionMask],
+    Optional[Dict[str, RaggedBufferF32]],
+]
 
 
 @dataclass
@@ -91,10 +147,15 @@ class DataSet:
     frames: int
 
     permutation: Optional[npt.NDArray[np.int64]] = None
+    # Number of consecutive frames that are kept together by shuffle
+    shuffle_block_size: int = 1
 
     @classmethod
     def from_merged_samples(
-        cls, merged_samples: MergedSamples, batch_size: int
+        cls,
+        merged_samples: MergedSamples,
+        batch_size: int,
+        shuffle_block_size: int = 1,
     ) -> "DataSet":
         frames = (merged_samples.frames // batch_size) * batch_size
         if frames == 0:
@@ -109,6 +170,7 @@ class DataSet:
             logits=merged_samples.logits,
             batch_size=batch_size,
             frames=frames,
+            shuffle_block_size=shuffle_block_size,
         )
 
     @classmethod
@@ -144,20 +206,15 @@ class DataSet:
     def nbatch(self) -> int:
         return self.frames // self.batch_size
 
-    def batch(
-        self, n: int
-    ) -> Tuple[
-        Dict[str, RaggedBufferF32],
-        Dict[str, RaggedBufferBool],
-        Dict[str, RaggedBufferI64],
-        Dict[str, RaggedBufferF32],
-        Dict[str, VecActionMask],
-        Optional[Dict[str, RaggedBufferF32]],
-    ]:
+    def batch(self, n: int) -> BatchData:
+        return self.gather(self.batch_indices(n))
+
+    def batch_indices(self, n: int) -> npt.NDArray[np.int64]:
         if self.permutation is None:
-            indices = np.arange(n * self.batch_size, (n + 1) * self.batch_size)
-        else:
-            indices = self.permutation[n * self.batch_size : (n + 1) * self.batch_size]
+            return np.arange(n * self.batch_size, (n + 1) * self.batch_size)
+        return self.permutation[n * self.batch_size : (n + 1) * self.batch_size]
+
+    def gather(self, indices: npt.NDArray[np.int64]) -> BatchData:
         return (
             self.entities[indices],
             self.visible[indices],
@@ -168,23 +225,390 @@ class DataSet:
         )
 
     def shuffle(self) -> None:
-        self.permutation = np.random.permutation(self.frames)
+        self.permutation = block_permutation(self.frames, self.shuffle_block_size)
+
+    def deterministic_shuffle(self) -> None:
+        self.permutation = deterministic_permutation(self.frames)
+
+
+def deterministic_permutation(n: int) -> npt.NDArray[np.int64]:
+    """
+    Permutation that visits the indices ``0..n`` with a stride of ``sqrt(n)``.
+    """
+    stepsize = int(math.sqrt(n))
+    if stepsize == 0:
+        return np.zeros(0, dtype=np.int64)
+    # Lay out the indices in rows of length stepsize and read them column by column
+    rows = -(-n // stepsize)
+    perm = np.arange(rows * stepsize, dtype=np.int64).reshape(rows, stepsize).T.ravel()
+    return perm[perm < n]
+
+
+def block_permutation(n: int, block_size: int) -> npt.NDArray[np.int64]:
+    """
+    Random permutation of the indices ``0..n`` that shuffles the order of contiguous
+    blocks of ``block_size`` indices but preserves the order of indices within each block.
+    """
+    if block_size <= 1:
+        return np.random.permutation(n)
+    blocks = np.random.permutation(-(-n // block_size))
+    perm = (blocks[:, None] * block_size + np.arange(block_size)).ravel()
+    return perm[perm < n]
+
+
+class StreamingDataSet:
+    """
+    Dataset that decodes samples from a :class:`MappedTrace` on demand.
+
+    Only the samples that contain the frames of the current batch are decoded, so the
+    memory usage is independent of the size of the trace.
+    Since a sample contains the frames of all environments for one step, random access
+    to individual frames would decode a different sample for most frames of a batch.
+    Instead, :meth:`shuffle` shuffles the order of samples and only shuffles frames
+    within windows of ``shuffle_window`` consecutive samples. The samples of a window
+    are decoded once when a batch first reads from it and kept until the following
+    window has been read, so every sample is decoded once per epoch.
+
+    :param trace: The memory-mapped trace.
+    :param samples: Indices of the samples of the trace that belong to this dataset.
+    :param shuffle_window: Number of samples whose frames are shuffled together.
+    """
+
+    # Number of decoded windows kept in memory, a batch usually spans at most two windows
+    WINDOW_CACHE_SIZE = 2
+
+    def __init__(
+        self,
+        trace: MappedTrace,
+        samples: npt.NDArray[np.int64],
+        batch_size: int,
+        shuffle_window: int = 64,
+    ) -> None:
+        self.trace = trace
+        self.samples = samples
+        self.shuffle_window = shuffle_window
+        # Index of the first frame of each sample
+        self.sample_offsets = np.concatenate(
+            [[0], np.cumsum(trace.sample_frames[samples])]
+        ).astype(np.int64)
+        total_frames = int(self.sample_offsets[-1])
+        self.frames = (total_frames // batch_size) * batch_size
+        self.batch_size = batch_size
+        if self.frames == 0:
+            self.frames = total_frames
+            self.batch_size = total_frames
+        self.permutation: Optional[npt.NDArray[np.int64]] = None
+        # Windows of the current permutation, see `_update_windows`
+        self._windows_permutation: Optional[npt.NDArray[np.int64]] = None
+        self._window_samples: List[npt.NDArray[np.int64]] = []
+        self._sample_window = np.zeros(len(samples), dtype=np.int64)
+        self._sample_window_offset = np.zeros(len(samples), dtype=np.int64)
+        self._window_cache: "OrderedDict[int, MergedSamples]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._update_windows()
+
+    @property
+    def nbatch(self) -> int:
+        return self.frames // self.batch_size
+
+    def batch(self, n: int) -> BatchData:
+        return self.gather(self.batch_indices(n))
+
+    def batch_indices(self, n: int) -> npt.NDArray[np.int64]:
+        if self.permutation is None:
+            return np.arange(n * self.batch_size, (n + 1) * self.batch_size)
+        return self.permutation[n * self.batch_size : (n + 1) * self.batch_size]
+
+    def gather(self, indices: npt.NDArray[np.int64]) -> BatchData:
+        # Batches may be loaded by a background thread, see `BatchPrefetcher`
+        with self._lock:
+            return self._gather(indices)
+
+    def _gather(self, indices: npt.NDArray[np.int64]) -> BatchData:
+        if self.permutation is not self._windows_permutation:
+            self._update_windows()
+        sample = np.searchsorted(self.sample_offsets, indices, side="right") - 1
+        window = self._sample_window[sample]
+        # Index of each frame within the decoded samples of its window
+        window_indices = (
+            self._sample_window_offset[sample] + indices - self.sample_offsets[sample]
+        )
+        unique_windows = np.unique(window)
+        if len(unique_windows) == 1:
+            return _index_merged(self._window(int(unique_windows[0])), window_indices)
+
+        # Concatenate the frames of each window and restore the order of the indices
+        merged = MergedSamples.empty()
+        for w in unique_windows:
+            merged_window = self._window(int(w))
+            window_frames = window_indices[window == w]
+            merged.entities.extend(merged_window.entities[window_frames])
+            merged.visible.extend(merged_window.visible[window_frames])
+            merged.actions.extend(merged_window.actions[window_frames])
+            merged.logprobs.extend(merged_window.logprobs[window_frames])
+            merged.masks.extend(merged_window.masks[window_frames])
+            if merged_window.logits is not None:
+                if merged.logits is None:
+                    merged.logits = RaggedBatchDict(RaggedBufferF32)
+                merged.logits.extend(merged_window.logits[window_frames])
+            merged.frames += len(window_frames)
+        order = np.argsort(window, kind="stable")
+        return _index_merged(merged, np.argsort(order))
+
+    def _update_windows(self) -> None:
+        # Windows consist of `shuffle_window` samples in the order in which their first
+        # frame appears in the permutation. This recovers the windows of `shuffle`, also
+        # for permutations that were assigned directly, e.g. by `ShardedDataSet`.
+        if self.permutation is None:
+            order = np.arange(len(self.samples))
+        else:
+            sample = (
+                np.searchsorted(self.sample_offsets, self.permutation, side="right") - 1
+            )
+            first = np.full(len(self.samples), len(sample), dtype=np.int64)
+            np.minimum.at(first, sample, np.arange(len(sample)))
+            order = np.argsort(first, kind="stable")
+        sample_frames = np.diff(self.sample_offsets)
+        self._window_samples = []
+        for w, start in enumerate(range(0, len(order), self.shuffle_window)):
+            window_samples = order[start : start + self.shuffle_window]
+            self._window_samples.append(window_samples)
+            self._sample_window[window_samples] = w
+            frames = sample_frames[window_samples]
+            self._sample_window_offset[window_samples] = np.cumsum(frames) - frames
+        self._windows_permutation = self.permutation
+        self._window_cache.clear()
+
+    def _window(self, w: int) -> MergedSamples:
+        merged = self._window_cache.get(w)
+        if merged is None:
+            merged = MergedSamples.empty()
+            for s in self._window_samples[w]:
+                # Takes ownership of the buffers of the sample, so samples can't be reused
+                merged.push_sample(self.trace.sample(self.samples[s]))
+            self._window_cache[w] = merged
+            if len(self._window_cache) > self.WINDOW_CACHE_SIZE:
+                self._window_cache.popitem(last=False)
+        else:
+            self._window_cache.move_to_end(w)
+        return merged
+
+    def shuffle(self) -> None:
+        order = np.random.permutation(len(self.samples))
+        windows = []
+        for start in range(0, len(order), self.shuffle_window):
+            frames = np.concatenate(
+                [
+                    np.arange(self.sample_offsets[s], self.sample_offsets[s + 1])
+                    for s in order[start : start + self.shuffle_window]
+                ]
+            )
+            windows.append(np.random.permutation(frames))
+        self.permutation = np.concatenate(windows)
 
     def deterministic_shuffle(self) -> None:
-        stepsize = int(math.sqrt(self.frames))
-        perm = np.zeros(self.frames, dtype=np.int64)
-        index = 0
-        offset = 0
-        for i in range(self.frames):
-            perm[i] = index
-            index += stepsize
-            if index >= self.frames:
-                offset += 1
-                index = offset
-        self.permutation = perm
-
-
-def load_dataset(filepath: str, batch_size: int) -> Tuple[Trace, DataSet, DataSet]:
+        # Shuffle the order of samples but keep the frames of each sample together
+        self.permutation = np.concatenate(
+            [
+                np.arange(self.sample_offsets[s], self.sample_offsets[s + 1])
+                for s in deterministic_permutation(len(self.samples))
+            ]
+        )
+
+
+def _index_merged(merged: MergedSamples, indices: npt.NDArray[np.int64]) -> BatchData:
+    return (
+        merged.entities[indices],
+        merged.visible[indices],
+        merged.actions[indices],
+        merged.logprobs[indices],
+        merged.masks[indices],
+        merged.logits[indices] if merged.logits is not None else None,
+    )
+
+
+class CachedDataSet:
+    """
+    Dataset that gathers batches from the memory-mapped arrays of a :class:`DatasetCache`.
+
+    :param shuffle_block_size: Number of consecutive frames that are kept together by
+        :meth:`shuffle`. Larger blocks make reads from the memory-mapped arrays more sequential.
+    """
+
+    def __init__(
+        self, split: CachedSplit, batch_size: int, shuffle_block_size: int = 1
+    ) -> None:
+        self.split = split
+        self.shuffle_block_size = shuffle_block_size
+        self.frames = (split.frames // batch_size) * batch_size
+        self.batch_size = batch_size
+        if self.frames == 0:
+            self.frames = split.frames
+            self.batch_size = split.frames
+        self.permutation: Optional[npt.NDArray[np.int64]] = None
+
+    @property
+    def nbatch(self) -> int:
+        return self.frames // self.batch_size
+
+    def batch(self, n: int) -> BatchData:
+        return self.gather(self.batch_indices(n))
+
+    def batch_indices(self, n: int) -> npt.NDArray[np.int64]:
+        if self.permutation is None:
+            return np.arange(n * self.batch_size, (n + 1) * self.batch_size)
+        return self.permutation[n * self.batch_size : (n + 1) * self.batch_size]
+
+    def gather(self, indices: npt.NDArray[np.int64]) -> BatchData:
+        logits = self.split.ragged("logits", RaggedBufferF32, indices)
+        return (
+            self.split.ragged("entities", RaggedBufferF32, indices),
+            self.split.ragged("visible", RaggedBufferBool, indices),
+            self.split.ragged("actions", RaggedBufferI64, indices),
+            self.split.ragged("logprobs", RaggedBufferF32, indices),
+            self.split.masks(indices),
+            logits if len(logits) > 0 else None,
+        )
+
+    def shuffle(self) -> None:
+        self.permutation = block_permutation(self.frames, self.shuffle_block_size)
+
+    def deterministic_shuffle(self) -> None:
+        self.permutation = deterministic_permutation(self.frames)
+
+
+class ShardedDataSet:
+    """
+    Shard of a dataset for one of ``world_size`` data-parallel processes.
+
+    Every batch of the dataset is split into ``world_size`` contiguous slices and
+    :meth:`batch` returns the slice of process ``rank``, so ``frames``, ``batch_size``,
+    and ``nbatch`` refer to the global batches shared by all processes.
+    All processes must visit frames in the same order, :meth:`shuffle` therefore
+    broadcasts the permutation of process 0.
+    """
+
+    def __init__(
+        self,
+        ds: "AnyDataSet",
+        rank: int,
+        world_size: int,
+    ) -> None:
+        self.ds = ds
+        self.rank = rank
+        self.world_size = world_size
+
+    @property
+    def frames(self) -> int:
+        return self.ds.frames
+
+    @property
+    def batch_size(self) -> int:
+        return self.ds.batch_size
+
+    @property
+    def nbatch(self) -> int:
+        return self.ds.nbatch
+
+    @property
+    def permutation(self) -> Optional[npt.NDArray[np.int64]]:
+        return self.ds.permutation
+
+    @permutation.setter
+    def permutation(self, permutation: Optional[npt.NDArray[np.int64]]) -> None:
+        self.ds.permutation = permutation
+
+    def batch(self, n: int) -> BatchData:
+        return self.gather(self.batch_indices(n))
+
+    def batch_indices(self, n: int) -> npt.NDArray[np.int64]:
+        return np.array_split(self.ds.batch_indices(n), self.world_size)[self.rank]
+
+    def gather(self, indices: npt.NDArray[np.int64]) -> BatchData:
+        return self.ds.gather(indices)
+
+    def shuffle(self) -> None:
+        self.ds.shuffle()
+        if dist.is_initialized():
+            assert self.ds.permutation is not None
+            permutation = torch.from_numpy(self.ds.permutation.astype(np.int64))
+            dist.broadcast(permutation, src=0)
+            self.ds.permutation = permutation.numpy()
+
+    def deterministic_shuffle(self) -> None:
+        self.ds.deterministic_shuffle()
+
+
+AnyDataSet = Union[DataSet, StreamingDataSet, CachedDataSet, ShardedDataSet]
+
+
+def build_dataset_cache_if_missing(cache_dir: str, filepath: str) -> str:
+    """
+    Builds the cache of a dataset in ``cache_dir`` unless it already exists, and returns
+    the path of the cache.
+    """
+    cache_path = dataset_cache_path(cache_dir, filepath)
+    if not os.path.exists(cache_path):
+        print(f"Building dataset cache {cache_path}")
+        os.makedirs(cache_dir, exist_ok=True)
+        build_dataset_cache(filepath, cache_path, test_frac=0.1, progress_bar=True)
+    return cache_path
+
+
+def load_dataset(
+    filepath: str,
+    batch_size: int,
+    streaming: bool = False,
+    cache_dir: Optional[str] = None,
+    shuffle_block_size: int = 1,
+) -> Tuple[Trace, AnyDataSet, AnyDataSet]:
+    """
+    Loads a dataset of recorded samples and splits it into a training and test set.
+
+    :param streaming: Memory-map the file and decode samples on demand rather than loading
+        the entire dataset into memory. The returned trace then only contains the
+        observation and action spaces, and no samples.
+    :param cache_dir: Directory of persistent dataset caches. On first use, the dataset is
+        converted into a cache that is reused by all later runs on the same dataset file.
+        The returned trace then only contains the observation and action spaces, and no samples.
+    :param shuffle_block_size: Number of consecutive frames that are kept together when
+        shuffling. Not used by streaming datasets, which always shuffle whole samples.
+    """
+    if cache_dir is not None:
+        cache = DatasetCache(build_dataset_cache_if_missing(cache_dir, filepath))
+        cached_trainds = CachedDataSet(cache.train, batch_size, shuffle_block_size)
+        cached_testds = CachedDataSet(cache.test, batch_size, shuffle_block_size)
+        print(f"{cached_trainds.frames} training samples")
+        print(f"{cached_testds.frames} test samples")
+        return (
+            Trace(
+                cache.action_space,
+                cache.obs_space,
+                samples=[],
+                subsample=cache.subsample,
+            ),
+            cached_trainds,
+            cached_testds,
+        )
+
+    if streaming:
+        mapped_trace = MappedTrace(filepath, progress_bar=True)
+        train_samples, test_samples = mapped_trace.train_test_split(test_frac=0.1)
+        streaming_trainds = StreamingDataSet(mapped_trace, train_samples, batch_size)
+        streaming_testds = StreamingDataSet(mapped_trace, test_samples, batch_size)
+        print(f"{streaming_trainds.frames} training samples")
+        print(f"{streaming_testds.frames} test samples")
+        return (
+            Trace(
+                mapped_trace.action_space,
+                mapped_trace.obs_space,
+                samples=[],
+                subsample=mapped_trace.subsample,
+            ),
+            streaming_trainds,
+            streaming_testds,
+        )
+
     trace = Trace.deserialize(open(filepath, "rb").read(), progress_bar=True)
 
     # episodes = trace.episodes(progress_bar=True)
@@ -194,37 +618,148 @@ def load_dataset(filepath: str, batch_size: int) -> Tuple[Trace, DataSet, DataSe
     # trainds = DataSet.from_episodes(train, batch_size=batch_size)
     # testds = DataSet.from_episodes(test, batch_size=batch_size)
     train, test = trace.train_test_split(test_frac=0.1, progress_bar=True)
-    trainds = DataSet.from_merged_samples(train, batch_size=batch_size)
-    testds = DataSet.from_merged_samples(test, batch_size=batch_size)
+    trainds = DataSet.from_merged_samples(train, batch_size, shuffle_block_size)
+    testds = DataSet.from_merged_samples(test, batch_size, shuffle_block_size)
     print(f"{trainds.frames} training samples")
     print(f"{testds.frames} test samples")
     return trace, trainds, testds
 
 
+@dataclass
+class Batch:
+    """
+    Inputs and targets of one batch of a dataset.
+    The targets are converted to tensors, which are pinned for fast transfer to the
+    device if ``pin_memory`` is set.
+    """
+
+    entities: Dict[str, RaggedBufferF32]
+    visible: Dict[str, RaggedBufferBool]
+    actions: Dict[str, RaggedBufferI64]
+    masks: Dict[str, VecActionMask]
+    logprobs: Dict[str, torch.Tensor]
+    logits: Optional[Dict[str, torch.Tensor]]
+
+    def to(self, device: torch.device) -> "Batch":
+        """
+        Returns a copy of the batch with the targets moved to the device.
+        """
+        return Batch(
+            entities=self.entities,
+            visible=self.visible,
+            actions=self.actions,
+            masks=self.masks,
+            logprobs={k: v.to(device) for k, v in self.logprobs.items()},
+            logits=(
+                {k: v.to(device) for k, v in self.logits.items()}
+                if self.logits is not None
+                else None
+            ),
+        )
+
+
+def load_batch(ds: AnyDataSet, n: int, pin_memory: bool = False) -> Batch:
+    return to_batch(ds.batch(n), pin_memory)
+
+
+def to_batch(data: BatchData, pin_memory: bool = False) -> Batch:
+    entities, visible, actions, logprobs, masks, logits = data
+
+    def to_tensor(buffer: RaggedBufferF32) -> torch.Tensor:
+        tensor = torch.from_numpy(buffer.as_array())
+        return tensor.pin_memory() if pin_memory else tensor
+
+    return Batch(
+        entities=entities,
+        visible=visible,
+        actions=actions,
+        masks=masks,
+        logprobs={k: to_tensor(v) for k, v in logprobs.items()},
+        logits=(
+            {k: to_tensor(v) for k, v in logits.items()} if logits is not None else None
+        ),
+    )
+
+
+class BatchPrefetcher:
+    """
+    Loads batches in a background thread while the model processes previous batches.
+    Up to ``depth`` batches are loaded ahead of the batch that is currently consumed.
+
+    :param depth: Number of batches to load ahead of time, 0 loads batches synchronously.
+    :param pin_memory: Stage the targets of each batch in pinned memory.
+    """
+
+    def __init__(self, depth: int, pin_memory: bool, tracer: Tracer) -> None:
+        self.depth = depth
+        self.pin_memory = pin_memory
+        self.tracer = tracer
+        self.executor = ThreadPoolExecutor(max_workers=1) if depth > 0 else None
+
+    def batches(self, ds: AnyDataSet, batches: Iterable[int]) -> Iterator[Batch]:
+        """
+        Yields the given batches of the dataset in order.
+        The order of the dataset must not be changed until all batches have been consumed.
+        """
+        if self.executor is None:
+            for n in batches:
+                with self.tracer.span("load_batch"):
+                    batch = load_batch(ds, n, self.pin_memory)
+                yield batch
+            return
+
+        remaining = iter(batches)
+        pending: Deque[Future[Batch]] = deque()
+        for n in remaining:
+            pending.append(self.executor.submit(load_batch, ds, n, self.pin_memory))
+            if len(pending) == self.depth:
+                break
+        while len(pending) > 0:
+            with self.tracer.span("wait_batch"):
+                batch = pending.popleft().result()
+            # Start loading the next batch before handing out the current one
+            n_next = next(remaining, None)
+            if n_next is not None:
+                pending.append(
+                    self.executor.submit(load_batch, ds, n_next, self.pin_memory)
+                )
+            yield batch
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
 def compute_loss(
     model: RogueNet,
-    batch: int,
-    ds: DataSet,
+    batch: Batch,
     loss_fn: Literal["kl", "mse"],
     tracer: Tracer,
     device: torch.device,
-) -> Tuple[torch.Tensor, float]:
-    entities, visible, actions, logprobs, masks, logits = ds.batch(batch)
-    _, newlogprob, entropy, _, aux, newlogits = model.get_action_and_auxiliary(
-        entities=entities,
-        visible=visible,
-        action_masks=masks,
-        prev_actions=actions,
-        tracer=tracer,
-    )
+    precision: str = "fp32",
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Returns the loss and the summed mean entropy of all actions of a batch.
+    Both are returned as tensors on the device to avoid synchronizing with the device.
+    """
+    with autocast(precision, device):
+        _, newlogprob, entropy, _, aux, newlogits = model.get_action_and_auxiliary(
+            entities=batch.entities,
+            visible=batch.visible,
+            action_masks=batch.masks,
+            prev_actions=batch.actions,
+            tracer=tracer,
+        )
+    newlogprob = {k: v.float() for k, v in newlogprob.items()}
+    newlogits = {k: v.float() for k, v in newlogits.items()}
     loss = torch.tensor(0.0, device=device)
-    for actname, target_logprob in logprobs.items():
+    for actname, target_logprob in batch.logprobs.items():
         # Create normalized distributions
         if loss_fn == "kl":
-            if logits is None:
+            if batch.logits is None:
                 logprob = newlogprob[actname]
                 dist = torch.cat([logprob, (1 - logprob.exp()).log()], dim=1)
-                target = torch.tensor(target_logprob.as_array(), device=device)
+                target = target_logprob.to(device, non_blocking=True)
                 target_dist = torch.cat([target.exp(), 1 - target.exp()], dim=1)
                 loss += F.kl_div(
                     dist,
@@ -232,41 +767,172 @@ def compute_loss(
                 )
             else:
                 dist = newlogits[actname]
-                target_dist = torch.tensor(logits[actname].as_array(), device=device)
+                target_dist = batch.logits[actname].to(device, non_blocking=True)
                 loss += F.kl_div(
                     dist,
                     target_dist.exp(),
                 )
         elif loss_fn == "mse":
             logprob = newlogprob[actname]
-            target = torch.tensor(target_logprob.as_array().squeeze(-1), device=device)
+            target = target_logprob.squeeze(-1).to(device, non_blocking=True)
             loss += F.mse_loss(
                 logprob.masked_fill(mask=logprob == float("-inf"), value=0.0),
                 target.masked_fill(mask=target == float("-inf"), value=0.0),
             )
-    return loss, sum(e.mean().item() for _, e in entropy.items())
+    total_entropy = torch.tensor(0.0, device=device)
+    for e in entropy.values():
+        total_entropy += e.float().mean()
+    return loss, total_entropy
+
+
+class FastEval:
+    """
+    Evaluates the loss on a fixed subset of the test set.
+
+    The first ``samples`` frames of the test set (in its current order) are gathered once
+    on construction and their targets are kept on the device, so repeated evaluations
+    don't reload any data. Batches hold up to ``batch_size`` frames, which can be larger
+    than the training batch size since no activations are retained for a backward pass.
+    If ``ds`` is a :class:`ShardedDataSet`, each process evaluates its share of the
+    subset and the loss is averaged across processes.
+
+    :param samples: Number of frames to evaluate.
+    :param batch_size: Number of frames per evaluation batch.
+    """
+
+    def __init__(
+        self,
+        ds: AnyDataSet,
+        samples: int,
+        batch_size: int,
+        device: torch.device,
+    ) -> None:
+        samples = min(samples, ds.frames)
+        if ds.permutation is None:
+            indices = np.arange(samples, dtype=np.int64)
+        else:
+            indices = ds.permutation[:samples]
+        if isinstance(ds, ShardedDataSet):
+            indices = np.array_split(indices, ds.world_size)[ds.rank]
+        chunks = [
+            indices[start : start + batch_size]
+            for start in range(0, len(indices), batch_size)
+        ]
+        self.frames = samples
+        self.batches = [to_batch(ds.gather(chunk)).to(device) for chunk in chunks]
+        self.batch_frames = [len(chunk) for chunk in chunks]
+
+    def run(
+        self,
+        model: RogueNet,
+        loss_fn: Literal["kl", "mse"],
+        tracer: Tracer,
+        device: torch.device,
+        precision: str = "fp32",
+    ) -> float:
+        """
+        Returns the mean loss over all frames of the subset.
+        """
+        return evaluate(
+            model,
+            self.batches,
+            loss_fn,
+            tracer,
+            device,
+            precision,
+            weights=self.batch_frames,
+        )
+
+
+def evaluate(
+    model: RogueNet,
+    batches: Iterable[Batch],
+    loss_fn: Literal["kl", "mse"],
+    tracer: Tracer,
+    device: torch.device,
+    precision: str = "fp32",
+    weights: Optional[List[int]] = None,
+) -> float:
+    """
+    Computes the mean loss over a sequence of batches.
+
+    The model is evaluated in inference mode and with normalization statistics frozen
+    (``model.eval()``), its previous mode is restored afterwards. Losses are accumulated
+    on the device and only synchronized once at the end. When training with multiple
+    processes, the result is the mean over the batches of all processes.
+
+    :param weights: Weight of the loss of each batch, defaults to equal weights.
+    """
+    was_training = model.training
+    model.eval()
+    try:
+        with torch.inference_mode():
+            # Sum of weighted losses and sum of weights
+            totals = torch.zeros(2, device=device)
+            for i, batch in enumerate(batches):
+                weight = weights[i] if weights is not None else 1
+                loss, _ = compute_loss(model, batch, loss_fn, tracer, device, precision)
+                totals[0] += loss * weight
+                totals[1] += weight
+            if dist.is_initialized():
+                dist.all_reduce(totals, op=dist.ReduceOp.SUM)
+            total_loss, total_weight = totals.tolist()
+    finally:
+        model.train(was_training)
+    return float(total_loss / max(total_weight, 1))
 
 
 def train(
     cfg: Config,
     model: RogueNet,
-    trainds: DataSet,
-    testds: DataSet,
+    trainds: AnyDataSet,
+    testds: AnyDataSet,
     device: torch.device,
 ) -> None:
+    """
+    Trains the model on the training set and periodically evaluates it on the test set.
+    If a process group has been initialized, every process trains on a slice of each
+    batch and gradients are summed across processes.
+    """
     tracer = Tracer(cuda=device == "cuda")
+    check_precision(cfg.optim.precision, device)
+
+    if dist.is_initialized():
+        rank = dist.get_rank()
+        parallelism = dist.get_world_size()
+    else:
+        rank = 0
+        parallelism = 1
+    allreduce: Optional[GradientAllreduce] = None
+    if parallelism > 1:
+        trainds = ShardedDataSet(trainds, rank, parallelism)
+        testds = ShardedDataSet(testds, rank, parallelism)
+        # All processes start from the parameters of process 0
+        _broadcast(model.state_dict().values())
+        allreduce = GradientAllreduce(
+            model, cfg.optim.allreduce_bucket_mb, cfg.optim.allreduce_fp16
+        )
 
     optimizer = AdamW(model.parameters(), lr=cfg.optim.lr)
+    scaler = grad_scaler(cfg.optim.precision)
+    prefetcher = BatchPrefetcher(
+        cfg.prefetch_batches, pin_memory=device.type == "cuda", tracer=tracer
+    )
+    fast_eval = FastEval(
+        testds, cfg.fast_eval_samples, cfg.fast_eval_batch_size, device
+    )
     for epoch in range(cfg.epochs + 1):
-        test_loss = 0.0
-        for test_batch in range(testds.nbatch):
-            loss, _ = compute_loss(
-                model, test_batch, testds, cfg.loss_fn, tracer, device
-            )
-            test_loss += loss.item()
-        test_loss /= testds.nbatch
-        print(f"Test loss {test_loss:.4f}")
-        if cfg.wandb.track:
+        test_loss = evaluate(
+            model,
+            prefetcher.batches(testds, range(testds.nbatch)),
+            cfg.loss_fn,
+            tracer,
+            device,
+            cfg.optim.precision,
+        )
+        if rank == 0:
+            print(f"Test loss {test_loss:.4f}")
+        if cfg.wandb.track and rank == 0:
             wandb.log(
                 {
                     "test_loss": test_loss,
@@ -279,23 +945,17 @@ def train(
 
         trainds.shuffle()
         model.train()
-        for batch in range(trainds.nbatch):
+        for batch, train_batch in enumerate(
+            prefetcher.batches(trainds, range(trainds.nbatch))
+        ):
             frame = batch * trainds.batch_size + epoch * trainds.frames
             if frame % cfg.fast_eval_interval == 0:
-                test_loss = 0.0
-                for test_batch in range(cfg.fast_eval_samples // testds.batch_size):
-                    loss, _ = compute_loss(
-                        model,
-                        test_batch,
-                        testds,
-                        cfg.loss_fn,
-                        tracer,
-                        device,
-                    )
-                    test_loss += loss.item()
-                test_loss /= cfg.fast_eval_samples // testds.batch_size
-                print(f"Fast test loss {test_loss:.4f}")
-                if cfg.wandb.track:
+                test_loss = fast_eval.run(
+                    model, cfg.loss_fn, tracer, device, cfg.optim.precision
+                )
+                if rank == 0:
+                    print(f"Fast test loss {test_loss:.4f}")
+                if cfg.wandb.track and rank == 0:
                     wandb.log(
                         {
                             "fast_test_loss": test_loss,
@@ -313,34 +973,150 @@ def train(
                 lrnow = cfg.optim.lr
 
             loss, entropy = compute_loss(
-                model, batch, trainds, cfg.loss_fn, tracer, device
+                model,
+                train_batch,
+                cfg.loss_fn,
+                tracer,
+                device,
+                cfg.optim.precision,
             )
-            loss.backward()
+            # Gradients are summed across processes
+            scaler.scale(loss / parallelism).backward()
+            if allreduce is not None:
+                with tracer.span("allreduce"):
+                    allreduce.wait()
+            scaler.unscale_(optimizer)
             gradnorm = nn.utils.clip_grad_norm_(
                 model.parameters(), cfg.optim.max_grad_norm
             )
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
+            if parallelism > 1:
+                # As with DistributedDataParallel, the input normalization statistics of
+                # process 0 are used by all processes. They are synchronized after the
+                # forward pass has updated them, so that all processes agree between steps.
+                with tracer.span("broadcast_buffers"):
+                    _broadcast_input_norms(model)
+            traces = {}
             if batch % cfg.log_interval == 0:
-                print(
-                    f"Epoch {epoch}/{cfg.epochs}, Batch {batch}/{trainds.nbatch}, Loss {loss.item():.4f}, Entropy {entropy:.4f}"
+                traces = tracer.finish()
+                data_wait = traces.get("wait_batch", 0.0) + traces.get(
+                    "load_batch", 0.0
                 )
-            if cfg.wandb.track:
+                if rank == 0:
+                    print(
+                        f"Epoch {epoch}/{cfg.epochs}, Batch {batch}/{trainds.nbatch}, Loss {loss.item():.4f}, Entropy {entropy.item():.4f}, Data wait {data_wait:.3f}s"
+                    )
+            if cfg.wandb.track and rank == 0:
                 wandb.log(
                     {
                         "train_loss": loss.item(),
-                        "train_entropy": entropy,
+                        "train_entropy": entropy.item(),
                         "gradnorm": gradnorm,
                         "epoch": epoch,
                         "frame": frame,
                         "lr": lrnow,
+                        **{f"trace/{k}": v for k, v in traces.items()},
                     },
                 )
+    prefetcher.close()
+
+
+def _broadcast(tensors: Iterable[torch.Tensor]) -> None:
+    for tensor in tensors:
+        dist.broadcast(tensor, src=0)
+
+
+def _broadcast_input_norms(model: nn.Module) -> None:
+    # The running statistics of input normalization are the only buffers that change
+    # during training, they are broadcast with a single collective
+    norms = [module for module in model.modules() if isinstance(module, InputNorm)]
+    if len(norms) == 0:
+        return
+    # Buffers are replaced by the first update, so they are looked up on every call
+    buffers: List[torch.Tensor] = [
+        buffer
+        for norm in norms
+        for buffer in [norm.count, norm.mean, norm.squares_sum]
+        if isinstance(buffer, torch.Tensor)
+    ]
+    flat = torch.cat([buffer.reshape(-1) for buffer in buffers])
+    dist.broadcast(flat, src=0)
+    offset = 0
+    for buffer in buffers:
+        buffer.copy_(flat[offset : offset + buffer.numel()].view_as(buffer))
+        offset += buffer.numel()
+    for norm in norms:
+        # Invalidates the cached standard deviation
+        norm._dirty = True
 
 
 @hyperstate.command(Config)
 def main(cfg: Config) -> None:
     """Trains a supervised model on samples recorded from an entity-gym environment."""
-    trace, traindata, testdata = load_dataset(cfg.dataset_path, cfg.optim.batch_size)
+    if cfg.processes > 1:
+        mp.spawn(
+            _run_local_process,
+            args=(cfg, cfg.processes, _free_port()),
+            nprocs=cfg.processes,
+        )
+    else:
+        run(cfg)
+
+
+def _run_local_process(rank: int, cfg: Config, world_size: int, port: int) -> None:
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        run(cfg)
+    finally:
+        dist.destroy_process_group()
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return int(s.getsockname()[1])
+
+
+def run(cfg: Config) -> None:
+    """
+    Runs supervised training in the current process.
+    On xprun, experiments with multiple replicas train with one process per replica.
+    """
+    xp_info = None
+    if os.path.exists("/xprun/info/config.ron"):
+        import xprun  # type: ignore
+
+        xp_info = xprun.current_xp()
+        if xp_info.replicas() > 1 and not dist.is_initialized():
+            from enn_trainer.train import init_process
+
+            init_process(xp_info)
+    if dist.is_initialized():
+        rank = dist.get_rank()
+        parallelism = dist.get_world_size()
+    else:
+        rank = 0
+        parallelism = 1
+    assert cfg.optim.batch_size % parallelism == 0, (
+        "Batch size must be divisible by number of processes: "
+        f"{cfg.optim.batch_size} % {parallelism} != 0"
+    )
+
+    if cfg.dataset_cache_dir is not None and parallelism > 1:
+        # Only process 0 builds the dataset cache, the others wait until it is complete
+        if rank == 0:
+            build_dataset_cache_if_missing(cfg.dataset_cache_dir, cfg.dataset_path)
+        dist.barrier()
+    trace, traindata, testdata = load_dataset(
+        cfg.dataset_path,
+        cfg.optim.batch_size,
+        cfg.streaming,
+        cfg.dataset_cache_dir,
+        cfg.shuffle_block_size,
+    )
     if testdata.frames < cfg.fast_eval_samples:
         print(
             f"WARNING: fast_eval_samples {cfg.fast_eval_samples} is larger than test dataset {testdata.frames}"
@@ -349,7 +1125,7 @@ def main(cfg: Config) -> None:
     testdata.deterministic_shuffle()
 
     if torch.cuda.is_available():
-        device = torch.device("cuda")
+        device = torch.device("cuda", rank % torch.cuda.device_count())
     else:
         device = torch.device("cpu")
     # TODO: compute input normalization once at the beginning and then freeze it
@@ -359,13 +1135,10 @@ def main(cfg: Config) -> None:
         action_space=trace.action_space,
     ).to(device)
 
-    if cfg.wandb.track:
+    if cfg.wandb.track and rank == 0:
         config = asdict(cfg)
         run_name = None
-        if os.path.exists("/xprun/info/config.ron"):
-            import xprun  # type: ignore
-
-            xp_info = xprun.current_xp()
+        if xp_info is not None:
             config["name"] = xp_info.xp_def.name
             config["base_name"] = xp_info.xp_def.base_name
             config["id"] = xp_info.id
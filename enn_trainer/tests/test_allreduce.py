@@ -0,0 +1,143 @@
+import copy
+from pathlib import Path
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from entity_gym.env.vec_env import Metric
+
+from enn_trainer.allreduce import GradientAllreduce
+from enn_trainer.eval import MetricReducer
+
+
+def _inputs(rank: int, microbatch: int) -> torch.Tensor:
+    generator = torch.Generator().manual_seed(100 * rank + microbatch)
+    return torch.randn(5, 8, generator=generator)
+
+
+def _allreduce_worker(
+    rank: int,
+    world_size: int,
+    init_file: str,
+    bucket_size_mb: float,
+    compress_fp16: bool,
+) -> None:
+    dist.init_process_group(
+        "gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size
+    )
+    torch.manual_seed(0)
+    model = nn.Sequential(
+        nn.Linear(8, 16), nn.ReLU(), nn.Linear(16, 16), nn.ReLU(), nn.Linear(16, 4)
+    )
+    reference = copy.deepcopy(model)
+    allreduce = GradientAllreduce(model, bucket_size_mb, compress_fp16)
+
+    for step in range(2):
+        model.zero_grad()
+        reference.zero_grad()
+        for microbatch in range(3):
+            allreduce.sync = microbatch == 2
+            model(_inputs(rank, microbatch)).pow(2).sum().backward()
+        allreduce.wait()
+
+        for r in range(world_size):
+            for microbatch in range(3):
+                reference(_inputs(r, microbatch)).pow(2).sum().backward()
+        tolerance = 1e-2 if compress_fp16 else 1e-5
+        for param, expected in zip(model.parameters(), reference.parameters()):
+            assert param.grad is not None and expected.grad is not None
+            assert torch.allclose(
+                param.grad, expected.grad, rtol=tolerance, atol=tolerance
+            )
+
+    dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("bucket_size_mb", [0.0005, 1.0])
+@pytest.mark.parametrize("compress_fp16", [False, True])
+def test_gradient_allreduce_gloo(
+    tmp_path: Path, bucket_size_mb: float, compress_fp16: bool
+) -> None:
+    world_size = 2
+    mp.spawn(
+        _allreduce_worker,
+        args=(world_size, str(tmp_path / "init"), bucket_size_mb, compress_fp16),
+        nprocs=world_size,
+    )
+
+
+def _unused_parameters_worker(rank: int, world_size: int, init_file: str) -> None:
+    dist.init_process_group(
+        "gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size
+    )
+    torch.manual_seed(0)
+    # Each process only computes gradients for its own layer
+    model = nn.ModuleList([nn.Linear(8, 4) for _ in range(world_size)])
+    reference = copy.deepcopy(model)
+    allreduce = GradientAllreduce(model)
+
+    model[rank](_inputs(rank, 0)).pow(2).sum().backward()
+    allreduce.wait()
+
+    for r in range(world_size):
+        reference[r](_inputs(r, 0)).pow(2).sum().backward()
+    for param, expected in zip(model.parameters(), reference.parameters()):
+        assert param.grad is not None and expected.grad is not None
+        assert torch.allclose(param.grad, expected.grad, rtol=1e-5, atol=1e-5)
+
+    dist.destroy_process_group()
+
+
+def test_gradient_allreduce_unused_parameters(tmp_path: Path) -> None:
+    world_size = 2
+    mp.spawn(
+        _unused_parameters_worker,
+        args=(world_size, str(tmp_path / "init")),
+        nprocs=world_size,
+    )
+
+
+def _metric_reducer_worker(rank: int, world_size: int, init_file: str) -> None:
+    dist.init_process_group(
+        "gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size
+    )
+    reducer = MetricReducer()
+    steps = [
+        {"reward": Metric(count=2, sum=rank + 1.0, min=-rank, max=rank)},
+        # Metric that is only reported by one process
+        {
+            "reward": Metric(count=1, sum=1.0, min=1.0, max=1.0),
+            **(
+                {"episode_length": Metric(count=1, sum=5.0, min=5, max=5)}
+                if rank == 1
+                else {}
+            ),
+        },
+        {
+            "reward": Metric(),
+            "episode_length": Metric(count=rank, sum=3.0 * rank, min=3, max=3),
+        },
+    ]
+    expected = [
+        {"reward": Metric(count=4, sum=3.0, min=-1, max=1)},
+        {
+            "reward": Metric(count=2, sum=2.0, min=1.0, max=1.0),
+            "episode_length": Metric(count=1, sum=5.0, min=5, max=5),
+        },
+        {"reward": Metric(), "episode_length": Metric(count=1, sum=3.0, min=3, max=3)},
+    ]
+    for metrics, _expected in zip(steps, expected):
+        assert reducer.reduce(metrics) == _expected
+    assert reducer.names == ["episode_length", "reward"]
+    dist.destroy_process_group()
+
+
+def test_metric_reducer_gloo(tmp_path: Path) -> None:
+    world_size = 2
+    mp.spawn(
+        _metric_reducer_worker,
+        args=(world_size, str(tmp_path / "init")),
+        nprocs=world_size,
+    )
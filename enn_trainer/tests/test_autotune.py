@@ -0,0 +1,82 @@
+from pathlib import Path
+
+import torch
+from entity_gym.examples import ENV_REGISTRY
+from rogue_net.rogue_net import RogueNetConfig
+
+from enn_trainer.autotune import autotune, write_rollout_config
+from enn_trainer.config import (
+    EnvConfig,
+    OptimizerConfig,
+    PPOConfig,
+    RolloutConfig,
+    TrainConfig,
+)
+
+
+def test_autotune() -> None:
+    cfg = TrainConfig(
+        cuda=False,
+        ppo=PPOConfig(),
+        env=EnvConfig(id="MultiArmedBandit"),
+        rollout=RolloutConfig(steps=4, processes=1, num_envs=4),
+        net=RogueNetConfig(n_layer=0, d_model=16),
+        optim=OptimizerConfig(bs=16),
+    )
+    results = autotune(
+        cfg,
+        ENV_REGISTRY[cfg.env.id],
+        num_envs=[2, 4],
+        processes=[1, 2, 4],
+        steps=4,
+        device=torch.device("cpu"),
+    )
+    assert sorted((r.num_envs, r.processes) for r in results) == [
+        (2, 1),
+        (2, 2),
+        (4, 1),
+        (4, 2),
+        (4, 4),
+    ]
+    assert all(r.sps > 0 for r in results)
+    assert results == sorted(results, key=lambda r: r.sps, reverse=True)
+
+
+def test_write_rollout_config(tmp_path: Path) -> None:
+    path = tmp_path / "config.ron"
+    path.write_text(
+        "// Comment\n"
+        "ExperimentConfig(\n"
+        "    version: 0,\n"
+        "    rollout: (\n"
+        "        num_envs: 128,\n"
+        "        steps: 16,\n"
+        "    ),\n"
+        "    total_timesteps: 1000,\n"
+        ")\n"
+    )
+    write_rollout_config(str(path), num_envs=64, processes=8)
+    assert path.read_text() == (
+        "// Comment\n"
+        "ExperimentConfig(\n"
+        "    version: 0,\n"
+        "    rollout: (\n"
+        "        processes: 8,\n"
+        "        num_envs: 64,\n"
+        "        steps: 16,\n"
+        "    ),\n"
+        "    total_timesteps: 1000,\n"
+        ")\n"
+    )
+
+    path.write_text("ExperimentConfig(\n    version: 0,\n)\n")
+    write_rollout_config(str(path), num_envs=32, processes=2)
+    assert path.read_text() == (
+        "ExperimentConfig(\n"
+        "    rollout: (\n"
+        "        num_envs: 32,\n"
+        "        processes: 2,\n"
+        "    ),\n"
+        "    version: 0,\n"
+        ")\n"
+    )
@@ -0,0 +1,143 @@
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import hyperstate
+import pytest
+import torch
+from entity_gym.examples import ENV_REGISTRY
+from hyperstate import StateManager
+from rogue_net.rogue_net import RogueNetConfig
+
+from enn_trainer.checkpoint import Checkpointer, _Snapshot
+from enn_trainer.config import EnvConfig, OptimizerConfig, PPOConfig, RolloutConfig
+from enn_trainer.load_checkpoint import load_rogue_net
+from enn_trainer.train import State, TrainConfig, _create_agent, init_train_state
+
+
+def _state_manager(checkpoint_dir: Path) -> StateManager[TrainConfig, State]:
+    cfg = TrainConfig(
+        env=EnvConfig(id="MultiSnake"),
+        net=RogueNetConfig(n_layer=1, d_model=16),
+        optim=OptimizerConfig(),
+        ppo=PPOConfig(),
+        rollout=RolloutConfig(),
+    )
+    env = ENV_REGISTRY[cfg.env.id]()
+    agent = _create_agent(cfg, env.obs_space(), env.action_space())
+    sm = StateManager(TrainConfig, State, init_train_state, None)
+    sm._config = cfg
+    sm.set_deserialize_ctx("obs_space", agent.obs_space)
+    sm.set_deserialize_ctx("action_space", agent.action_space)
+    sm.set_deserialize_ctx("agent", agent)
+    sm.checkpoint_dir = checkpoint_dir
+    return sm
+
+
+def _fake_checkpoint(
+    monkeypatch: pytest.MonkeyPatch, delay: float
+) -> List[Dict[str, Any]]:
+    # Records the serialized agent instead of writing RON files
+    written: List[Dict[str, Any]] = []
+
+    def checkpoint(self: StateManager, target_dir: str) -> None:
+        time.sleep(delay)
+        assert isinstance(self.state.agent, hyperstate.Serializable)
+        written.append({"step": self.state.step, "agent": self.state.agent.serialize()})
+        Path(target_dir).mkdir()
+
+    monkeypatch.setattr(StateManager, "checkpoint", checkpoint)
+    return written
+
+
+def _checkpoints(path: Path) -> List[str]:
+    return sorted(p.name for p in path.iterdir())
+
+
+def test_async_checkpointer(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    written = _fake_checkpoint(monkeypatch, delay=0.5)
+    sm = _state_manager(tmp_path)
+    state = sm.state
+    expected = {k: v.clone() for k, v in state.agent.state_dict().items()}
+    checkpointer = Checkpointer(sm, keep=2, asynchronous=True)
+    assert sm.checkpoint_dir is None
+
+    state.step = 1
+    checkpointer.step()
+    # The checkpoint is written from a copy of the state
+    with torch.no_grad():
+        for p in state.agent.parameters():
+            p.zero_()
+    # Skipped while the first checkpoint is written
+    state.step = 2
+    checkpointer.step()
+    state.step = 3
+    checkpointer.step()
+    checkpointer.close()
+
+    assert [w["step"] for w in written] == [1, 3]
+    for name, tensor in expected.items():
+        assert torch.equal(written[0]["agent"][name], tensor), name
+    for p in state.agent.parameters():
+        assert torch.equal(p, torch.zeros_like(p))
+    assert _checkpoints(tmp_path) == [
+        "latest-step000000000001",
+        "latest-step000000000003",
+    ]
+    write_times = checkpointer.write_times()
+    assert len(write_times) == 2
+    assert all(t >= 0.5 for t in write_times)
+    assert checkpointer.write_times() == []
+
+
+def test_checkpointer_keep(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    _fake_checkpoint(monkeypatch, delay=0.0)
+    sm = _state_manager(tmp_path)
+    (tmp_path / "latest-step000000000000").mkdir()
+    (tmp_path / "other").mkdir()
+    checkpointer = Checkpointer(sm, keep=2)
+    for step in range(1, 5):
+        sm.state.step = step
+        checkpointer.step()
+        assert len(checkpointer.write_times()) == 1
+    assert _checkpoints(tmp_path) == [
+        "latest-step000000000003",
+        "latest-step000000000004",
+        "other",
+    ]
+    with pytest.raises(ValueError):
+        Checkpointer(sm, keep=0)
+
+
+def test_async_checkpointer_failed_write(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    def checkpoint(self: StateManager, target_dir: str) -> None:
+        time.sleep(0.2)
+        raise OSError("disk full")
+
+    monkeypatch.setattr(StateManager, "checkpoint", checkpoint)
+    sm = _state_manager(tmp_path)
+    checkpointer = Checkpointer(sm, asynchronous=True)
+    sm.state.step = 1
+    checkpointer.step()
+    sm.state.step = 2
+    checkpointer.step()
+    # The error of the pending write is raised and the background thread is stopped
+    with pytest.raises(OSError):
+        checkpointer.close()
+    assert checkpointer._executor is not None and checkpointer._executor._shutdown
+    with pytest.raises(TypeError):
+        _Snapshot.deserialize({}, sm.config, sm.state, {})
+
+
+def test_async_checkpointer_load(tmp_path: Path) -> None:
+    sm = _state_manager(tmp_path)
+    checkpointer = Checkpointer(sm, asynchronous=True)
+    sm.state.step = 1
+    checkpointer.step()
+    checkpointer.close()
+
+    net = load_rogue_net(str(tmp_path / "latest-step000000000001"))
+    for name, tensor in sm.state.agent.state_dict().items():
+        assert torch.equal(net.state_dict()[name], tensor), name
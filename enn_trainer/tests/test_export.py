@@ -0,0 +1,207 @@
+from pathlib import Path
+from typing import List, cast
+
+import numpy as np
+import pytest
+import torch
+from entity_gym.env import SelectEntityActionSpace
+from entity_gym.env.vec_env import batch_obs
+from entity_gym.examples import ENV_REGISTRY
+from entity_gym.simple_trace import Tracer
+from rogue_net.categorical_action_head import CategoricalActionHead
+from rogue_net.rogue_net import RogueNetConfig
+from rogue_net.select_entity_action_head import PaddedSelectEntityActionHead
+from rogue_net.transformer import Block, RaggedAttention
+
+from enn_trainer.agent import RogueNetAgent
+from enn_trainer.config import EnvConfig, OptimizerConfig, PPOConfig, RolloutConfig
+from enn_trainer.export import (
+    InferenceNet,
+    export_agent,
+    inference_inputs,
+    load_exported_agent,
+)
+from enn_trainer.train import TrainConfig, _create_agent
+
+
+@pytest.mark.parametrize(
+    "env_id", ["MultiSnake", "CherryPick", "MineSweeper", "Xor", "TreasureHunt"]
+)
+def test_inference_net(env_id: str) -> None:
+    cfg = TrainConfig(
+        env=EnvConfig(id=env_id),
+        net=RogueNetConfig(n_layer=2, d_model=16, n_head=2),
+        optim=OptimizerConfig(),
+        ppo=PPOConfig(),
+        rollout=RolloutConfig(),
+    )
+    env = ENV_REGISTRY[env_id]()
+    obs_space, action_space = env.obs_space(), env.action_space()
+    agent = _create_agent(cfg, obs_space, action_space)
+    net = InferenceNet(agent)
+    agent.eval()
+    tracer = Tracer(cuda=False)
+    obs = env.reset_filter(obs_space)
+    for _ in range(8):
+        vec_obs = batch_obs([obs], obs_space, action_space)
+        with torch.no_grad():
+            _, _, _, _, aux, logits = agent.get_action_and_auxiliary(
+                vec_obs.features, vec_obs.visible, vec_obs.action_masks, tracer
+            )
+            logprobs, values = net(*inference_inputs(vec_obs, obs_space, action_space))
+        for (name, space), logprob in zip(action_space.items(), logprobs):
+            expected = logits[name]
+            if isinstance(space, SelectEntityActionSpace):
+                expected = expected.squeeze(0)
+            if expected.numel() == 0:
+                assert logprob.numel() == 0
+                continue
+            np.testing.assert_allclose(
+                logprob.numpy(), expected.numpy(), rtol=1e-4, atol=1e-5
+            )
+        np.testing.assert_allclose(
+            values[0].numpy(), aux["value"].numpy(), rtol=1e-4, atol=1e-5
+        )
+        actions, _ = RogueNetAgent(agent).act(obs)
+        obs = env.act_filter(actions, obs_space)
+        if obs.done:
+            obs = env.reset_filter(obs_space)
+
+
+def test_export_and_load(tmp_path: Path) -> None:
+    cfg = TrainConfig(
+        env=EnvConfig(id="MineSweeper"),
+        net=RogueNetConfig(n_layer=1, d_model=16),
+        optim=OptimizerConfig(),
+        ppo=PPOConfig(),
+        rollout=RolloutConfig(),
+    )
+    env = ENV_REGISTRY[cfg.env.id]()
+    obs_space, action_space = env.obs_space(), env.action_space()
+    agent = _create_agent(cfg, obs_space, action_space)
+    state_dict = {k: v.clone() for k, v in agent.state_dict().items()}
+    path = str(tmp_path / "policy.pt")
+    export_agent(agent, path)
+    compiled = load_exported_agent(path)
+    assert compiled.obs_space == obs_space
+    assert compiled.action_space == action_space
+
+    # Exporting doesn't modify the agent
+    assert agent.training
+    for name, tensor in agent.state_dict().items():
+        assert torch.equal(tensor, state_dict[name]), name
+    agent.eval()
+
+    # The traced module generalizes to different numbers of entities and actors
+    reference = RogueNetAgent(agent)
+    obs = env.reset_filter(obs_space)
+    for _ in range(8):
+        vec_obs = batch_obs([obs], obs_space, action_space)
+        inputs = inference_inputs(vec_obs, obs_space, action_space)
+        with torch.no_grad():
+            expected, _ = InferenceNet(agent)(*inputs)
+            logprobs, _ = compiled.module(*inputs)
+        for x, y in zip(logprobs, expected):
+            np.testing.assert_allclose(x.numpy(), y.numpy(), rtol=1e-5, atol=1e-6)
+        actions, value = compiled.act(obs)
+        _, expected_value = reference.act(obs)
+        assert actions.keys() == action_space.keys()
+        assert value == pytest.approx(expected_value, rel=1e-4, abs=1e-5)
+        obs = env.act_filter(actions, obs_space)
+        if obs.done:
+            obs = env.reset_filter(obs_space)
+
+
+def test_unsupported_config() -> None:
+    cfg = TrainConfig(
+        env=EnvConfig(id="MultiSnake"),
+        net=RogueNetConfig(n_layer=1, d_model=16),
+        optim=OptimizerConfig(),
+        ppo=PPOConfig(),
+        rollout=RolloutConfig(),
+    )
+    env = ENV_REGISTRY[cfg.env.id]()
+    agent = _create_agent(cfg, env.obs_space(), env.action_space())
+    agent.obs_filter = {"Snake": np.array([0, 1])}
+    with pytest.raises(ValueError):
+        InferenceNet(agent)
+
+
+def test_onnx_export(tmp_path: Path) -> None:
+    onnx = pytest.importorskip("onnx")
+    onnxruntime = pytest.importorskip("onnxruntime")
+    cfg = TrainConfig(
+        env=EnvConfig(id="CherryPick"),
+        net=RogueNetConfig(n_layer=1, d_model=16),
+        optim=OptimizerConfig(),
+        ppo=PPOConfig(),
+        rollout=RolloutConfig(),
+    )
+    env = ENV_REGISTRY[cfg.env.id]()
+    obs_space, action_space = env.obs_space(), env.action_space()
+    agent = _create_agent(cfg, obs_space, action_space)
+    path = str(tmp_path / "policy.onnx")
+    export_agent(agent, path, format="onnx")
+    onnx.checker.check_model(onnx.load(path))
+
+    net = InferenceNet(agent)
+    session = onnxruntime.InferenceSession(path)
+    input_names = [i.name for i in session.get_inputs()]
+    obs = env.reset_filter(obs_space)
+    for _ in range(8):
+        vec_obs = batch_obs([obs], obs_space, action_space)
+        features, visible, actors, masks = inference_inputs(
+            vec_obs, obs_space, action_space
+        )
+        inputs = [t.numpy() for t in features + visible + actors + masks]
+        outputs = session.run(None, dict(zip(input_names, inputs)))
+        with torch.no_grad():
+            logprobs, values = net(features, visible, actors, masks)
+        for x, y in zip(outputs, logprobs + values):
+            np.testing.assert_allclose(x, y.numpy(), rtol=1e-4, atol=1e-5)
+        actions, _ = RogueNetAgent(agent).act(obs)
+        obs = env.act_filter(actions, obs_space)
+        if obs.done:
+            obs = env.reset_filter(obs_space)
+
+
+def test_rogue_net_layout() -> None:
+    # InferenceNet reimplements the forward pass of these modules from their parameters
+    modules: List[torch.nn.Module] = []
+    for env_id in ["TreasureHunt", "CherryPick"]:
+        cfg = TrainConfig(
+            env=EnvConfig(id=env_id),
+            net=RogueNetConfig(n_layer=1, d_model=16),
+            optim=OptimizerConfig(),
+            ppo=PPOConfig(),
+            rollout=RolloutConfig(),
+        )
+        env = ENV_REGISTRY[cfg.env.id]()
+        agent = _create_agent(cfg, env.obs_space(), env.action_space())
+        modules += list(agent.action_heads.values())
+        for block in cast(List[Block], agent.backbone.blocks):
+            attn = cast(RaggedAttention, block.attn)
+            modules += [block, attn]
+            assert isinstance(attn.n_head, int)
+    children = {
+        Block: {"ln1", "ln2", "attn", "mlp"},
+        RaggedAttention: {
+            "key",
+            "query",
+            "value",
+            "proj",
+            "attn_drop",
+            "resid_drop",
+        },
+        CategoricalActionHead: {"proj"},
+        PaddedSelectEntityActionHead: {"query_proj", "key_proj"},
+    }
+    assert {type(module) for module in modules} == set(children.keys())
+    for module in modules:
+        assert {name for name, _ in module.named_children()} == children[
+            type(module)
+        ], type(module)
+        # No parameters besides those of the submodules
+        assert len(list(module.parameters(recurse=False))) == 0
+        if isinstance(module, PaddedSelectEntityActionHead):
+            assert module.query_proj.out_features == module.d_qk
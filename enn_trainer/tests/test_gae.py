@@ -0,0 +1,77 @@
+import pytest
+import torch
+from entity_gym.examples import ENV_REGISTRY
+from entity_gym.simple_trace import Tracer
+from rogue_net.rogue_net import RogueNetConfig
+
+from enn_trainer.config import EnvConfig, OptimizerConfig, PPOConfig, RolloutConfig
+from enn_trainer.gae import (
+    _reference_returns_and_advantages,
+    compute_returns_and_advantages,
+    importance_log_ratios,
+)
+from enn_trainer.ppo import ActorLayout
+from enn_trainer.rollout import Rollout
+from enn_trainer.train import TrainConfig, _create_agent, _env_factory
+
+
+@pytest.mark.parametrize("gae", [True, False])
+@pytest.mark.parametrize("steps,num_envs", [(1, 4), (7, 3), (16, 32), (128, 256)])
+def test_returns_and_advantages_match_sequential(
+    gae: bool, steps: int, num_envs: int
+) -> None:
+    generator = torch.Generator().manual_seed(steps * num_envs)
+    rewards = torch.randn(steps, num_envs, generator=generator)
+    values = torch.randn(steps, num_envs, generator=generator)
+    dones = (torch.rand(steps, num_envs, generator=generator) < 0.1).float()
+    next_value = torch.randn(1, num_envs, generator=generator)
+    next_done = (torch.rand(num_envs, generator=generator) < 0.1).float()
+
+    expected = _reference_returns_and_advantages(
+        next_value, next_done, rewards, dones, values, gae, 0.99, 0.95
+    )
+    actual = compute_returns_and_advantages(
+        next_value, next_done, rewards, dones, values, gae, 0.99, 0.95
+    )
+    for e, a in zip(expected, actual):
+        assert torch.allclose(e, a, rtol=1e-5, atol=1e-5)
+
+
+def test_importance_log_ratios_freeze_normalization() -> None:
+    cfg = TrainConfig(
+        env=EnvConfig(id="MultiSnake"),
+        net=RogueNetConfig(n_layer=1, d_model=16),
+        optim=OptimizerConfig(),
+        ppo=PPOConfig(vtrace=True),
+        rollout=RolloutConfig(),
+    )
+    envs = _env_factory(ENV_REGISTRY[cfg.env.id])(cfg.env, 4, 1, 0)
+    obs_space, action_space = envs.obs_space(), envs.action_space()
+    agent = _create_agent(cfg, obs_space, action_space)
+    device = torch.device("cpu")
+    tracer = Tracer(cuda=False)
+    rollout = Rollout(envs, obs_space, action_space, agent, device, tracer)
+    rollout.run(8, record_samples=True, capture_logits=False)
+    buffers = {name: b.clone() for name, b in agent.named_buffers()}
+
+    log_rhos = importance_log_ratios(
+        agent,
+        rollout.entities,
+        rollout.visible,
+        rollout.action_masks,
+        rollout.actions,
+        ActorLayout.from_logprobs(rollout.logprobs.buffers, device),
+        rollout.values.numel(),
+        8,
+        device,
+        tracer,
+    )
+    rollout.close()
+    envs.close()
+
+    assert log_rhos.shape == (rollout.values.numel(),)
+    assert torch.isfinite(log_rhos).all()
+    # Normalization statistics are only updated by the rollout
+    assert agent.training
+    for name, buffer in agent.named_buffers():
+        assert torch.equal(buffer, buffers[name]), name
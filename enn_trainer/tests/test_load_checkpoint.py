@@ -0,0 +1,91 @@
+import os
+from pathlib import Path
+from typing import Tuple
+
+import msgpack
+import torch
+from entity_gym.examples import ENV_REGISTRY
+from hyperstate import StateManager, msgpack_torch
+from rogue_net.input_norm import InputNorm
+from rogue_net.rogue_net import RogueNetConfig
+
+from enn_trainer.config import EnvConfig, OptimizerConfig, PPOConfig, RolloutConfig
+from enn_trainer.load_checkpoint import load_rogue_net, mmap_state_dict
+from enn_trainer.train import (
+    SerializableRogueNet,
+    State,
+    TrainConfig,
+    _create_agent,
+    init_train_state,
+)
+
+
+def _agent() -> Tuple[TrainConfig, SerializableRogueNet]:
+    cfg = TrainConfig(
+        env=EnvConfig(id="MultiSnake"),
+        net=RogueNetConfig(n_layer=2, d_model=32),
+        optim=OptimizerConfig(),
+        ppo=PPOConfig(),
+        rollout=RolloutConfig(),
+    )
+    env = ENV_REGISTRY[cfg.env.id]()
+    return cfg, _create_agent(cfg, env.obs_space(), env.action_space())
+
+
+def test_mmap_state_dict(tmp_path: Path) -> None:
+    _, agent = _agent()
+    # Statistics of the input normalization
+    for module in agent.modules():
+        if isinstance(module, InputNorm):
+            module.update(torch.randn(16, module.mean.size(0)))
+    path = tmp_path / "state.agent.msgpack"
+    path.write_bytes(msgpack.packb(agent.serialize(), default=msgpack_torch.encode))
+
+    state_dict = mmap_state_dict(str(path))
+    expected = agent.state_dict()
+    assert list(state_dict.keys()) == list(expected.keys())
+    for name, tensor in expected.items():
+        assert state_dict[name].dtype == tensor.dtype
+        assert torch.equal(state_dict[name], tensor), name
+
+    # Tensors are copy-on-write
+    for tensor in state_dict.values():
+        tensor.zero_()
+    for name, tensor in mmap_state_dict(str(path)).items():
+        assert torch.equal(tensor, expected[name]), name
+
+
+def test_load_rogue_net(tmp_path: Path) -> None:
+    cfg, agent = _agent()
+    sm = StateManager(TrainConfig, State, init_train_state, None)
+    sm._config = cfg
+    sm.set_deserialize_ctx("obs_space", agent.obs_space)
+    sm.set_deserialize_ctx("action_space", agent.action_space)
+    sm.set_deserialize_ctx("agent", agent)
+    path = str(tmp_path / "checkpoint")
+    sm.checkpoint(path)
+
+    net = load_rogue_net(path)
+    for name, tensor in agent.state_dict().items():
+        assert torch.equal(net.state_dict()[name], tensor), name
+
+    # Networks loaded from the cache don't share parameters
+    other = load_rogue_net(path)
+    with torch.no_grad():
+        for p in net.parameters():
+            p.zero_()
+    for name, tensor in agent.state_dict().items():
+        assert torch.equal(other.state_dict()[name], tensor), name
+
+    # Modified checkpoints are reloaded
+    with torch.no_grad():
+        for p in agent.parameters():
+            p.add_(1.0)
+    sm.checkpoint(str(tmp_path / "modified"))
+    blob = Path(path) / "state.agent.msgpack"
+    os.replace(tmp_path / "modified" / "state.agent.msgpack", blob)
+    stat = os.stat(blob)
+    os.utime(blob, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    reloaded = load_rogue_net(path)
+    for name, tensor in agent.state_dict().items():
+        assert torch.equal(reloaded.state_dict()[name], tensor), name
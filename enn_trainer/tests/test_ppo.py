@@ -0,0 +1,103 @@
+from typing import List
+
+import numpy as np
+import numpy.typing as npt
+import pytest
+import torch
+from entity_gym.simple_trace import Tracer
+from ragged_buffer import RaggedBufferF32
+
+from enn_trainer.config import PPOConfig
+from enn_trainer.ppo import (
+    ActorLayout,
+    microbatches,
+    normalize_advantages,
+    padding_efficiency,
+    ppo_loss,
+)
+
+
+def test_actor_layout_matches_ragged_indexing() -> None:
+    counts = np.array([2, 0, 1, 3, 1, 2], dtype=np.int64)
+    logprobs = {
+        "multi": RaggedBufferF32.from_flattened(
+            np.random.randn(counts.sum(), 1).astype(np.float32), counts
+        ),
+        "single": RaggedBufferF32.from_flattened(
+            np.random.randn(len(counts), 1).astype(np.float32),
+            np.ones_like(counts),
+        ),
+    }
+    layout = ActorLayout.from_logprobs(logprobs, torch.device("cpu"))
+    assert not layout.one_actor_per_frame["multi"]
+    assert layout.one_actor_per_frame["single"]
+
+    inds = np.array([3, 0, 5, 1, 4], dtype=np.int64)
+    actors = layout.microbatch(inds, torch.tensor(inds))
+    for action_name, _logprobs in logprobs.items():
+        expected = _logprobs[inds]
+        assert np.array_equal(
+            actors.logprobs[action_name].numpy(), expected.as_array().flatten()
+        )
+        frame_index = actors.frame_index[action_name]
+        if frame_index is None:
+            frame_index = torch.arange(len(inds))
+        assert np.array_equal(
+            frame_index.numpy(), expected.indices(dim=0).as_array().flatten()
+        )
+
+
+def _minibatch_loss(
+    layout: ActorLayout,
+    advantages: torch.Tensor,
+    newlogprobs: torch.Tensor,
+    mbs: List[npt.NDArray[np.int64]],
+) -> torch.Tensor:
+    # Loss of a minibatch, accumulated over microbatches in the same way as the training loop
+    cfg = PPOConfig(norm_adv=True)
+    minibatch_inds = torch.tensor(np.concatenate(mbs))
+    minibatch_advantages = normalize_advantages(cfg, advantages[minibatch_inds])
+    loss = torch.tensor(0.0)
+    start = 0
+    for mb in mbs:
+        mb_slice = slice(start, start + len(mb))
+        actors = layout.microbatch(mb, minibatch_inds[mb_slice])
+        pg_loss, _ = ppo_loss(
+            cfg,
+            {"move": newlogprobs[minibatch_inds[mb_slice]]},
+            actors,
+            minibatch_advantages[mb_slice],
+            torch.device("cpu"),
+            Tracer(cuda=False),
+        )
+        loss += pg_loss * len(mb) / len(minibatch_inds)
+        start += len(mb)
+    return loss
+
+
+@pytest.mark.parametrize("max_entities,token_budget", [(20, 64), (40, 512), (100, 150)])
+def test_token_budget_microbatches(max_entities: int, token_budget: int) -> None:
+    entity_counts = np.random.randint(1, max_entities, size=256)
+    inds = np.random.permutation(256)[:100]
+    fixed = microbatches(inds, 10, entity_counts)
+    packed = microbatches(inds, 10, entity_counts, token_budget=token_budget)
+    for mbs in [fixed, packed]:
+        assert sorted(np.concatenate(mbs).tolist()) == sorted(inds.tolist())
+    for mb in packed:
+        assert len(mb) == 1 or len(mb) * entity_counts[mb].max() <= token_budget
+    assert padding_efficiency(packed, entity_counts) > padding_efficiency(
+        fixed, entity_counts
+    )
+
+    # The loss doesn't depend on the assignment of frames to microbatches, even if
+    # microbatches contain a single frame
+    logprobs = RaggedBufferF32.from_flattened(
+        np.random.randn(256, 1).astype(np.float32), np.ones(256, dtype=np.int64)
+    )
+    layout = ActorLayout.from_logprobs({"move": logprobs}, torch.device("cpu"))
+    advantages = torch.randn(256)
+    newlogprobs = layout.logprobs["move"] + 0.1 * torch.randn(256)
+    expected = _minibatch_loss(layout, advantages, newlogprobs, [inds])
+    for mbs in [fixed, packed]:
+        loss = _minibatch_loss(layout, advantages, newlogprobs, mbs)
+        assert torch.allclose(loss, expected, atol=1e-6)
@@ -0,0 +1,119 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+from entity_gym.examples import ENV_REGISTRY
+from entity_gym.serialization import Trace
+from entity_gym.serialization.sample_recorder import SampleRecordingVecEnv
+from entity_gym.simple_trace import Tracer
+from rogue_net.rogue_net import RogueNetConfig
+
+from enn_trainer.config import EnvConfig, OptimizerConfig, PPOConfig, RolloutConfig
+from enn_trainer.rollout import MultiAgentForward, Rollout
+from enn_trainer.train import TrainConfig, _create_agent, _env_factory
+
+
+def _cfg() -> TrainConfig:
+    return TrainConfig(
+        env=EnvConfig(id="MultiSnake"),
+        net=RogueNetConfig(n_layer=1, d_model=16),
+        optim=OptimizerConfig(),
+        ppo=PPOConfig(),
+        rollout=RolloutConfig(),
+    )
+
+
+@pytest.mark.parametrize("concurrent", [False, True])
+def test_multi_agent_forward(concurrent: bool) -> None:
+    cfg = _cfg()
+    envs = _env_factory(ENV_REGISTRY[cfg.env.id])(cfg.env, 6, 1, 0)
+    obs_space, action_space = envs.obs_space(), envs.action_space()
+    agent = _create_agent(cfg, obs_space, action_space)
+    opponent = _create_agent(cfg, obs_space, action_space)
+    # Freeze the input normalization so that repeated forward passes are identical
+    agent.eval()
+    opponent.eval()
+    env_indices = [np.array([4, 0, 2]), np.array([1, 5, 3])]
+    forward = MultiAgentForward(
+        [(env_indices[0], agent), (env_indices[1], opponent)],
+        6,
+        torch.device("cpu"),
+        concurrent=concurrent,
+    )
+    obs = envs.reset(obs_space)
+    tracer = Tracer(cuda=False)
+    with tracer.span("policy"):
+        actions, logprobs, logits = forward.forward(obs, tracer, capture_logits=True)
+    forward.close()
+    assert logits is not None
+    # Spans of the forward passes are recorded by the caller's tracer
+    spans = tracer.finish()
+    assert spans["policy.action_heads"] > 0
+
+    # Logits don't depend on the sampled actions
+    for indices, policy in zip(env_indices, [agent, opponent]):
+        _, _, _, _, _, expected_logits = policy.get_action_and_auxiliary(
+            {name: feats[indices] for name, feats in obs.features.items()},
+            {name: visible[indices] for name, visible in obs.visible.items()},
+            {name: mask[indices] for name, mask in obs.action_masks.items()},
+            tracer,
+        )
+        for name, value in expected_logits.items():
+            np.testing.assert_allclose(
+                logits[name][indices].as_array(),
+                value.squeeze(1).detach().numpy(),
+                rtol=1e-5,
+                atol=1e-6,
+            )
+        for name in actions.keys():
+            assert np.array_equal(
+                actions[name][indices].size1(),
+                obs.action_masks[name].actors[indices].size1(),
+            )
+            assert np.array_equal(
+                logprobs[name][indices].size1(), actions[name][indices].size1()
+            )
+    envs.close()
+
+
+def test_multi_agent_forward_requires_partition() -> None:
+    cfg = _cfg()
+    envs = _env_factory(ENV_REGISTRY[cfg.env.id])(cfg.env, 4, 1, 0)
+    agent = _create_agent(cfg, envs.obs_space(), envs.action_space())
+    with pytest.raises(ValueError):
+        MultiAgentForward(
+            [(np.array([0, 1]), agent), (np.array([1, 2]), agent)],
+            4,
+            torch.device("cpu"),
+        )
+    envs.close()
+
+
+def test_record_samples_against_opponent(tmp_path: Path) -> None:
+    cfg = _cfg()
+    envs = _env_factory(ENV_REGISTRY[cfg.env.id])(cfg.env, 4, 1, 0)
+    obs_space, action_space = envs.obs_space(), envs.action_space()
+    agent = _create_agent(cfg, obs_space, action_space)
+    opponent = _create_agent(cfg, obs_space, action_space)
+    path = tmp_path / "samples.blob"
+    recording_envs = SampleRecordingVecEnv(envs, str(path))
+    rollout = Rollout(
+        recording_envs,
+        obs_space=obs_space,
+        action_space=action_space,
+        agent=[(np.array([0, 2]), agent), (np.array([1, 3]), opponent)],
+        device=torch.device("cpu"),
+        tracer=Tracer(cuda=False),
+    )
+    rollout.run(8, record_samples=False, capture_logits=True)
+    rollout.close()
+    recording_envs.close()
+
+    trace = Trace.deserialize(path.read_bytes())
+    assert len(trace.samples) == 8
+    for sample in trace.samples:
+        assert sample.logits is not None
+        assert sample.probs.keys() == sample.actions.keys()
+        for name, probs in sample.probs.items():
+            assert np.array_equal(probs.size1(), sample.actions[name].size1())
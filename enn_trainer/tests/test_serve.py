@@ -0,0 +1,112 @@
+import asyncio
+import threading
+from typing import List, Tuple
+
+import numpy as np
+import pytest
+import torch
+from entity_gym.env import Observation
+from entity_gym.examples import ENV_REGISTRY
+from rogue_net.rogue_net import RogueNet, RogueNetConfig
+
+from enn_trainer.agent import RogueNetAgent
+from enn_trainer.config import EnvConfig, OptimizerConfig, PPOConfig, RolloutConfig
+from enn_trainer.serve import BatchingAgent
+from enn_trainer.train import TrainConfig, _create_agent
+
+
+def _setup(env_id: str, nobs: int) -> Tuple[RogueNet, List[Observation]]:
+    cfg = TrainConfig(
+        env=EnvConfig(id=env_id),
+        net=RogueNetConfig(n_layer=1, d_model=16),
+        optim=OptimizerConfig(),
+        ppo=PPOConfig(),
+        rollout=RolloutConfig(),
+    )
+    env = ENV_REGISTRY[env_id]()
+    obs_space = env.obs_space()
+    agent = _create_agent(cfg, obs_space, env.action_space())
+    # Observations with different numbers of entities and actors
+    observations = []
+    obs = env.reset_filter(obs_space)
+    for _ in range(nobs):
+        observations.append(obs)
+        actions, _ = RogueNetAgent(agent).act(obs)
+        obs = env.act_filter(actions, obs_space)
+        if obs.done:
+            obs = env.reset_filter(obs_space)
+    return agent, observations
+
+
+@pytest.mark.parametrize("env_id", ["MultiSnake", "CherryPick", "MineSweeper", "Xor"])
+def test_batching_agent(env_id: str) -> None:
+    agent, observations = _setup(env_id, 16)
+    reference = RogueNetAgent(agent)
+    results: List = [None] * len(observations)
+    barrier = threading.Barrier(len(observations))
+    buffers = {name: b.clone() for name, b in agent.named_buffers()}
+
+    with BatchingAgent(agent, max_batch_size=8, max_delay_ms=50) as server:
+
+        def request(i: int) -> None:
+            barrier.wait()
+            results[i] = server.act(observations[i])
+
+        threads = [
+            threading.Thread(target=request, args=(i,))
+            for i in range(len(observations))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = server.stats()
+
+    assert stats.requests == len(observations)
+    assert sum(size * count for size, count in stats.batch_sizes.items()) == 16
+    assert max(stats.batch_sizes) <= 8
+    # All requests arrive at once, so at least one batch contains several requests
+    assert max(stats.batch_sizes) > 1
+    assert 0 < stats.latency_p50_ms <= stats.latency_p99_ms
+    # Serving doesn't update the input normalization
+    assert not agent.training
+    for name, b in agent.named_buffers():
+        assert torch.equal(b, buffers[name]), name
+    for obs, (actions, value) in zip(observations, results):
+        expected_actions, expected_value = reference.act(obs)
+        assert value == pytest.approx(expected_value, rel=1e-4, abs=1e-5)
+        assert actions.keys() == expected_actions.keys()
+        for name, action in actions.items():
+            expected = expected_actions[name]
+            assert type(action) == type(expected)
+            np.testing.assert_allclose(
+                np.asarray(action.probs),
+                np.asarray(expected.probs),
+                rtol=1e-4,
+                atol=1e-5,
+            )
+
+
+def test_batching_agent_async() -> None:
+    agent, observations = _setup("MultiSnake", 8)
+
+    async def run(server: BatchingAgent) -> list:
+        return await asyncio.gather(*[server.act_async(obs) for obs in observations])
+
+    with BatchingAgent(agent, max_batch_size=64, max_delay_ms=50) as server:
+        results = asyncio.run(run(server))
+        stats = server.stats()
+    assert len(results) == len(observations)
+    assert stats.batch_sizes == {8: 1}
+    with pytest.raises(RuntimeError):
+        server.act(observations[0])
+
+
+def test_batching_agent_error() -> None:
+    agent, observations = _setup("MultiSnake", 1)
+    _, other = _setup("CherryPick", 1)
+    with BatchingAgent(agent) as server:
+        with pytest.raises(Exception):
+            server.act(other[0])
+        # The server keeps serving after a failed batch
+        server.act(observations[0])
@@ -0,0 +1,314 @@
+import math
+import os
+from pathlib import Path
+from typing import Any, List, Tuple
+
+import numpy as np
+import numpy.typing as npt
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from entity_gym.examples import ENV_REGISTRY
+from entity_gym.simple_trace import Tracer
+from hyperstate import StateManager
+from rogue_net.rogue_net import RogueNet, RogueNetConfig
+
+from enn_trainer import supervised
+from enn_trainer.config import RolloutConfig
+from enn_trainer.dataset_cache import _SplitWriter, dataset_cache_path
+from enn_trainer.trace_reader import MappedTrace
+from enn_trainer.train import (
+    EnvConfig,
+    OptimizerConfig,
+    PPOConfig,
+    State,
+    TrainConfig,
+    init_train_state,
+    train,
+)
+
+
+def _record_trace(path: Path, env_id: str, capture_logits: bool) -> None:
+    cfg = TrainConfig(
+        total_timesteps=2048,
+        cuda=False,
+        ppo=PPOConfig(),
+        env=EnvConfig(id=env_id),
+        rollout=RolloutConfig(steps=16, num_envs=16),
+        net=RogueNetConfig(n_layer=1, d_model=16),
+        optim=OptimizerConfig(bs=256),
+        capture_samples=str(path),
+        capture_logits=capture_logits,
+    )
+    sm = StateManager(TrainConfig, State, init_train_state, None)
+    sm._config = cfg
+    train(sm, ENV_REGISTRY[cfg.env.id])
+
+
+def _assert_ragged_equal(x: Any, y: Any) -> None:
+    if hasattr(x, "as_array"):
+        np.testing.assert_equal(x.as_array(), y.as_array())
+        np.testing.assert_equal(x.size1(), y.size1())
+    elif x is None:
+        assert y is None
+    else:
+        # Action masks
+        for field in vars(x):
+            _assert_ragged_equal(getattr(x, field), getattr(y, field))
+
+
+def _assert_batches_equal(a: Tuple[Any, ...], b: Tuple[Any, ...]) -> None:
+    for x, y in zip(a, b):
+        if x is None:
+            assert y is None
+            continue
+        assert x.keys() == y.keys()
+        for key in x.keys():
+            _assert_ragged_equal(x[key], y[key])
+
+
+# Logits of select entity actions have a different size for each frame and can't be merged
+@pytest.mark.parametrize(
+    "env_id,capture_logits", [("CherryPick", False), ("MultiSnake", True)]
+)
+def test_streaming_and_cached_dataset(
+    tmp_path: Path, env_id: str, capture_logits: bool
+) -> None:
+    path = tmp_path / "samples.blob"
+    _record_trace(path, env_id, capture_logits)
+    trace, trainds, testds = supervised.load_dataset(str(path), batch_size=64)
+    cache_dir = tmp_path / "cache"
+    for kwargs in [
+        dict(streaming=True),
+        dict(cache_dir=str(cache_dir)),
+        # Loads the existing cache
+        dict(cache_dir=str(cache_dir)),
+    ]:
+        other_trace, other_trainds, other_testds = supervised.load_dataset(
+            str(path), batch_size=64, **kwargs  # type: ignore
+        )
+        assert len(other_trace.samples) == 0
+        assert other_trace.obs_space == trace.obs_space
+        assert other_trace.action_space == trace.action_space
+        for ds, other_ds in [(trainds, other_trainds), (testds, other_testds)]:
+            assert (other_ds.frames, other_ds.nbatch) == (ds.frames, ds.nbatch)
+            ds.permutation = None
+            for n in range(ds.nbatch):
+                _assert_batches_equal(ds.batch(n), other_ds.batch(n))
+
+        other_trainds.shuffle()
+        assert other_trainds.permutation is not None
+        assert sorted(other_trainds.permutation) == list(
+            range(len(other_trainds.permutation))
+        )
+        trainds.permutation = other_trainds.permutation
+        for n in range(trainds.nbatch):
+            _assert_batches_equal(trainds.batch(n), other_trainds.batch(n))
+    assert len(list(cache_dir.iterdir())) == 1
+
+
+def test_dataset_cache(tmp_path: Path) -> None:
+    path = tmp_path / "samples.blob"
+    _record_trace(path, "MultiSnake", capture_logits=False)
+    cache_path = dataset_cache_path(str(tmp_path), str(path))
+    assert dataset_cache_path(str(tmp_path), str(path)) == cache_path
+    # Modified datasets are cached separately
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert dataset_cache_path(str(tmp_path), str(path)) != cache_path
+
+    trace = MappedTrace(str(path))
+    writer = _SplitWriter(str(tmp_path), "train")
+    writer.push_sample(trace.sample(0))
+    sample = trace.sample(1)
+    del sample.obs.features[next(iter(sample.obs.features))]
+    with pytest.raises(ValueError):
+        writer.push_sample(sample)
+    writer.close()
+    trace.close()
+
+
+def test_streaming_dataset_decodes_samples_once(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    path = tmp_path / "samples.blob"
+    _record_trace(path, "MultiSnake", capture_logits=True)
+    _, trainds, _ = supervised.load_dataset(str(path), batch_size=40)
+    _, streaming_trainds, _ = supervised.load_dataset(
+        str(path), batch_size=40, streaming=True
+    )
+    assert isinstance(streaming_trainds, supervised.StreamingDataSet)
+    # Batches contain the frames of several windows of 3 samples with 16 frames each
+    streaming_trainds.shuffle_window = 3
+    decoded: List[int] = []
+    trace = streaming_trainds.trace
+    decode = trace.sample
+
+    def sample(i: int) -> Any:
+        decoded.append(i)
+        return decode(i)
+
+    monkeypatch.setattr(trace, "sample", sample)
+
+    streaming_trainds.shuffle()
+    trainds.permutation = streaming_trainds.permutation
+    for n in range(trainds.nbatch):
+        _assert_batches_equal(trainds.batch(n), streaming_trainds.batch(n))
+    assert len(decoded) == len(set(decoded))
+
+
+def test_prefetch(tmp_path: Path) -> None:
+    path = tmp_path / "samples.blob"
+    _record_trace(path, "MultiSnake", capture_logits=True)
+    params = []
+    for prefetch_batches in [0, 3]:
+        torch.manual_seed(0)
+        np.random.seed(0)
+        trace, trainds, testds = supervised.load_dataset(str(path), batch_size=64)
+        cfg = supervised.Config(
+            optim=supervised.OptimizerConfig(batch_size=64),
+            wandb=supervised.WandbConfig(),
+            model=RogueNetConfig(n_layer=1, d_model=16),
+            dataset_path=str(path),
+            epochs=1,
+            loss_fn="kl",
+            fast_eval_samples=64,
+            prefetch_batches=prefetch_batches,
+        )
+        model = RogueNet(
+            cfg.model, obs_space=trace.obs_space, action_space=trace.action_space
+        )
+        supervised.train(cfg, model, trainds, testds, torch.device("cpu"))
+        params.append(torch.cat([p.detach().view(-1) for p in model.parameters()]))
+    assert torch.equal(params[0], params[1])
+
+
+def test_sharded_dataset(tmp_path: Path) -> None:
+    path = tmp_path / "samples.blob"
+    _record_trace(path, "MultiSnake", capture_logits=True)
+    _, trainds, _ = supervised.load_dataset(str(path), batch_size=64)
+    trainds.shuffle()
+    shards = [supervised.ShardedDataSet(trainds, rank, 3) for rank in range(3)]
+    for n in range(trainds.nbatch):
+        indices = [shard.batch_indices(n) for shard in shards]
+        assert sum(len(i) for i in indices) == 64
+        np.testing.assert_equal(np.concatenate(indices), trainds.batch_indices(n))
+        _assert_batches_equal(shards[1].batch(n), trainds.gather(indices[1]))
+
+
+def _data_parallel_worker(rank: int, world_size: int, tmp_path: Path) -> None:
+    dist.init_process_group(
+        "gloo",
+        init_method=f"file://{tmp_path / 'init'}",
+        rank=rank,
+        world_size=world_size,
+    )
+    # Different seeds on each process, the model and order of batches are synchronized
+    torch.manual_seed(rank)
+    np.random.seed(rank)
+    path = tmp_path / "samples.blob"
+    trace, trainds, testds = supervised.load_dataset(str(path), batch_size=64)
+    testds.deterministic_shuffle()
+    cfg = supervised.Config(
+        optim=supervised.OptimizerConfig(batch_size=64),
+        wandb=supervised.WandbConfig(),
+        model=RogueNetConfig(n_layer=1, d_model=16),
+        dataset_path=str(path),
+        epochs=1,
+        loss_fn="kl",
+        fast_eval_samples=64,
+    )
+    model = RogueNet(
+        cfg.model, obs_space=trace.obs_space, action_space=trace.action_space
+    )
+    supervised.train(cfg, model, trainds, testds, torch.device("cpu"))
+    torch.save(
+        torch.cat([p.detach().view(-1) for p in model.parameters()]),
+        tmp_path / f"params{rank}.pt",
+    )
+    torch.save(
+        torch.cat([b.detach().view(-1).float() for b in model.buffers()]),
+        tmp_path / f"buffers{rank}.pt",
+    )
+    dist.destroy_process_group()
+
+
+def test_data_parallel(tmp_path: Path) -> None:
+    _record_trace(tmp_path / "samples.blob", "MultiSnake", capture_logits=True)
+    world_size = 2
+    mp.spawn(_data_parallel_worker, args=(world_size, tmp_path), nprocs=world_size)
+    params = [torch.load(tmp_path / f"params{rank}.pt") for rank in range(world_size)]
+    assert torch.equal(params[0], params[1])
+    buffers = [torch.load(tmp_path / f"buffers{rank}.pt") for rank in range(world_size)]
+    assert torch.equal(buffers[0], buffers[1])
+
+
+def _loop_deterministic_permutation(n: int) -> npt.NDArray[np.int64]:
+    stepsize = int(math.sqrt(n))
+    perm = np.zeros(n, dtype=np.int64)
+    index = 0
+    offset = 0
+    for i in range(n):
+        perm[i] = index
+        index += stepsize
+        if index >= n:
+            offset += 1
+            index = offset
+    return perm
+
+
+@pytest.mark.parametrize("n", [0, 1, 2, 3, 4, 10, 99, 100, 101, 4097, 12345])
+def test_deterministic_permutation(n: int) -> None:
+    np.testing.assert_equal(
+        supervised.deterministic_permutation(n), _loop_deterministic_permutation(n)
+    )
+
+
+@pytest.mark.parametrize("n,block_size", [(0, 4), (10, 1), (100, 8), (101, 8)])
+def test_block_permutation(n: int, block_size: int) -> None:
+    perm = supervised.block_permutation(n, block_size)
+    assert sorted(perm) == list(range(n))
+    # Frames within a block stay in order
+    for prev, curr in zip(perm[:-1], perm[1:]):
+        assert curr % block_size == 0 or curr == prev + 1
+
+
+def test_fast_eval(tmp_path: Path) -> None:
+    path = tmp_path / "samples.blob"
+    _record_trace(path, "MultiSnake", capture_logits=True)
+    trace, _, testds = supervised.load_dataset(str(path), batch_size=64)
+    testds.deterministic_shuffle()
+    model = RogueNet(
+        RogueNetConfig(n_layer=1, d_model=16),
+        obs_space=trace.obs_space,
+        action_space=trace.action_space,
+    )
+    device = torch.device("cpu")
+    tracer = Tracer(cuda=False)
+    # Collect normalization statistics
+    model.train()
+    supervised.compute_loss(
+        model, supervised.load_batch(testds, 0), "kl", tracer, device
+    )
+    state = {k: v.clone() for k, v in model.state_dict().items()}
+
+    fast_eval = supervised.FastEval(testds, 3 * 64, batch_size=128, device=device)
+    assert fast_eval.batch_frames == [128, 64]
+    loss = fast_eval.run(model, "kl", tracer, device)
+
+    # Evaluation doesn't change the model or its mode
+    assert model.training
+    for k, v in model.state_dict().items():
+        assert torch.equal(v, state[k]), k
+    model.eval()
+    with torch.no_grad():
+        expected = np.mean(
+            [
+                supervised.compute_loss(
+                    model, supervised.load_batch(testds, n), "kl", tracer, device
+                )[0].item()
+                for n in range(3)
+            ]
+        )
+    assert loss == pytest.approx(expected, rel=1e-5)
@@ -66,6 +66,38 @@ def test_multi_snake() -> None:
     assert meanrew >= 0.0
 
 
+def test_shared_memory_env() -> None:
+    cfg = TrainConfig(
+        total_timesteps=256,
+        cuda=False,
+        net=RogueNetConfig(d_model=16),
+        env=EnvConfig(id="MultiSnake"),
+        rollout=RolloutConfig(steps=16, num_envs=4, processes=2, shared_memory_mb=1),
+        optim=OptimizerConfig(bs=64),
+        ppo=PPOConfig(),
+    )
+    meanrew = _train(cfg)
+    print(f"Final mean reward: {meanrew}")
+    assert meanrew >= 0.0
+
+
+def test_asynchronous_rollouts() -> None:
+    cfg = TrainConfig(
+        total_timesteps=2000,
+        cuda=False,
+        net=RogueNetConfig(d_model=16, n_layer=1),
+        env=EnvConfig(id="NotHotdog"),
+        rollout=RolloutConfig(
+            steps=16, num_envs=8, asynchronous=True, max_policy_lag=2
+        ),
+        optim=OptimizerConfig(bs=16, lr=0.005),
+        ppo=PPOConfig(ent_coef=0.0, gamma=0.5, vtrace=True),
+    )
+    meanrew = _train(cfg)
+    print(f"Final mean reward: {meanrew}")
+    assert meanrew >= 0.9
+
+
 def test_not_hotdog() -> None:
     cfg = TrainConfig(
         total_timesteps=1000,
@@ -81,6 +113,21 @@ def test_not_hotdog() -> None:
     assert meanrew >= 0.99
 
 
+def test_bf16_precision() -> None:
+    cfg = TrainConfig(
+        total_timesteps=1000,
+        cuda=False,
+        net=RogueNetConfig(d_model=16, n_layer=1),
+        env=EnvConfig(id="NotHotdog"),
+        rollout=RolloutConfig(steps=16, num_envs=8),
+        optim=OptimizerConfig(bs=16, lr=0.005, precision="bf16"),
+        ppo=PPOConfig(ent_coef=0.0, gamma=0.5),
+    )
+    meanrew = _train(cfg)
+    print(f"Final mean reward: {meanrew}")
+    assert meanrew >= 0.99
+
+
 def test_masked_count() -> None:
     cfg = TrainConfig(
         total_timesteps=2000,
@@ -0,0 +1,125 @@
+import mmap
+from typing import Any, Dict, List, Tuple
+
+import msgpack
+import msgpack_numpy
+import numpy as np
+import numpy.typing as npt
+import tqdm
+from entity_gym.env import ActionSpace, ObsSpace
+from entity_gym.serialization.msgpack_ragged import ragged_buffer_decode
+from entity_gym.serialization.sample_recorder import Sample
+
+
+class MappedTrace:
+    """
+    Memory-mapped trace of samples recorded with ``SampleRecordingVecEnv``.
+
+    On construction, the file is scanned once to index the byte offset of each sample
+    and the episode ids of its frames. Only the (small) episode ids are decoded during
+    indexing, observations and actions are decoded on demand by :meth:`sample`. The
+    operating system pages in the parts of the file that are accessed, so traces much
+    larger than memory can be read.
+
+    :param header: The serialized header of the trace, see :func:`decode_header`.
+    :param offsets: Byte offset of each serialized sample.
+    :param sizes: Size in bytes of each serialized sample.
+    :param episodes: Episode ids of the frames of each sample.
+    :param sample_frames: Number of frames in each sample.
+    """
+
+    def __init__(self, path: str, progress_bar: bool = False) -> None:
+        self.path = path
+        self._file = open(path, "rb")
+        self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        version = int(np.frombuffer(self.data[:8], dtype=np.uint64)[0])
+        assert version == 0 or version == 1
+        header_len = int(np.frombuffer(self.data[8:16], dtype=np.uint64)[0])
+        self.header = self.data[16 : 16 + header_len]
+        self.action_space, self.obs_space, self.subsample = decode_header(self.header)
+
+        if progress_bar:
+            pbar = tqdm.tqdm(total=len(self.data))
+        offsets = []
+        sizes = []
+        self.episodes: List[npt.NDArray[np.int64]] = []
+        offset = 16 + header_len
+        while offset < len(self.data):
+            size = int(
+                np.frombuffer(self.data[offset : offset + 8], dtype=np.uint64)[0]
+            )
+            offset += 8
+            offsets.append(offset)
+            sizes.append(size)
+            self.episodes.append(_read_episodes(self.data[offset : offset + size]))
+            offset += size
+            if progress_bar:
+                pbar.update(size + 8)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.sizes = np.array(sizes, dtype=np.int64)
+        self.sample_frames = np.array([len(e) for e in self.episodes], dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def sample(self, i: int) -> Sample:
+        start = self.offsets[i]
+        return Sample.deserialize(self.data[start : start + self.sizes[i]])
+
+    def train_test_split(
+        self, test_frac: float = 0.1
+    ) -> Tuple[npt.NDArray[np.int64], npt.NDArray[np.int64]]:
+        """
+        Splits the samples the same way as ``Trace.train_test_split``, returning the indices
+        of the train and test samples.
+        The first samples up to ``test_frac`` of all frames are used for testing, samples
+        that share an episode with any test sample are excluded from the training set.
+        """
+        if self.subsample == 1:
+            total_frames = len(self) * self.sample_frames[0]
+        else:
+            total_frames = self.sample_frames.sum()
+        test_frames = 0
+        i = 0
+        while test_frames < total_frames * test_frac:
+            test_frames += self.sample_frames[i]
+            i += 1
+        test_episodes = np.unique(
+            np.concatenate(self.episodes[:i] + [np.zeros(0, dtype=np.int64)])
+        )
+        train = [
+            j
+            for j in range(i, len(self))
+            if not np.isin(self.episodes[j], test_episodes).any()
+        ]
+        return np.array(train, dtype=np.int64), np.arange(i, dtype=np.int64)
+
+    def close(self) -> None:
+        self.data.close()
+        self._file.close()
+
+
+def decode_header(header: bytes) -> Tuple[Dict[str, ActionSpace], ObsSpace, int]:
+    """
+    Decodes the header of a trace, returning the action space, observation space, and
+    subsampling rate of the recorded samples.
+    """
+    data = msgpack_numpy.loads(
+        header, object_hook=ragged_buffer_decode, strict_map_key=False
+    )
+    return data["act_space"], data["obs_space"], data.get("subsample", 1)
+
+
+def _read_episodes(data: Any) -> npt.NDArray[np.int64]:
+    # Reads only the episode ids of a serialized sample and skips over all other fields
+    unpacker = msgpack.Unpacker(
+        raw=False, strict_map_key=False, max_buffer_size=max(len(data), 1024 * 1024)
+    )
+    unpacker.feed(data)
+    for _ in range(unpacker.read_map_header()):
+        key = unpacker.unpack()
+        if key == "episode":
+            return np.array(unpacker.unpack(), dtype=np.int64)
+        unpacker.skip()
+    raise ValueError("Sample does not contain episode ids")
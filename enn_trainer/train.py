@@ -27,11 +27,27 @@ from rogue_net.rogue_net import RogueNet
 from torch.utils.tensorboard import SummaryWriter
 
 from enn_trainer.agent import PPOAgent
+from enn_trainer.allreduce import GradientAllreduce
+from enn_trainer.checkpoint import Checkpointer
 from enn_trainer.config import *
-from enn_trainer.eval import allgather, run_eval
-from enn_trainer.gae import returns_and_advantages
-from enn_trainer.ppo import ppo_loss, value_loss
-from enn_trainer.rollout import Rollout
+from enn_trainer.eval import MetricReducer, run_eval
+from enn_trainer.gae import (
+    importance_log_ratios,
+    returns_and_advantages,
+    vtrace_returns_and_advantages,
+)
+from enn_trainer.ppo import (
+    ActorLayout,
+    PPOStats,
+    microbatches,
+    normalize_advantages,
+    padding_efficiency,
+    ppo_loss,
+    value_loss,
+)
+from enn_trainer.precision import autocast, check_precision, grad_scaler
+from enn_trainer.rollout import AsyncRollout, Rollout, RolloutBatch
+from enn_trainer.shared_memory_env import SharedMemoryEnvList
 
 EnvFactory = Callable[[EnvConfig, int, int, int], VecEnv]
 
@@ -74,6 +90,7 @@ class SerializableAdamW(optim.AdamW, hyperstate.Serializable):
 
 def _env_factory(
     env_cls: Type[Environment],
+    shared_memory_mb: Optional[float] = None,
 ) -> Callable[[EnvConfig, int, int, int], VecEnv]:
     def _create_env(
         cfg: EnvConfig, num_envs: int, processes: int, first_env_index: int
@@ -83,7 +100,11 @@ def _env_factory(
             create_env = lambda: ValidatingEnv(env_cls(**kwargs))
         else:
             create_env = lambda: env_cls(**kwargs)  # type: ignore
-        if processes > 1:
+        if processes > 1 and shared_memory_mb is not None:
+            return SharedMemoryEnvList(
+                create_env, num_envs, processes, capacity_mb=shared_memory_mb
+            )
+        elif processes > 1:
             return ParallelEnvList(create_env, num_envs, processes)
         else:
             return EnvList(create_env, num_envs)
@@ -105,13 +126,9 @@ def load_rogue_net_opponent(
             regression_heads={"value": 1},
         ).to(device)
     else:
-        return StateManager(
-            TrainConfig,
-            State,
-            init_train_state,
-            init_path=path,
-            ignore_extra_fields=True,
-        ).state.agent.to(device)
+        from enn_trainer.load_checkpoint import load_rogue_net
+
+        return load_rogue_net(path, device)
 
 
 @dataclass
@@ -175,6 +192,7 @@ def train(
     cuda = torch.cuda.is_available() and cfg.cuda
     device = torch.device("cuda" if cuda else "cpu")
 
+    check_precision(cfg.optim.precision, device)
     assert cfg.rollout.num_envs * cfg.rollout.steps >= cfg.optim.bs, (
         "Number of frames per rollout is smaller than batch size: "
         f"{cfg.rollout.num_envs} * {cfg.rollout.steps} < {cfg.optim.bs}"
@@ -230,7 +248,7 @@ def train(
     torch.backends.cudnn.deterministic = cfg.torch_deterministic
 
     if inspect.isclass(env) and issubclass(env, Environment):
-        create_env: EnvFactory = _env_factory(env)
+        create_env: EnvFactory = _env_factory(env, cfg.rollout.shared_memory_mb)
     else:
         create_env = env  # type: ignore
     envs: VecEnv = AddMetricsWrapper(
@@ -250,6 +268,9 @@ def train(
     state = state_manager.state
     if rank != 0:
         state_manager.checkpoint_dir = None
+    checkpointer = Checkpointer(
+        state_manager, keep=cfg.checkpoint_keep, asynchronous=cfg.checkpoint_async
+    )
     if state.step > 0:
         state.restart += 1
     agent = state.agent.to(device)
@@ -258,6 +279,7 @@ def train(
     if value_function is not None:
         value_function = value_function.to(device)
     vf_optimizer = state.vf_optimizer
+    scaler = grad_scaler(cfg.optim.precision)
 
     tracer = Tracer(cuda=cuda)
 
@@ -268,15 +290,42 @@ def train(
             sample_file = os.path.join(out_dir, cfg.capture_samples)
         envs = SampleRecordingVecEnv(envs, sample_file, cfg.capture_samples_subsample)
 
-    rollout = Rollout(
-        envs,
-        obs_space=obs_space,
-        action_space=action_space,
-        agent=agent,
-        value_function=value_function,
-        device=device,
-        tracer=tracer,
-    )
+    async_rollout: Optional[AsyncRollout] = None
+    if cfg.rollout.asynchronous:
+        async_rollout = AsyncRollout(
+            envs,
+            obs_space=obs_space,
+            action_space=action_space,
+            agent=agent,
+            value_function=value_function,
+            device=device,
+            cuda=cuda,
+            max_policy_lag=cfg.rollout.max_policy_lag,
+            precision=cfg.optim.precision,
+        )
+        rollout = async_rollout.current
+    else:
+        rollout = Rollout(
+            envs,
+            obs_space=obs_space,
+            action_space=action_space,
+            agent=agent,
+            value_function=value_function,
+            device=device,
+            tracer=tracer,
+            precision=cfg.optim.precision,
+        )
+
+    agent_allreduce: Optional[GradientAllreduce] = None
+    vf_allreduce: Optional[GradientAllreduce] = None
+    if parallelism > 1:
+        agent_allreduce = GradientAllreduce(
+            agent, cfg.optim.allreduce_bucket_mb, cfg.optim.allreduce_fp16
+        )
+        if value_function is not None:
+            vf_allreduce = GradientAllreduce(
+                value_function, cfg.optim.allreduce_bucket_mb, cfg.optim.allreduce_fp16
+            )
 
     if rank == 0:
         if cfg.track:
@@ -333,324 +382,443 @@ def train(
                     rollout.global_step * parallelism,
                     rank,
                     parallelism,
+                    eval_metric_reducer,
                 )
 
+    metric_reducer = MetricReducer()
+    eval_metric_reducer = MetricReducer()
     start_time = time.time()
     num_updates = cfg.total_timesteps // (cfg.rollout.num_envs * cfg.rollout.steps)
     initial_step = state.step
-    for update in range(
-        1 + initial_step // (cfg.rollout.num_envs * cfg.rollout.steps), num_updates + 1
-    ):
-        if (
-            cfg.eval is not None
-            and state.next_eval_step is not None
-            and rollout.global_step * parallelism >= state.next_eval_step
+    if async_rollout is not None:
+        async_rollout.start(cfg.rollout.steps, capture_logits=cfg.capture_logits)
+    try:
+        for update in range(
+            1 + initial_step // (cfg.rollout.num_envs * cfg.rollout.steps),
+            num_updates + 1,
         ):
-            state.next_eval_step += cfg.eval.interval
-            _run_eval()
+            if (
+                cfg.eval is not None
+                and state.next_eval_step is not None
+                and rollout.global_step * parallelism >= state.next_eval_step
+            ):
+                state.next_eval_step += cfg.eval.interval
+                _run_eval()
+
+            tracer.start("update")
+            if (
+                cfg.max_train_time is not None
+                and time.time() - start_time >= cfg.max_train_time
+            ):
+                print("Max train time reached, stopping training.")
+                break
+
+            # Annealing the rate if instructed to do so.
+            if cfg.optim.anneal_lr:
+                frac = 1.0 - (update - 1.0) / num_updates
+                if cfg.max_train_time is not None:
+                    frac = min(
+                        frac,
+                        max(0, 1.0 - (time.time() - start_time) / cfg.max_train_time),
+                    )
+                lrnow = frac * cfg.optim.lr
+                optimizer.param_groups[0]["lr"] = lrnow
+                if vf_optimizer is not None:
+                    vf_optimizer.param_groups[0]["lr"] = lrnow
 
-        tracer.start("update")
-        if (
-            cfg.max_train_time is not None
-            and time.time() - start_time >= cfg.max_train_time
-        ):
-            print("Max train time reached, stopping training.")
-            break
-
-        # Annealing the rate if instructed to do so.
-        if cfg.optim.anneal_lr:
-            frac = 1.0 - (update - 1.0) / num_updates
-            if cfg.max_train_time is not None:
-                frac = min(
-                    frac, max(0, 1.0 - (time.time() - start_time) / cfg.max_train_time)
-                )
-            lrnow = frac * cfg.optim.lr
-            optimizer.param_groups[0]["lr"] = lrnow
-            if vf_optimizer is not None:
-                vf_optimizer.param_groups[0]["lr"] = lrnow
+            tracer.start("rollout")
 
-        tracer.start("rollout")
+            if async_rollout is None:
+                next_obs, next_done, metrics = rollout.run(
+                    cfg.rollout.steps,
+                    record_samples=True,
+                    capture_logits=cfg.capture_logits,
+                )
+            else:
+                with tracer.span("wait"):
+                    rollout, next_obs, next_done, metrics = async_rollout.wait()
+                # Collect the next batch with the policy snapshot while optimizing on this one
+                if update < num_updates:
+                    async_rollout.start(
+                        cfg.rollout.steps, capture_logits=cfg.capture_logits
+                    )
 
-        next_obs, next_done, metrics = rollout.run(
-            cfg.rollout.steps, record_samples=True, capture_logits=cfg.capture_logits
-        )
+            global_step = rollout.global_step * parallelism + initial_step
+
+            if parallelism > 1:
+                with tracer.span("reduce_metrics"):
+                    metrics = metric_reducer.reduce(metrics)
+            if rank == 0:
+                for name, value in metrics.items():
+                    writer.add_scalar(f"{name}.mean", value.mean, global_step)
+                    writer.add_scalar(f"{name}.max", value.max, global_step)
+                    writer.add_scalar(f"{name}.min", value.min, global_step)
+                    writer.add_scalar(f"{name}.count", value.count, global_step)
+                used_bytes, reserved_bytes = rollout.storage_bytes()
+                writer.add_scalar("memory/rollout_used_bytes", used_bytes, global_step)
+                writer.add_scalar(
+                    "memory/rollout_reserved_bytes", reserved_bytes, global_step
+                )
 
-        global_step = rollout.global_step * parallelism + initial_step
-
-        if parallelism > 1:
-            serialized_metrics = json.dumps(
-                {
-                    k: {
-                        "count": int(v.count),
-                        "sum": float(v.sum),
-                        "min": float(v.min),
-                        "max": float(v.max),
-                    }
-                    for k, v in metrics.items()
-                }
-            )
-            metrics_tensor = torch.tensor(
-                bytearray(serialized_metrics.encode("utf-8")), dtype=torch.uint8
-            )
-            metrics = {}
-            for metrics_tensor in allgather(metrics_tensor, rank, parallelism):
-                for k, v in json.loads(
-                    metrics_tensor.numpy().tobytes().decode("utf-8")
-                ).items():
-                    m = Metric(**v)
-                    if k in metrics:
-                        metrics[k] += m
-                    else:
-                        metrics[k] = m
-        if rank == 0:
-            for name, value in metrics.items():
-                writer.add_scalar(f"{name}.mean", value.mean, global_step)
-                writer.add_scalar(f"{name}.max", value.max, global_step)
-                writer.add_scalar(f"{name}.min", value.min, global_step)
-                writer.add_scalar(f"{name}.count", value.count, global_step)
-
-        values = rollout.values
-        actions = rollout.actions
-        entities = rollout.entities
-        visible = rollout.visible
-        action_masks = rollout.action_masks
-        logprobs = rollout.logprobs
-
-        with torch.no_grad(), tracer.span("advantages"):
-            returns, advantages = returns_and_advantages(
-                value_function or agent,
-                next_obs,
-                next_done,
-                rollout.rewards,
-                rollout.dones,
-                values,
-                cfg.ppo.gae,
-                cfg.ppo.gamma,
-                cfg.ppo.gae_lambda,
-                device,
-                tracer,
-            )
+            values = rollout.values
+            actions = rollout.actions
+            entities = rollout.entities
+            visible = rollout.visible
+            action_masks = rollout.action_masks
+            logprobs = rollout.logprobs
+
+            with tracer.span("actor_layout"):
+                actor_layout = ActorLayout.from_logprobs(logprobs.buffers, device)
+
+            with torch.no_grad(), tracer.span("advantages"):
+                if cfg.ppo.vtrace:
+                    log_rhos = importance_log_ratios(
+                        agent,
+                        entities,
+                        visible,
+                        action_masks,
+                        actions,
+                        actor_layout,
+                        values.numel(),
+                        cfg.optim.micro_bs or cfg.optim.bs // parallelism,
+                        device,
+                        tracer,
+                    ).view_as(values)
+                    returns, advantages = vtrace_returns_and_advantages(
+                        value_function or agent,
+                        next_obs,
+                        next_done,
+                        rollout.rewards,
+                        rollout.dones,
+                        values,
+                        log_rhos,
+                        cfg.ppo.gamma,
+                        cfg.ppo.vtrace_rho_clip,
+                        cfg.ppo.vtrace_c_clip,
+                        device,
+                        tracer,
+                    )
+                else:
+                    returns, advantages = returns_and_advantages(
+                        value_function or agent,
+                        next_obs,
+                        next_done,
+                        rollout.rewards,
+                        rollout.dones,
+                        values,
+                        cfg.ppo.gae,
+                        cfg.ppo.gamma,
+                        cfg.ppo.gae_lambda,
+                        device,
+                        tracer,
+                    )
 
-        # flatten the batch
-        with tracer.span("flatten"):
-            b_advantages = advantages.reshape(-1)
-            b_returns = returns.reshape(-1).detach()
-            b_values = values.reshape(-1).detach()
-
-        tracer.end("rollout")
-
-        # Optimize the policy and value network
-        tracer.start("optimize")
-        frames = cfg.rollout.num_envs * cfg.rollout.steps // parallelism
-        b_inds = np.arange(frames)
-        clipfracs = []
-
-        for epoch in range(cfg.optim.update_epochs):
-            np.random.shuffle(b_inds)
-            for start in range(0, frames, cfg.optim.bs // parallelism):
-                end = start + cfg.optim.bs // parallelism
-                microbatch_size = (
-                    cfg.optim.micro_bs
-                    if cfg.optim.micro_bs is not None
-                    else cfg.optim.bs // parallelism
-                )
+            # flatten the batch
+            with tracer.span("flatten"):
+                batch = RolloutBatch(rollout, actor_layout, advantages, returns)
+
+            tracer.end("rollout")
+
+            # Optimize the policy and value network
+            tracer.start("optimize")
+            if cuda:
+                torch.cuda.reset_peak_memory_stats(device)
+            optimized_frames = 0
+            frames = cfg.rollout.num_envs * cfg.rollout.steps // parallelism
+            b_inds = np.arange(frames)
+            ppo_stats: Optional[PPOStats] = None
+            padding_efficiencies = []
+
+            for epoch in range(cfg.optim.update_epochs):
+                np.random.shuffle(b_inds)
+                for start in range(0, frames, cfg.optim.bs // parallelism):
+                    end = start + cfg.optim.bs // parallelism
+                    microbatch_size = (
+                        cfg.optim.micro_bs
+                        if cfg.optim.micro_bs is not None
+                        else cfg.optim.bs // parallelism
+                    )
 
-                optimizer.zero_grad()
-                if vf_optimizer is not None:
-                    vf_optimizer.zero_grad()
-                for _start in range(start, end, microbatch_size):
-                    _end = _start + microbatch_size
-                    mb_inds = b_inds[_start:_end]
-
-                    b_entities = entities[mb_inds]
-                    b_visible = visible[mb_inds]
-                    b_action_masks = action_masks[mb_inds]
-                    b_logprobs = logprobs[mb_inds]
-                    b_actions = actions[mb_inds]
-                    mb_advantages = b_advantages[mb_inds]  # type: ignore
-
-                    with tracer.span("forward"):
-                        (
-                            _,
+                    optimizer.zero_grad()
+                    if vf_optimizer is not None:
+                        vf_optimizer.zero_grad()
+                    with tracer.span("microbatches"):
+                        mb_inds_list = microbatches(
+                            b_inds[start:end],
+                            microbatch_size,
+                            batch.entity_counts,
+                            cfg.optim.micro_bs_tokens,
+                        )
+                        padding_efficiencies.append(
+                            padding_efficiency(mb_inds_list, batch.entity_counts)
+                        )
+                        # Upload the indices of all microbatches at once
+                        minibatch_inds = batch.upload_indices(
+                            np.concatenate(mb_inds_list)
+                        )
+                        minibatch_advantages = normalize_advantages(
+                            cfg.ppo, batch.advantages[minibatch_inds]
+                        )
+                    mb_start = 0
+                    for i, mb_inds in enumerate(mb_inds_list):
+                        mb_slice = slice(mb_start, mb_start + len(mb_inds))
+                        with tracer.span("gather"):
+                            mb = batch.gather(mb_inds, minibatch_inds[mb_slice])
+                        mb_start += len(mb_inds)
+
+                        with tracer.span("forward"), autocast(
+                            cfg.optim.precision, device
+                        ):
+                            (
+                                _,
+                                newlogprob,
+                                entropy,
+                                _,
+                                aux,
+                                _,
+                            ) = agent.get_action_and_auxiliary(
+                                mb.entities,
+                                mb.visible,
+                                mb.action_masks,
+                                prev_actions=mb.actions,
+                                tracer=tracer,
+                            )
+                            if value_function is None:
+                                newvalue = aux["value"]
+                            else:
+                                newvalue = value_function.get_auxiliary_head(
+                                    mb.entities, mb.visible, "value", tracer=tracer
+                                )
+
+                        pg_loss, mb_stats = ppo_loss(
+                            cfg.ppo,
                             newlogprob,
-                            entropy,
-                            _,
-                            aux,
-                            _,
-                        ) = agent.get_action_and_auxiliary(
-                            b_entities,
-                            b_visible,
-                            b_action_masks,
-                            prev_actions=b_actions,
-                            tracer=tracer,
+                            mb.actors,
+                            minibatch_advantages[mb_slice],
+                            device,
+                            tracer,
                         )
-                        if value_function is None:
-                            newvalue = aux["value"]
+                        if ppo_stats is None:
+                            ppo_stats = mb_stats
                         else:
-                            newvalue = value_function.get_auxiliary_head(
-                                b_entities, b_visible, "value", tracer=tracer
-                            )
-
-                    pg_loss, clipfrac, approx_kl = ppo_loss(
-                        cfg.ppo, newlogprob, b_logprobs, mb_advantages, device, tracer
-                    )
-                    clipfracs += [clipfrac]
+                            ppo_stats += mb_stats
+
+                        v_loss = value_loss(
+                            cfg.ppo,
+                            newvalue,
+                            mb.returns,
+                            mb.values,
+                            tracer,
+                        )
 
-                    v_loss = value_loss(
-                        cfg.ppo,
-                        newvalue,
-                        b_returns[mb_inds],  # type: ignore
-                        b_values[mb_inds],  # type: ignore
-                        tracer,
+                        # TODO: what's correct way of combining entropy loss from multiple actions/actors on the same timestep?
+                        if cfg.ppo.anneal_entropy:
+                            frac = 1.0 - (update - 1.0) / num_updates
+                            if cfg.max_train_time is not None:
+                                frac = min(
+                                    frac,
+                                    max(
+                                        0,
+                                        1.0
+                                        - (time.time() - start_time)
+                                        / cfg.max_train_time,
+                                    ),
+                                )
+                            ent_coef = frac * cfg.ppo.ent_coef
+                        else:
+                            ent_coef = cfg.ppo.ent_coef
+                        entropy_loss = torch.cat(
+                            [e.float() for e in entropy.values()]
+                        ).mean()
+                        loss = (
+                            pg_loss - ent_coef * entropy_loss + v_loss * cfg.ppo.vf_coef
+                        )
+                        loss *= len(mb_inds) / cfg.optim.bs
+
+                        # Gradients are only all-reduced during the backward pass of the last microbatch
+                        for allreduce in [agent_allreduce, vf_allreduce]:
+                            if allreduce is not None:
+                                allreduce.sync = i == len(mb_inds_list) - 1
+                        with tracer.span("backward"):
+                            scaler.scale(loss).backward()
+                        optimized_frames += len(mb_inds)
+                    if agent_allreduce is not None:
+                        with tracer.span("allreduce"):
+                            agent_allreduce.wait()
+                    scaler.unscale_(optimizer)
+                    gradnorm = nn.utils.clip_grad_norm_(
+                        agent.parameters(), cfg.optim.max_grad_norm
                     )
-
-                    # TODO: what's correct way of combining entropy loss from multiple actions/actors on the same timestep?
-                    if cfg.ppo.anneal_entropy:
-                        frac = 1.0 - (update - 1.0) / num_updates
-                        if cfg.max_train_time is not None:
-                            frac = min(
-                                frac,
-                                max(
-                                    0,
-                                    1.0
-                                    - (time.time() - start_time) / cfg.max_train_time,
-                                ),
-                            )
-                        ent_coef = frac * cfg.ppo.ent_coef
+                    scaler.step(optimizer)
+                    if value_function is not None:
+                        if vf_allreduce is not None:
+                            with tracer.span("allreduce_vf"):
+                                vf_allreduce.wait()
+                        if vf_optimizer is not None:
+                            scaler.unscale_(vf_optimizer)
+                        vf_gradnorm: Union[
+                            torch.Tensor, float
+                        ] = nn.utils.clip_grad_norm_(
+                            value_function.parameters(), cfg.optim.max_grad_norm
+                        )
                     else:
-                        ent_coef = cfg.ppo.ent_coef
-                    entropy_loss = torch.cat([e for e in entropy.values()]).mean()
-                    loss = pg_loss - ent_coef * entropy_loss + v_loss * cfg.ppo.vf_coef
-                    loss *= microbatch_size / cfg.optim.bs
-
-                    with tracer.span("backward"):
-                        loss.backward()
-                if parallelism > 1:
-                    with tracer.span("allreduce"):
-                        gradient_allreduce(agent)
-                gradnorm = nn.utils.clip_grad_norm_(
-                    agent.parameters(), cfg.optim.max_grad_norm
-                )
-                optimizer.step()
-                if value_function is not None:
-                    if parallelism > 1:
-                        with tracer.span("allreduce_vf"):
-                            gradient_allreduce(value_function)
-                    vf_gradnorm = nn.utils.clip_grad_norm_(
-                        value_function.parameters(), cfg.optim.max_grad_norm
-                    ).item()
-                else:
-                    vf_gradnorm = 0.0
-                if vf_optimizer is not None:
-                    vf_optimizer.step()
-
-            if cfg.ppo.target_kl is not None:
-                if approx_kl > cfg.ppo.target_kl:
-                    break
-
-        if cfg.cuda_empty_cache:
-            torch.cuda.empty_cache()
-        tracer.end("optimize")
-
-        tracer.start("metrics")
-        # TODO: aggregate across all ranks
-        y_pred, y_true = b_values.cpu().numpy(), b_returns.cpu().numpy()
-        var_y = np.var(y_true)
-        explained_var = torch.tensor(
-            np.nan if var_y == 0 else 1 - np.var(y_true - y_pred) / var_y
-        )
-        clipfrac = torch.tensor(np.mean(clipfracs))
-        if parallelism > 1:
-            dist.all_reduce(v_loss, op=dist.ReduceOp.SUM)
-            dist.all_reduce(pg_loss, op=dist.ReduceOp.SUM)
-            dist.all_reduce(entropy_loss, op=dist.ReduceOp.SUM)
-            dist.all_reduce(approx_kl, op=dist.ReduceOp.SUM)
-            dist.all_reduce(clipfrac, op=dist.ReduceOp.SUM)
-            dist.all_reduce(explained_var, op=dist.ReduceOp.SUM)
-            v_loss /= parallelism
-            pg_loss /= parallelism
-            entropy_loss /= parallelism
-            approx_kl /= parallelism
-            clipfrac /= parallelism
-            explained_var /= parallelism
-        if rank == 0:
-
-            writer.add_scalar(
-                "charts/learning_rate", optimizer.param_groups[0]["lr"], global_step
-            )
-            writer.add_scalar("charts/entropy_coef", ent_coef, global_step)
-            writer.add_scalar("losses/value_loss", v_loss.item(), global_step)
-            writer.add_scalar("losses/policy_loss", pg_loss.item(), global_step)
-            writer.add_scalar("losses/entropy", entropy_loss.item(), global_step)
-            writer.add_scalar("losses/approx_kl", approx_kl.item(), global_step)
-            writer.add_scalar("losses/clipfrac", clipfrac.item(), global_step)
-            writer.add_scalar(
-                "losses/explained_variance", explained_var.item(), global_step
+                        vf_gradnorm = 0.0
+                    if vf_optimizer is not None:
+                        scaler.step(vf_optimizer)
+                    scaler.update()
+
+                if cfg.ppo.target_kl is not None:
+                    if mb_stats.approx_kl > cfg.ppo.target_kl:
+                        break
+
+            if cfg.cuda_empty_cache:
+                torch.cuda.empty_cache()
+            tracer.end("optimize")
+
+            tracer.start("metrics")
+            # TODO: aggregate across all ranks
+            y_pred, y_true = batch.values.cpu().numpy(), batch.returns.cpu().numpy()
+            var_y = np.var(y_true)
+            explained_var = torch.tensor(
+                np.nan if var_y == 0 else 1 - np.var(y_true - y_pred) / var_y
             )
-            writer.add_scalar("losses/gradnorm", gradnorm, global_step)
-            writer.add_scalar("losses/vf_gradnorm", vf_gradnorm, global_step)
-            writer.add_scalar("restart", state.restart, global_step)
-            # TODO: aggregate actions across ranks
-            for action_name, space in action_space.items():
-                if isinstance(space, CategoricalActionSpace):
-                    _actions = actions.buffers[action_name].as_array().flatten()
-                    if len(_actions) > 0:
-                        for i, label in enumerate(space.index_to_label):
-                            writer.add_scalar(
-                                f"actions/{action_name}/{label}",
-                                np.sum(_actions == i).item() / len(_actions),
-                                global_step,
-                            )
-
-            fps = (global_step - initial_step) / (time.time() - start_time)
-            digits = int(np.ceil(np.log10(cfg.total_timesteps)))
-            episodic_reward = metrics["episodic_reward"].mean
-            episode_length = metrics["episode_length"].mean
-            episode_count = metrics["episode_length"].count
-            mean_reward = metrics["reward"].mean
-
-            def green(s: str) -> str:
-                return click.style(s, fg="cyan")
-
-            def estyle(f: float) -> str:
-                return click.style(f"{f:.2e}", fg="cyan")
-
-            def fstyle(f: float) -> str:
-                return click.style(f"{f:5.2f}", fg="cyan")
-
-            def tstyle(s: str) -> str:
-                return s
-
-            def symstyle(s: str) -> str:
-                return click.style(s, fg="white", bold=True)
-
-            # fmt: off
-            click.echo(
-                green(f"{global_step:>{digits}}") + symstyle("/") + green(f"{cfg.total_timesteps} ")
-                + f"{symstyle('|')} {tstyle('meanrew')} {estyle(mean_reward)} "
-                + f"{symstyle('|')} {tstyle('explained_var')} {fstyle(explained_var.item())} "
-                + f"{symstyle('|')} {tstyle('entropy')} {fstyle(entropy_loss.item())} "
-                + f"{symstyle('|')} {tstyle('episodic_reward')} {estyle(episodic_reward)} "
-                + f"{symstyle('|')} {tstyle('episode_length')} {estyle(episode_length)} "
-                + f"{symstyle('|')} {tstyle('episodes')} {green(str(episode_count))} "
-                + f"{symstyle('|')} {tstyle('fps')} {green(str(int(fps)))}"
-            )
-            # fmt: on
-            writer.add_scalar(
-                "charts/SPS",
-                int((global_step - initial_step) / (time.time() - start_time)),
-                global_step,
-            )
-        tracer.end("metrics")
-        tracer.end("update")
-        traces = tracer.finish()
-        if rank == 0:
-            for callstack, timing in traces.items():
-                writer.add_scalar(f"trace/{callstack}", timing, global_step)
-
-        state.step = global_step
-        with tracer.span("checkpoint"):
-            state_manager.step()
+            assert ppo_stats is not None
+            approx_kl = ppo_stats.mean_approx_kl
+            clipfrac = ppo_stats.mean_clipfrac
+            ratio_min = ppo_stats.ratio_min
+            ratio_max = ppo_stats.ratio_max
+            if parallelism > 1:
+                dist.all_reduce(v_loss, op=dist.ReduceOp.SUM)
+                dist.all_reduce(pg_loss, op=dist.ReduceOp.SUM)
+                dist.all_reduce(entropy_loss, op=dist.ReduceOp.SUM)
+                dist.all_reduce(approx_kl, op=dist.ReduceOp.SUM)
+                dist.all_reduce(clipfrac, op=dist.ReduceOp.SUM)
+                dist.all_reduce(explained_var, op=dist.ReduceOp.SUM)
+                dist.all_reduce(ratio_min, op=dist.ReduceOp.MIN)
+                dist.all_reduce(ratio_max, op=dist.ReduceOp.MAX)
+                v_loss /= parallelism
+                pg_loss /= parallelism
+                entropy_loss /= parallelism
+                approx_kl /= parallelism
+                clipfrac /= parallelism
+                explained_var /= parallelism
+            if rank == 0:
+
+                writer.add_scalar(
+                    "charts/learning_rate", optimizer.param_groups[0]["lr"], global_step
+                )
+                writer.add_scalar("charts/entropy_coef", ent_coef, global_step)
+                writer.add_scalar("losses/value_loss", v_loss.item(), global_step)
+                writer.add_scalar("losses/policy_loss", pg_loss.item(), global_step)
+                writer.add_scalar("losses/entropy", entropy_loss.item(), global_step)
+                # Read all policy update statistics with a single device sync
+                _approx_kl, _clipfrac, _ratio_min, _ratio_max = torch.stack(
+                    [approx_kl, clipfrac, ratio_min, ratio_max]
+                ).tolist()
+                writer.add_scalar("losses/approx_kl", _approx_kl, global_step)
+                writer.add_scalar("losses/clipfrac", _clipfrac, global_step)
+                writer.add_scalar("losses/ratio_min", _ratio_min, global_step)
+                writer.add_scalar("losses/ratio_max", _ratio_max, global_step)
+                writer.add_scalar(
+                    "losses/explained_variance", explained_var.item(), global_step
+                )
+                writer.add_scalar(
+                    "charts/padding_efficiency",
+                    np.mean(padding_efficiencies),
+                    global_step,
+                )
+                writer.add_scalar("losses/gradnorm", gradnorm, global_step)
+                writer.add_scalar("losses/vf_gradnorm", vf_gradnorm, global_step)
+                writer.add_scalar("restart", state.restart, global_step)
+                # TODO: aggregate actions across ranks
+                for action_name, space in action_space.items():
+                    if isinstance(space, CategoricalActionSpace):
+                        _actions = actions.buffers[action_name].as_array().flatten()
+                        if len(_actions) > 0:
+                            for i, label in enumerate(space.index_to_label):
+                                writer.add_scalar(
+                                    f"actions/{action_name}/{label}",
+                                    np.sum(_actions == i).item() / len(_actions),
+                                    global_step,
+                                )
+
+                fps = (global_step - initial_step) / (time.time() - start_time)
+                digits = int(np.ceil(np.log10(cfg.total_timesteps)))
+                episodic_reward = metrics["episodic_reward"].mean
+                episode_length = metrics["episode_length"].mean
+                episode_count = metrics["episode_length"].count
+                mean_reward = metrics["reward"].mean
+
+                def green(s: str) -> str:
+                    return click.style(s, fg="cyan")
+
+                def estyle(f: float) -> str:
+                    return click.style(f"{f:.2e}", fg="cyan")
+
+                def fstyle(f: float) -> str:
+                    return click.style(f"{f:5.2f}", fg="cyan")
+
+                def tstyle(s: str) -> str:
+                    return s
+
+                def symstyle(s: str) -> str:
+                    return click.style(s, fg="white", bold=True)
+
+                # fmt: off
+                click.echo(
+                    green(f"{global_step:>{digits}}") + symstyle("/") + green(f"{cfg.total_timesteps} ")
+                    + f"{symstyle('|')} {tstyle('meanrew')} {estyle(mean_reward)} "
+                    + f"{symstyle('|')} {tstyle('explained_var')} {fstyle(explained_var.item())} "
+                    + f"{symstyle('|')} {tstyle('entropy')} {fstyle(entropy_loss.item())} "
+                    + f"{symstyle('|')} {tstyle('episodic_reward')} {estyle(episodic_reward)} "
+                    + f"{symstyle('|')} {tstyle('episode_length')} {estyle(episode_length)} "
+                    + f"{symstyle('|')} {tstyle('episodes')} {green(str(episode_count))} "
+                    + f"{symstyle('|')} {tstyle('fps')} {green(str(int(fps)))}"
+                )
+                # fmt: on
+                writer.add_scalar(
+                    "charts/SPS",
+                    int((global_step - initial_step) / (time.time() - start_time)),
+                    global_step,
+                )
+            tracer.end("metrics")
+            tracer.end("update")
+            traces = tracer.finish()
+            if rank == 0:
+                for callstack, timing in traces.items():
+                    writer.add_scalar(f"trace/{callstack}", timing, global_step)
+                if traces.get("update.optimize", 0.0) > 0:
+                    writer.add_scalar(
+                        "trace/optimize_frames_per_second",
+                        optimized_frames / traces["update.optimize"],
+                        global_step,
+                    )
+                if cuda:
+                    writer.add_scalar(
+                        "memory/optimize_peak_allocated_bytes",
+                        torch.cuda.max_memory_allocated(device),
+                        global_step,
+                    )
+                if async_rollout is not None:
+                    for callstack, timing in async_rollout.traces.items():
+                        writer.add_scalar(
+                            f"trace/async_rollout.{callstack}", timing, global_step
+                        )
+                    writer.add_scalar(
+                        "charts/policy_lag", async_rollout.policy_lag, global_step
+                    )
+                for write_time in checkpointer.write_times():
+                    writer.add_scalar("trace/checkpoint_write", write_time, global_step)
+
+            state.step = global_step
+            with tracer.span("checkpoint"):
+                checkpointer.step()
+    finally:
+        # Writes the last skipped checkpoint and waits for pending writes even if
+        # training is interrupted by an exception
+        checkpointer.close()
+        if async_rollout is not None:
+            async_rollout.close()
 
     if cfg.eval is not None:
         _run_eval()
@@ -672,22 +840,6 @@ def init_process(xp_info: Any, backend: str = "gloo") -> None:
     )
 
 
-def gradient_allreduce(model: Any) -> None:
-    all_grads_list = []
-    for param in model.parameters():
-        if param.grad is not None:
-            all_grads_list.append(param.grad.view(-1))
-    all_grads = torch.cat(all_grads_list)
-    dist.all_reduce(all_grads, op=dist.ReduceOp.SUM)
-    offset = 0
-    for param in model.parameters():
-        if param.grad is not None:
-            param.grad.data.copy_(
-                all_grads[offset : offset + param.numel()].view_as(param.grad.data)
-            )
-            offset += param.numel()
-
-
 def _create_agent(
     cfg: TrainConfig, obs_space: ObsSpace, action_space: Dict[ActionName, ActionSpace]
 ) -> SerializableRogueNet: